@@ -0,0 +1,137 @@
+#Write synthetic E/p trees with the branches of EoverPTreeAlgo, so that the plotting code can be run and timed without access to eos
+import numpy as np
+import os
+import imp
+import argparse
+
+try:
+    imp.find_module('root_numpy')
+    foundRootNumpy=True
+except ImportError:
+    foundRootNumpy=False
+    print("Didn't find root_numpy module. Trees can't be written. Continuing")
+
+if foundRootNumpy:
+    from root_numpy import array2root
+
+#the branches written by EoverPTreeAlgo.cxx, with the types in EoverPTreeAlgo.h
+tree_name = "LA_EoverP_InDetTrackParticlesSortedLooseIsolatedVertexAssociated_tree"
+layers = ["PreSamplerB", "EMB1", "EMB2", "EMB3", "PreSamplerE", "EME1", "EME2", "EME3", "HEC0", "HEC1", "HEC2", "HEC3", "TileBar0", "TileBar1", "TileBar2", "TileGap1", "TileGap2", "TileGap3", "TileExt0", "TileExt1", "TileExt2"]
+barrel_layers = ["PreSamplerB", "EMB1", "EMB2", "EMB3", "TileBar0", "TileBar1", "TileBar2", "TileGap1", "TileGap2", "TileGap3"]
+energy_calibs = ["ClusterEnergy", "CellEnergy", "LCWClusterEnergy", "TotalCalibHitEnergy", "TotalPhotonBackgroundCalibHitEnergy", "TotalHadronicBackgroundCalibHitEnergy", "CalibEMActiveEnergy", "CalibEMInactiveEnergy", "CalibNonEMActiveEnergy", "CalibNonEMInactiveEnergy", "ClusterEMActiveCalibHitEnergy"]
+radius_cuts = ["025", "050", "075", "100", "125", "150", "175", "200", "225", "250", "275", "300"]
+no_extrapolation = -999999999.0
+
+data_directory_name = "user.synthetic.data17_13TeV.00000001.physics_MinBias.EoverP_hist/"
+mc_directory_name = "user.synthetic.mc16_13TeV.361021.Pythia8EvtGen_A14NNPDF23LO_jetjet_JZ1W.EoverP_hist/"
+
+def get_dtype():
+    '''get the numpy dtype of a track in the tree'''
+    dtype = [("trkIndex", np.uint8), ("trk_etaID", np.float32), ("trk_phiID", np.float32), ("trk_pt", np.float32), ("trk_d0", np.float32),\
+             ("trk_nTRT", np.uint8), ("trk_nSCT", np.uint8), ("trk_charge", np.int8), ("trk_z0sintheta", np.float32), ("trk_z0sintheta_primary", np.float32),\
+             ("trk_p", np.float32), ("trk_p_err", np.float32), ("trk_nearest_dR_EM", np.float32), ("trk_nearest_dR_HAD", np.float32), ("trkWeight", np.float32),\
+             ("trk_NPV_2", np.uint8), ("trk_NPV_4", np.uint8), ("trk_hasTruthParticle", np.int8), ("trk_truthPdgId", np.int32), ("trk_truthEnergy", np.float32),\
+             ("trk_truthP", np.float32), ("trk_truthProb", np.float32), ("trk_actualmu", np.float32), ("trk_averagemu", np.float32), ("trk_corrected_averagemu", np.float32)]
+    for layer in layers:
+        dtype.append(("trk_eta" + layer, np.float32))
+        dtype.append(("trk_phi" + layer, np.float32))
+    for calib in energy_calibs:
+        for radius_cut in radius_cuts:
+            dtype.append(("trk_{}_EM_{}".format(calib, radius_cut), np.float32))
+            dtype.append(("trk_{}_HAD_{}".format(calib, radius_cut), np.float32))
+    for radius_cut in radius_cuts:
+        for name in ["EM", "HAD", "EM_emlike", "HAD_emlike", "EM_hadlike", "HAD_hadlike"]:
+            dtype.append(("trk_nclusters_{}_{}".format(name, radius_cut), np.int32))
+    return dtype
+
+def generate_tracks(n_tracks, is_data, seed = 0):
+    '''generate a structured array of n_tracks synthetic tracks, with distributions that look roughly like those of the low mu data'''
+    random = np.random.RandomState(seed)
+    tracks = np.zeros(n_tracks, dtype = get_dtype())
+
+    #the index of the track in its event. Most events have only a few tracks
+    tracks["trkIndex"] = random.geometric(0.4, size = n_tracks) - 1
+    eta = random.uniform(-2.5, 2.5, size = n_tracks)
+    phi = random.uniform(-np.pi, np.pi, size = n_tracks)
+    pt = 0.5 + random.exponential(1.5, size = n_tracks)
+    p = pt * np.cosh(eta)
+    tracks["trk_etaID"] = eta
+    tracks["trk_phiID"] = phi
+    tracks["trk_pt"] = pt
+    tracks["trk_p"] = p
+    tracks["trk_p_err"] = 0.01 * p
+    tracks["trk_d0"] = random.normal(0.0, 0.5, size = n_tracks)
+    tracks["trk_z0sintheta"] = random.normal(0.0, 0.8, size = n_tracks)
+    tracks["trk_z0sintheta_primary"] = tracks["trk_z0sintheta"]
+    tracks["trk_nTRT"] = np.where(np.abs(eta) < 2.0, random.randint(0, 45, size = n_tracks), 0)
+    tracks["trk_nSCT"] = random.randint(6, 12, size = n_tracks)
+    tracks["trk_charge"] = random.choice([-1, 1], size = n_tracks)
+    tracks["trk_nearest_dR_EM"] = random.uniform(0.4, 3.0, size = n_tracks)
+    tracks["trk_nearest_dR_HAD"] = random.uniform(0.4, 3.0, size = n_tracks)
+    tracks["trk_NPV_2"] = random.randint(1, 4, size = n_tracks)
+    tracks["trk_NPV_4"] = tracks["trk_NPV_2"]
+    tracks["trk_actualmu"] = random.uniform(0.0, 2.0, size = n_tracks)
+    tracks["trk_averagemu"] = tracks["trk_actualmu"]
+    tracks["trk_corrected_averagemu"] = tracks["trk_actualmu"]
+    tracks["trkWeight"] = 1.0 if is_data else random.uniform(0.5, 1.5, size = n_tracks)
+
+    if not is_data:
+        tracks["trk_hasTruthParticle"] = random.uniform(size = n_tracks) < 0.95
+        tracks["trk_truthProb"] = random.uniform(0.3, 1.0, size = n_tracks)
+        tracks["trk_truthPdgId"] = tracks["trk_charge"] * random.choice([211, 211, 211, 321, 2212, 11], size = n_tracks)
+        tracks["trk_truthP"] = p / 1000.0
+        tracks["trk_truthEnergy"] = p / 1000.0
+
+    #the extrapolated coordinates. Layers that the track doesn't reach have no extrapolation
+    for layer in layers:
+        in_barrel = layer in barrel_layers
+        reached = (np.abs(eta) < 1.5) if in_barrel else (np.abs(eta) > 1.35)
+        tracks["trk_eta" + layer] = np.where(reached, eta + random.normal(0.0, 0.01, size = n_tracks), no_extrapolation)
+        tracks["trk_phi" + layer] = np.where(reached, phi + random.normal(0.0, 0.01, size = n_tracks), no_extrapolation)
+
+    #the energy in each cone grows with the cone size. About a third of the tracks have no energy deposit at all
+    has_energy = random.uniform(size = n_tracks) > 0.3
+    had_fraction = random.uniform(0.0, 1.0, size = n_tracks)
+    for calib in energy_calibs:
+        scale = 1.0 if "Calib" not in calib else 0.3
+        em_sum = np.zeros(n_tracks)
+        had_sum = np.zeros(n_tracks)
+        for i, radius_cut in enumerate(radius_cuts):
+            core = p * scale * random.gamma(2.0, 0.25, size = n_tracks) if i == 0 else np.zeros(n_tracks)
+            pileup = random.exponential(0.02 * (i + 1), size = n_tracks)
+            em_sum = em_sum + has_energy * ((1.0 - had_fraction) * core + pileup)
+            had_sum = had_sum + has_energy * (had_fraction * core + 0.5 * pileup)
+            tracks["trk_{}_EM_{}".format(calib, radius_cut)] = em_sum
+            tracks["trk_{}_HAD_{}".format(calib, radius_cut)] = had_sum
+
+    for name in ["EM", "HAD", "EM_emlike", "HAD_emlike", "EM_hadlike", "HAD_hadlike"]:
+        n_clusters = np.zeros(n_tracks, dtype = np.int32)
+        for radius_cut in radius_cuts:
+            n_clusters = n_clusters + has_energy * random.poisson(0.3, size = n_tracks)
+            tracks["trk_nclusters_{}_{}".format(name, radius_cut)] = n_clusters
+
+    return tracks
+
+def write_synthetic_trees(output_directory, n_tracks, seed = 0):
+    '''
+    Write a data and a Pythia JZ1W tree with n_tracks tracks each to output_directory. Return a dictionary of channel to list of directories, that can be passed to utils.tchain_files_together with on_eos = False
+    '''
+    files = {}
+    for channel, directory_name, is_data in [("LowMuData", data_directory_name, True), ("PythiaJetJet", mc_directory_name, False)]:
+        directory = os.path.join(output_directory, directory_name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, "tree.root")
+        if not os.path.exists(filename):
+            print("Writing {} synthetic tracks to {}".format(n_tracks, filename))
+            array2root(generate_tracks(n_tracks, is_data, seed = seed), filename, treename = tree_name, mode = "recreate")
+        files[channel] = [directory]
+    return files
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic E/p trees for benchmarking the plotting code')
+    parser.add_argument('--output_directory', '-o', dest="output_directory", type=str, required=True, help='where to write the trees')
+    parser.add_argument('--n_tracks', '-n', dest="n_tracks", type=int, default=100000, help='the number of tracks in each tree')
+    parser.add_argument('--seed', '-s', dest="seed", type=int, default=0, help='the seed of the random numbers')
+    args = parser.parse_args()
+    write_synthetic_trees(args.output_directory, args.n_tracks, seed = args.seed)
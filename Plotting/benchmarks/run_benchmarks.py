@@ -0,0 +1,158 @@
+#Time each step of the histogram filling on synthetic trees, so that the performance can be compared between commits
+import os
+import time
+import json
+import subprocess
+import argparse
+import numpy as np
+import ROOT
+from root_numpy import tree2array
+
+import utils
+from generate_trees import write_synthetic_trees, tree_name
+from histogram_filling import HistogramFiller, get_needed_branches, get_p, get_log_bins, create_selection_function
+from fill_plan import FillPlan
+from calculation import WeightCalculation, BlockEvaluator
+from variables import weight, calc_trkP, calc_trkCount
+from selections import sel_NonZeroEnergy, sel_Event, sel_HardScatter, ParticlePDGID_ABS
+from eop_histograms import create_eop_histograms
+from fill_script import write_histograms
+
+eta_bin_edges = [0.0, 0.2, 0.7, 1.3, 1.8, 2.5]
+eta_ranges = [(eta_bin_edges[i], eta_bin_edges[i+1]) for i in range(0, len(eta_bin_edges)-1)]
+
+def create_reweighting_histogram(name):
+    '''a reweighting histogram for the simulation, like the ones in ReweightingHistograms'''
+    p_bins = get_log_bins(0.5, 40.05, 100)
+    histogram = ROOT.TH1D(name, name, len(p_bins) - 1, np.array(p_bins))
+    for i in range(1, histogram.GetNbinsX() + 1):
+        histogram.SetBinContent(i, 0.5 + float(i) / histogram.GetNbinsX())
+    histogram.SetDirectory(0)
+    return histogram
+
+def create_histogram_filler(files):
+    '''create a HistogramFiller for the synthetic trees, with the histograms of the E/p measurement booked'''
+    trees = utils.tchain_files_together(tree_name, files, on_eos = False)
+    weight_calculator = WeightCalculation(weight, ["trkWeight"])
+    hist_filler = HistogramFiller(trees, tree_name, weight_calculator)
+    weight_calculator.add_reweight_histogram("PythiaJetJet", [calc_trkP], create_reweighting_histogram("BenchmarkMomentumReweight"), selection = [])
+    weight_calculator.add_reweight_histogram("PythiaJetJet", [calc_trkCount], create_reweighting_histogram("BenchmarkCountReweight"), selection = [sel_Event])
+    sel_Pion = create_selection_function(ParticlePDGID_ABS, ["trk_truthPdgId"], 211.0)
+    hist_filler.create_subchannel_for_channel("PythiaJetJetHardScatterPion", "PythiaJetJet", [sel_Pion, sel_HardScatter])
+
+    p_bins_for_eta_range = []
+    for eta_range in eta_ranges:
+        p_bins_min = get_p(0.5, (eta_range[0] + eta_range[1]) / 2.0)
+        p_bins_for_eta_range.append(get_log_bins(p_bins_min, 30.05, 15))
+    create_eop_histograms(hist_filler, [sel_NonZeroEnergy], eta_ranges, p_bins_for_eta_range, "NonZeroEnergy")
+    return hist_filler
+
+def read_tracks(hist_filler, channel, filename):
+    '''read the branches needed by the booked histograms, without evaluating anything'''
+    branches = get_needed_branches(hist_filler.all_variables, hist_filler.all_selections) + hist_filler.weight_calculator.branches
+    return tree2array(hist_filler.trees[channel][filename], list(set(branches)))
+
+def get_all_data(hist_filler):
+    data = {}
+    for channel in hist_filler.channels:
+        if channel in hist_filler.subchannels:
+            continue
+        data[channel] = {}
+        for filename in hist_filler.channel_files[channel]:
+            data[channel][filename] = hist_filler.get_data(channel, filename, hist_filler.all_variables, hist_filler.all_selections, close_file = False)
+    data.update(hist_filler.get_subchannel_data(data))
+    return data
+
+def benchmark_get_data(files):
+    hist_filler = create_histogram_filler(files)
+    start = time.time()
+    get_all_data(hist_filler)
+    return time.time() - start
+
+def benchmark_selections(files):
+    hist_filler = create_histogram_filler(files)
+    tracks = [read_tracks(hist_filler, channel, filename) for channel in hist_filler.trees for filename in hist_filler.trees[channel]]
+    start = time.time()
+    for trk in tracks:
+        trk = BlockEvaluator(trk)
+        for selection in hist_filler.all_selections:
+            selection.eval(trk)
+    return time.time() - start
+
+def benchmark_reweighting(files):
+    hist_filler = create_histogram_filler(files)
+    filename = hist_filler.channel_files["PythiaJetJet"][0]
+    trk = read_tracks(hist_filler, "PythiaJetJet", filename)
+    start = time.time()
+    hist_filler.weight_calculator.eval(trk, False, "PythiaJetJet")
+    return time.time() - start
+
+def benchmark_filling(files):
+    hist_filler = create_histogram_filler(files)
+    data = get_all_data(hist_filler)
+    accumulators = hist_filler.create_all_accumulators()
+    plan = FillPlan(list(hist_filler.booked_histograms.values()))
+    start = time.time()
+    plan.fill(data, accumulators)
+    hist_filler.convert_accumulators(accumulators)
+    return time.time() - start
+
+def benchmark_dump_histograms(files):
+    hist_filler = create_histogram_filler(files)
+    start = time.time()
+    hist_filler.DumpHistograms()
+    return time.time() - start
+
+def benchmark_write_histograms(files, output_directory):
+    hist_filler = create_histogram_filler(files)
+    histograms = hist_filler.DumpHistograms()
+    output_filename = os.path.join(output_directory, "benchmark_histograms.root")
+    start = time.time()
+    outFile = ROOT.TFile(output_filename, "RECREATE")
+    for histogram_name in histograms:
+        write_histograms(histograms[histogram_name], outFile)
+    outFile.Close()
+    elapsed = time.time() - start
+    os.remove(output_filename)
+    return elapsed
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except Exception:
+        return "unknown"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the steps of the histogram filling on synthetic trees')
+    parser.add_argument('--work_directory', '-w', dest="work_directory", type=str, required=True, help='where to write the synthetic trees. The trees are reused by later runs')
+    parser.add_argument('--n_tracks', '-n', dest="n_tracks", type=int, nargs='+', default=[10000, 100000, 1000000], help='the number of tracks in each synthetic tree')
+    parser.add_argument('--repeat', '-r', dest="repeat", type=int, default=3, help='how many times to time each step')
+    parser.add_argument('--output_file', '-o', dest="output_file", type=str, default=None, help='a json file to write the timings to')
+    args = parser.parse_args()
+
+    benchmarks = [("GetData", benchmark_get_data),\
+                  ("selections", benchmark_selections),\
+                  ("reweighting", benchmark_reweighting),\
+                  ("filling", benchmark_filling),\
+                  ("DumpHistograms", benchmark_dump_histograms),\
+                  ("write_histograms", lambda files: benchmark_write_histograms(files, os.path.abspath(args.work_directory)))]
+
+    results = {"commit" : get_commit(), "timings" : {}}
+    for n_tracks in args.n_tracks:
+        files = write_synthetic_trees(os.path.join(os.path.abspath(args.work_directory), "tracks_{}".format(n_tracks)), n_tracks)
+        results["timings"][n_tracks] = {}
+        for name, benchmark in benchmarks:
+            times = [benchmark(files) for i in range(0, args.repeat)]
+            results["timings"][n_tracks][name] = times
+
+    print("\n" * 2)
+    print("Timings for commit {}".format(results["commit"]))
+    print("{:>10} {:>20} {:>12} {:>12}".format("tracks", "step", "min [s]", "median [s]"))
+    for n_tracks in args.n_tracks:
+        for name, benchmark in benchmarks:
+            times = results["timings"][n_tracks][name]
+            print("{:>10} {:>20} {:>12.3f} {:>12.3f}".format(n_tracks, name, min(times), float(np.median(times))))
+
+    if args.output_file != None:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent = 1)
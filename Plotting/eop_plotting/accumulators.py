@@ -0,0 +1,216 @@
+import numpy as np
+
+class Axis:
+    '''
+    The binning of one axis of a histogram, with the same bin numbering as a TAxis: bin 0 is the underflow, bins 1 to nbins are the bins of the axis, and bin nbins + 1 is the overflow.
+    bins is either a list of bin edges, or a number of equal bins between low and high.
+    '''
+    def __init__(self, bins, low = None, high = None):
+        if type(bins) == list:
+            self.edges = np.array(bins, dtype = np.float64)
+            self.nbins = len(bins) - 1
+            self.uniform = False
+            self.low = self.edges[0]
+            self.high = self.edges[-1]
+        else:
+            self.edges = None
+            self.nbins = int(bins)
+            self.uniform = True
+            self.low = float(low)
+            self.high = float(high)
+
+    @property
+    def key(self):
+        '''the bin edges of the axis, or the number of bins and the range for equal bins. Axes with the same key have the same bins'''
+        if self.uniform:
+            return (self.nbins, self.low, self.high)
+        return tuple(self.edges)
+
+    def find_bins(self, values):
+        '''get the bin of each value, like TAxis::FindBin. Values below the axis go to the underflow, and values above the axis or nan go to the overflow'''
+        values = np.asarray(values, dtype = np.float64)
+        below = values < self.low
+        above = np.logical_not(values < self.high)
+        inside = np.logical_not(below | above)
+        bins = np.empty(len(values), dtype = np.intp)
+        bins[below] = 0
+        bins[above] = self.nbins + 1
+        if self.uniform:
+            bins[inside] = 1 + (self.nbins * (values[inside] - self.low) / (self.high - self.low)).astype(np.intp)
+        else:
+            bins[inside] = np.searchsorted(self.edges, values[inside], side = "right")
+        return bins
+
+def get_booking_axes(booking):
+    '''get the axes of a HistogramBooking, with the same ranges as the histograms created by HistogramFiller.create_histograms'''
+    options = booking.options
+    if booking.histogram_type == "TH2D":
+        if type(options["bins_x"]) == list and type(options["bins_y"]) == list:
+            return [Axis(options["bins_x"]), Axis(options["bins_y"])]
+        elif type(options["bins_x"]) != list and type(options["bins_y"]) != list:
+            return [Axis(options["bins_x"], options["range_low_x"] + 0.0000001, options["range_high_x"] - 0.000001), Axis(options["bins_y"], options["range_low_y"] + 0.0000001, options["range_high_y"] + 0.0000001)]
+        raise ValueError("both of the bins_x and bins_y variables need to be the same type. Both integers, or both lists")
+    if type(options["bins"]) == list:
+        return [Axis(options["bins"])]
+    return [Axis(options["bins"], options["range_low"] + 0.0000001, options["range_high"] - 0.000001)]
+
+class HistogramAccumulator:
+    '''
+    The sums of a TH1D, TH2D or TProfile kept in numpy arrays, filled with np.bincount. No ROOT object is needed until the histogram is written.
+    The arrays are in the global bin order of root, including the underflow and overflow bins, in the same format as merging.histogram_to_arrays:
+    contents is the sum of the weights (the sum of weight * y for a TProfile), sumw2 the sum of the squared weights (weight * y * y for a TProfile), stats the statistics from TH1::GetStats and entries the number of fills.
+    A TProfile also has bin_entries, the sum of the weights, and bin_sumw2, the sum of the squared weights in each bin.
+    '''
+    def __init__(self, histogram_type, axes):
+        self.histogram_type = histogram_type
+        self.axes = axes
+        self.ncells = 1
+        for axis in axes:
+            self.ncells *= axis.nbins + 2
+        self.arrays = {}
+        self.arrays["contents"] = np.zeros(self.ncells)
+        self.arrays["sumw2"] = np.zeros(self.ncells)
+        self.arrays["stats"] = np.zeros(13)
+        self.arrays["entries"] = 0.0
+        if histogram_type == "TProfile":
+            self.arrays["bin_entries"] = np.zeros(self.ncells)
+            self.arrays["bin_sumw2"] = np.zeros(self.ncells)
+
+    def get_global_bins(self, bins):
+        '''get the global bin number from the bin number along each axis'''
+        global_bins = bins[0]
+        stride = self.axes[0].nbins + 2
+        for axis, axis_bins in zip(self.axes[1:], bins[1:]):
+            global_bins = global_bins + stride * axis_bins
+            stride *= axis.nbins + 2
+        return global_bins
+
+    def fill(self, values, weights = None, bins = None):
+        '''
+        Fill the list of arrays values, weighted by weights. For a TProfile, values are the x values and the y values to profile. If weights is None, every entry has a weight of 1.
+        bins is an optional list of the bin along each axis of every entry, as returned by Axis.find_bins, for when they are already known.
+        '''
+        x = np.asarray(values[0], dtype = np.float64)
+        weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype = np.float64)
+        if bins is None:
+            n_binned = 1 if self.histogram_type == "TProfile" else len(self.axes)
+            bins = [axis.find_bins(value) for axis, value in zip(self.axes, values[:n_binned])]
+        global_bins = self.get_global_bins(bins)
+
+        #the statistics only include the entries inside of the axes, like TH1::Fill
+        in_range = np.ones(len(x), dtype = bool)
+        for axis, axis_bins in zip(self.axes, bins):
+            in_range &= (axis_bins > 0) & (axis_bins <= axis.nbins)
+        w = weights[in_range]
+        stats = self.arrays["stats"]
+        stats[0] += np.sum(w)
+        stats[1] += np.sum(w * w)
+        stats[2] += np.sum(w * x[in_range])
+        stats[3] += np.sum(w * x[in_range] * x[in_range])
+
+        if self.histogram_type == "TProfile":
+            y = np.asarray(values[1], dtype = np.float64)
+            self.arrays["contents"] += np.bincount(global_bins, weights = weights * y, minlength = self.ncells)
+            self.arrays["sumw2"] += np.bincount(global_bins, weights = weights * y * y, minlength = self.ncells)
+            self.arrays["bin_entries"] += np.bincount(global_bins, weights = weights, minlength = self.ncells)
+            self.arrays["bin_sumw2"] += np.bincount(global_bins, weights = weights * weights, minlength = self.ncells)
+            stats[4] += np.sum(w * y[in_range])
+            stats[5] += np.sum(w * y[in_range] * y[in_range])
+        else:
+            self.arrays["contents"] += np.bincount(global_bins, weights = weights, minlength = self.ncells)
+            self.arrays["sumw2"] += np.bincount(global_bins, weights = weights * weights, minlength = self.ncells)
+            if self.histogram_type == "TH2D":
+                y = np.asarray(values[1], dtype = np.float64)
+                stats[4] += np.sum(w * y[in_range])
+                stats[5] += np.sum(w * y[in_range] * y[in_range])
+                stats[6] += np.sum(w * x[in_range] * y[in_range])
+        self.arrays["entries"] += len(x)
+
+    def add(self, other):
+        '''add the sums of another accumulator with the same binning'''
+        for key in self.arrays:
+            self.arrays[key] = self.arrays[key] + other.arrays[key]
+
+    def get_output_arrays(self):
+        '''get the list of the arrays of each histogram written from this accumulator, in the order of HistogramBooking.get_output_bookings'''
+        return [self.arrays]
+
+class SplitHistogramAccumulator:
+    '''
+    A TH1D for every momentum bin of every eta range, kept in dense (cell, bin) arrays so that all of them are filled in a single pass over the tracks. The cells are the momentum bins of the first eta range, then those of the second, and so on.
+    A track is in an eta range if low < |eta| < high, like selections.EtaBin, and in a momentum bin if low < p <= high, like selections.PBin.
+    The values filled are the variable binned along axis, the absolute eta and the momentum.
+    '''
+    def __init__(self, eta_ranges, p_bins_for_eta_range, axis):
+        self.eta_ranges = eta_ranges
+        self.p_edges = [np.array(p_bins, dtype = np.float64) for p_bins in p_bins_for_eta_range]
+        self.offsets = np.cumsum([0] + [len(p_edges) - 1 for p_edges in self.p_edges])
+        self.ncells_split = int(self.offsets[-1])
+        self.axes = [axis]
+        self.nbins = axis.nbins + 2
+        self.contents = np.zeros((self.ncells_split, self.nbins))
+        self.sumw2 = np.zeros((self.ncells_split, self.nbins))
+        self.stats = np.zeros((self.ncells_split, 13))
+        self.entries = np.zeros(self.ncells_split)
+
+    def find_cells(self, eta, p):
+        '''get the cell of each track in every eta range, as a list of (indices of the tracks in the range, cell of each of those tracks) tuples. Tracks outside of all momentum bins are dropped'''
+        cells = []
+        for eta_range, p_edges, offset in zip(self.eta_ranges, self.p_edges, self.offsets):
+            indices = np.flatnonzero((eta > eta_range[0]) & (eta < eta_range[1]))
+            p_bins = np.searchsorted(p_edges, p[indices], side = "left") - 1
+            in_p_bins = (p_bins >= 0) & (p_bins < len(p_edges) - 1)
+            cells.append((indices[in_p_bins], offset + p_bins[in_p_bins]))
+        return cells
+
+    def fill(self, values, weights = None, bins = None):
+        x = np.asarray(values[0], dtype = np.float64)
+        eta = np.asarray(values[1], dtype = np.float64)
+        p = np.asarray(values[2], dtype = np.float64)
+        weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype = np.float64)
+        x_bins = self.axes[0].find_bins(x) if bins is None else bins[0]
+
+        #the cells of the tracks in all of the eta ranges are filled together, with one bincount for each sum
+        cells_in_eta_ranges = self.find_cells(eta, p)
+        indices = np.concatenate([range_indices for range_indices, range_cells in cells_in_eta_ranges])
+        cells = np.concatenate([range_cells for range_indices, range_cells in cells_in_eta_ranges])
+        w = weights[indices]
+        cell_x = x[indices]
+        cell_x_bins = x_bins[indices]
+        global_bins = cells * self.nbins + cell_x_bins
+        self.contents += np.bincount(global_bins, weights = w, minlength = self.contents.size).reshape(self.contents.shape)
+        self.sumw2 += np.bincount(global_bins, weights = w * w, minlength = self.sumw2.size).reshape(self.sumw2.shape)
+        self.entries += np.bincount(cells, minlength = self.ncells_split)
+
+        #the statistics only include the entries inside of the axis, like TH1::Fill
+        in_range = (cell_x_bins > 0) & (cell_x_bins <= self.axes[0].nbins)
+        cells = cells[in_range]
+        w = w[in_range]
+        cell_x = cell_x[in_range]
+        for i, sums in enumerate([w, w * w, w * cell_x, w * cell_x * cell_x]):
+            self.stats[:, i] += np.bincount(cells, weights = sums, minlength = self.ncells_split)
+
+    def add(self, other):
+        '''add the sums of another accumulator with the same binning'''
+        self.contents = self.contents + other.contents
+        self.sumw2 = self.sumw2 + other.sumw2
+        self.stats = self.stats + other.stats
+        self.entries = self.entries + other.entries
+
+    def get_output_arrays(self):
+        '''get the list of the arrays of the TH1D of each cell, in the format of merging.histogram_to_arrays and in the order of HistogramBooking.get_output_bookings'''
+        output_arrays = []
+        for cell in range(0, self.ncells_split):
+            arrays = {}
+            arrays["contents"] = self.contents[cell]
+            arrays["sumw2"] = self.sumw2[cell]
+            arrays["stats"] = self.stats[cell]
+            arrays["entries"] = self.entries[cell]
+            output_arrays.append(arrays)
+        return output_arrays
+
+def create_accumulator(booking):
+    '''create an empty accumulator for a HistogramBooking'''
+    if booking.histogram_type == "TH1DSplit":
+        return SplitHistogramAccumulator(booking.options["eta_ranges"], booking.options["p_bins_for_eta_range"], get_booking_axes(booking)[0])
+    return HistogramAccumulator(booking.histogram_type, get_booking_axes(booking))
@@ -1,10 +1,5 @@
-from pyximport import install
 import numpy as np
-import os
-cython_cache = os.path.join(os.getenv("EOPPlottingDir"), "cython_cache")
-if not os.path.exists(cython_cache): os.makedirs(cython_cache)
-install(setup_args={"include_dirs":np.get_include()},reload_support=True, build_dir=cython_cache)
-from utils_cython import get_weights_from_bins, get_weights_from_2dbins
+from utils_binning import get_weights_from_bins, get_weights_from_2dbins
 
 class CalculationDataMC:
     def __init__(self, function, list_of_branches):
@@ -16,14 +11,52 @@ class CalculationDataMC:
     def eval(self, data, dataFlag):
         return self.function(data, dataFlag)
 
+class BlockEvaluator:
+    '''
+    A block of tracks, together with the values of the calculations that have been evaluated on it. Each calculation is evaluated once per block and then looked up by the calculation itself,
+    so that two calculations with the same name don't share a value, and calculations that depend on the same intermediate value (e.g. the extrapolated eta and phi in the ECAL) share it instead of calculating it again.
+    Indexing, "in" and len() are passed through to the block, so an evaluator can be passed to every calculation in place of the data.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.values = {}
+
+    def __getitem__(self, branch):
+        return self.data[branch]
+
+    def __contains__(self, branch):
+        return branch in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def evaluate(self, calculation):
+        if calculation not in self.values:
+            self.values[calculation] = calculation.function(self)
+        return self.values[calculation]
+
 class Calculation:
-    def __init__(self, function, list_of_branches):
+    '''
+    A quantity calculated from the branches in list_of_branches. dependencies is a list of other Calculations whose values are used by function through their eval method.
+    The branches of the dependencies are added to the branches of this calculation, so that they are always read.
+    '''
+    def __init__(self, function, list_of_branches, dependencies = []):
         self.function = function
         self.name = function.__name__
         self.needsDataFlag = False
-        self.branches = list_of_branches
+        self.dependencies = list(dependencies)
+        self.branches = list(list_of_branches)
+        for dependency in self.dependencies:
+            for branch in dependency.branches:
+                if branch not in self.branches:
+                    self.branches.append(branch)
 
     def eval(self, data):
+        if isinstance(data, BlockEvaluator):
+            return data.evaluate(self)
         return self.function(data)
 
 def WeightsToNormalizeToHistogram(variable_in_histogram, histogram):
@@ -91,7 +124,7 @@ class WeightCalculation:
         self.reweightDictionary = {}
 
     def eval(self, data, isData, channel):
-        weights = self.function(data, isData)
+        weights = np.array(self.function(data, isData)) #copy, since the weights are scaled in place below
         if channel in self.reweightDictionary:
             for variables, histogram, selection in zip(self.reweightDictionary[channel]["variables"], self.reweightDictionary[channel]["histograms"], self.reweightDictionary[channel]["selections"]):
                 if len(variables) == 1:
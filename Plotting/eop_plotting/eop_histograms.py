@@ -5,7 +5,7 @@ from math import pi
 import pickle
 import numpy as np
 from eop_plotting.selections import EtaBin, PBin, sel_SubleadingTrack
-from eop_plotting.variables import calc_trkP
+from eop_plotting.variables import calc_trkP, calc_EOP, calc_trkEtaECAL_ABS
 
 
 def put_binning_vectors_in_file(outFile, eta_ranges, p_bins_for_eta_range, description):
@@ -54,6 +54,7 @@ def put_binning_vectors_in_file(outFile, eta_ranges, p_bins_for_eta_range, descr
         binningTree.Write()
 
 def create_eop_histograms(hist_filler, base_selection, eta_ranges,p_bins_for_eta_range, description, do_cluster_plots=False, do_calib_hit_plots=False):
+    eop_bins = get_bins(-1.0, +3.0, 800) # use a super fine binning
     #define a set of eta bins
     eta_count = -1
     for eta_range, p_bins in zip(eta_ranges, p_bins_for_eta_range):
@@ -67,12 +68,10 @@ def create_eop_histograms(hist_filler, base_selection, eta_ranges,p_bins_for_eta
         Pt_low = 0.5
         Pt_high = max(p_bins)
         ptbins = get_log_bins(Pt_low, Pt_high, NPtBins)
-        eop_bins = get_bins(-1.0, +3.0, 800) # use a super fine binning
 
         histogram_name = "EOPProfileVsMomentum"
         histogram_name = histogram_name + "_" + "_" + description + "_Eta_" + str(eta_count)
 
-        from eop_plotting.variables import calc_EOP
         hist_filler.book_tprofile_fill(histogram_name,
                                                   calc_trkP,\
                                                   calc_EOP,\
@@ -93,38 +92,14 @@ def create_eop_histograms(hist_filler, base_selection, eta_ranges,p_bins_for_eta
                                                   xlabel ="P[GeV]",\
                                                   ylabel = "E/p",\
                                                   )
-        from variables import cone_strings, total_energy_annulus_template
-        from math import pi
-        def annulus_area(low,high):
-            return pi * ((high ** 2) - (low ** 2))
+        from variables import cone_strings, get_annulus_calculation, get_annulus_energy_calculation
+        from variables import calc_AnnulusEnergyDensityMatrix, calc_AnnulusEOPMatrix, calc_AnnulusEOPDensityMatrix
         for (low, high) in zip(cone_strings[:-1], cone_strings[1:]):
-            #this function calculates the energy in a cone from low to high
-            func_e = lambda x, y = low, z = high : total_energy_annulus_template(x,y,z)
-            func_e.__name__ = "energy_in_cone_{}_{}".format(low, high)
-            #this function calculates the energy in a cone from low to high
-            func_e_area = lambda x, y = low, z = high, l=low, h=high : total_energy_annulus_template(x,y,z)/(annulus_area(float(l)/1000.0, float(h)/1000.0))
-            func_e_area.__name__ = "energy_in_cone_area_{}_{}".format(low, high)
-            #this function calculates the eop in a cone from low to high
-            func_eop = lambda x, y = low, z = high : total_energy_annulus_template(x,y,z)/x["trk_p"]
-            func_eop.__name__ = "eop_in_cone_{}_{}".format(low, high)
-            #this function calculates the eop in a cone from low to high
-            func_eop_area = lambda x, y = low, z = high, l=low, h=high : (total_energy_annulus_template(x,y,z)/x["trk_p"])/(annulus_area(float(l)/1000.0, float(h)/1000.0))
-            func_eop_area.__name__ = "eop_in_cone_area_{}_{}".format(low, high)
-
-            #define the calculation and the branches that we need for this
-            branches = ["trk_ClusterEnergy_EM_{}".format(low), "trk_ClusterEnergy_HAD_{}".format(low)]
-            branches += ["trk_ClusterEnergy_EM_{}".format(high), "trk_ClusterEnergy_HAD_{}".format(high)]
-            clean_branches = []
-            for b in branches:
-                if "000" not in b:
-                    clean_branches.append(b)
-            branches = clean_branches
-            from calculation import Calculation
-            calc_cone_e = Calculation(func_e, branches)
-            calc_cone_e_area = Calculation(func_e_area, branches)
-            branches = branches + ["trk_p"]
-            calc_cone_eop = Calculation(func_eop, branches)
-            calc_cone_eop_area = Calculation(func_eop_area, branches)
+            #the energy, energy per area, eop and eop per area in the annulus from low to high. These are columns of matrices that are calculated for all annuli at once
+            calc_cone_e = get_annulus_energy_calculation(low, high)
+            calc_cone_e_area = get_annulus_calculation(calc_AnnulusEnergyDensityMatrix, low, high)
+            calc_cone_eop = get_annulus_calculation(calc_AnnulusEOPMatrix, low, high)
+            calc_cone_eop_area = get_annulus_calculation(calc_AnnulusEOPDensityMatrix, low, high)
 
             #book the histograms
             low_descr = float(low)/10.0
@@ -305,14 +280,6 @@ def create_eop_histograms(hist_filler, base_selection, eta_ranges,p_bins_for_eta
             p_bin_selection = create_selection_function(PBin, ["trk_p"], p_range[0], p_range[1])
             selections = base_selection + [eta_bin_selection] + [p_bin_selection]
 
-            histogram_name = "EOPDistribution" + "_" + description + "_Eta_" + str(eta_count) + "_Momentum_" + str(p_count)
-            EOPDist  =  hist_filler.book_histogram_fill(histogram_name,
-                                                      calc_EOP,\
-                                                      selections = selections,\
-                                                      bins = eop_bins,\
-                                                      xlabel ="E/p",\
-                                                      )
-
             if do_calib_hit_plots:
               from eop_plotting.variables import calc_CalibHitFrac, calc_PhotonCalibHitFrac, calc_HadronCalibHitFrac, sel_HasCalibHit
               from eop_plotting.variables import calc_EMCalibHitFrac, calc_PhotonEMCalibHitFrac, calc_HadronEMCalibHitFrac, sel_HasEMCalibHit
@@ -487,3 +454,19 @@ def create_eop_histograms(hist_filler, base_selection, eta_ranges,p_bins_for_eta
                                           range_high = 9.5,\
                                           xlabel=xlabel,\
                                           ylabel="Number of Tracks")
+
+    #the E/p distributions of every momentum bin of every eta range are filled in a single pass over the tracks
+    histogram_names = []
+    for eta_count, p_bins in enumerate(p_bins_for_eta_range):
+        histogram_names.append(["EOPDistribution" + "_" + description + "_Eta_" + str(eta_count) + "_Momentum_" + str(p_count) for p_count in range(0, len(p_bins) - 1)])
+    hist_filler.book_split_histogram_fill("EOPDistribution" + "_" + description,\
+                                          calc_EOP,\
+                                          calc_trkEtaECAL_ABS,\
+                                          calc_trkP,\
+                                          eta_ranges,\
+                                          p_bins_for_eta_range,\
+                                          histogram_names,\
+                                          selections = base_selection,\
+                                          bins = eop_bins,\
+                                          xlabel ="E/p",\
+                                          )
@@ -0,0 +1,215 @@
+import numpy as np
+import imp
+from accumulators import HistogramAccumulator, SplitHistogramAccumulator
+
+try:
+    imp.find_module('root_numpy')
+    foundRootNumpy=True
+except ImportError:
+    foundRootNumpy=False
+    print("Didn't find root_numpy module. Histograms can't be filled. Continuing")
+
+if foundRootNumpy:
+    from root_numpy import fill_hist, fill_profile
+
+class HistogramBooking:
+    '''
+    A histogram booked with the HistogramFiller.
+    histogram_type is one of "TH1D", "TH2D" or "TProfile". variables is a list of the calculations filled along each axis, and selections is the list of selections that a track must pass to be filled. options are the arguments used to create the histograms.
+    histogram_type can also be "TH1DSplit", for a TH1D in every momentum bin of every eta range, filled together into a SplitHistogramAccumulator. The variables are then the variable to histogram, the absolute eta and the momentum,
+    and the options also have the eta_ranges, the p_bins_for_eta_range and the histogram_names, a list for each eta range of the names of the histograms in each momentum bin.
+    '''
+    def __init__(self, histogram_name, histogram_type, variables, selections = [], use_weights = True, **options):
+        self.name = histogram_name
+        self.histogram_type = histogram_type
+        self.variables = variables
+        self.selections = selections
+        self.use_weights = use_weights
+        self.options = options
+
+    @property
+    def selection_key(self):
+        '''the set of selection names for this histogram. Histograms with the same key share a mask'''
+        return tuple(sorted(set([selection.name for selection in self.selections])))
+
+    def get_output_bookings(self):
+        '''get the bookings of the histograms that are written for this booking. A TH1DSplit booking writes a TH1D for each momentum bin of each eta range'''
+        if self.histogram_type != "TH1DSplit":
+            return [self]
+        output_bookings = []
+        for histogram_names in self.options["histogram_names"]:
+            for histogram_name in histogram_names:
+                output_bookings.append(HistogramBooking(histogram_name, "TH1D", self.variables[:1], selections = self.selections, use_weights = self.use_weights, bins = self.options["bins"], range_low = self.options["range_low"], range_high = self.options["range_high"], xlabel = self.options["xlabel"], ylabel = self.options["ylabel"]))
+        return output_bookings
+
+    def fill(self, histogram, values, weights, bins = None):
+        '''
+        fill histogram, either a HistogramAccumulator or a ROOT histogram, with the list of arrays values, one per variable, weighted by weights.
+        bins is an optional list of the bins of the values along each axis of a HistogramAccumulator.
+        '''
+        if isinstance(histogram, (HistogramAccumulator, SplitHistogramAccumulator)):
+            #only the 1D histograms can be filled without weights
+            histogram.fill(values, weights if (self.use_weights or self.histogram_type != "TH1D") else None, bins = bins)
+        elif self.histogram_type == "TH1DSplit":
+            raise ValueError("A TH1DSplit histogram can only be filled into a SplitHistogramAccumulator")
+        elif self.histogram_type == "TH1D":
+            if self.use_weights:
+                fill_hist(histogram, values[0], weights)
+            else:
+                fill_hist(histogram, values[0])
+        elif self.histogram_type == "TH2D":
+            fill_hist(histogram, np.column_stack(values), weights)
+        elif self.histogram_type == "TProfile":
+            fill_profile(histogram, np.column_stack(values), weights)
+        else:
+            raise ValueError("Don't know how to fill a histogram of type {}".format(self.histogram_type))
+
+class SelectionCache:
+    '''
+    A cache of the combined masks of sets of selections for one block of data, keyed by the frozenset of the selection names.
+    Each combination is built starting from the largest combination already in the cache that is a subset of it. Only the combinations that are kept for reuse are stored, bit-packed with np.packbits, or as an array of the selected indices if that is smaller.
+    '''
+    def __init__(self, selection_dict, entries):
+        self.selection_dict = selection_dict
+        self.entries = entries
+        self.cache = {}
+
+    def store(self, key, mask):
+        indices = np.flatnonzero(mask)
+        if len(indices) * 32 < self.entries:
+            self.cache[key] = ("indices", indices.astype(np.int32))
+        else:
+            self.cache[key] = ("packed", np.packbits(mask))
+
+    def load(self, key):
+        storage, values = self.cache[key]
+        if storage == "indices":
+            mask = np.zeros(self.entries, dtype=bool)
+            mask[values] = True
+            return mask
+        return np.unpackbits(values, count = self.entries).view(bool)
+
+    def get_mask(self, selection_names, keep = False):
+        '''get the boolean mask of the entries that pass all of the selections in selection_names. If keep is set, the mask is stored, so that it can be reused by the combinations that contain it'''
+        key = frozenset(selection_names)
+        if key in self.cache:
+            return self.load(key)
+
+        #start from the biggest combination already calculated
+        start_key = frozenset()
+        for cached_key in self.cache:
+            if len(cached_key) > len(start_key) and cached_key < key:
+                start_key = cached_key
+        if len(start_key) > 0:
+            mask = self.load(start_key)
+        else:
+            mask = np.ones(self.entries, dtype=bool)
+        for name in key - start_key:
+            mask &= self.selection_dict[name]
+
+        if keep:
+            self.store(key, mask)
+        return mask
+
+class BinIndexCache:
+    '''
+    The bin of every entry in a block of data for a variable and an axis, keyed by the variable name and the key of the axis.
+    Histograms that fill the same variable with the same binning, like the momentum axis of the profiles in create_eop_histograms, share the bins and only mask them with their own selections.
+    '''
+    def __init__(self, variable_dict):
+        self.variable_dict = variable_dict
+        self.cache = {}
+
+    def get_bins(self, variable_name, axis):
+        key = (variable_name, axis.key)
+        if key not in self.cache:
+            self.cache[key] = axis.find_bins(self.variable_dict[variable_name]).astype(np.int32)
+        return self.cache[key]
+
+class FillPlan:
+    '''
+    All of the booked histograms compiled into a single plan. The histograms are grouped by their set of selections, so that when a block of data is filled, the mask for each group is built once and each variable is masked once per group.
+    '''
+    def __init__(self, bookings):
+        self.groups = {}
+        for booking in bookings:
+            key = booking.selection_key
+            if key not in self.groups:
+                self.groups[key] = []
+            self.groups[key].append(booking)
+
+        #the combinations of selections that several groups have in common, such as the base selection of the eta bins in create_eop_histograms. These are calculated first and kept, so that each group only has to add its own selections. The masks of the other groups are only used once, and aren't kept
+        keys = [frozenset(key) for key in self.groups]
+        shared = set()
+        for i in range(0, len(keys)):
+            for j in range(i + 1, len(keys)):
+                common = keys[i] & keys[j]
+                if len(common) > 1:
+                    shared.add(common)
+        self.shared_combinations = sorted(shared, key = lambda combination: (len(combination), sorted(combination)))
+        print("Compiled {} histograms into {} selection groups".format(len(bookings), len(self.groups)))
+
+    def fill(self, data, histograms):
+        '''
+        data is a dictionary of channel to filename to (variable_dict, selection_dict, weights) as returned by HistogramFiller.get_data
+        histograms is a dictionary of histogram name to channel to HistogramAccumulator or ROOT histogram
+        '''
+        for channel in data:
+            for filename in data[channel]:
+                variable_dict, selection_dict, weights = data[channel][filename]
+                self.fill_block(channel, variable_dict, selection_dict, weights, histograms)
+
+    def fill_block(self, channel, variable_dict, selection_dict, weights, histograms):
+        '''fill every histogram in the plan for one block of data in channel'''
+        selection_cache = SelectionCache(selection_dict, len(weights))
+        bin_cache = BinIndexCache(variable_dict)
+        for combination in self.shared_combinations:
+            selection_cache.get_mask(combination, keep = True)
+
+        #variables that are calculated when they are first used, like the lazy branches of GetData, are calculated together for all of the groups that have entries passing their selections. The variables of the other groups are never calculated
+        if hasattr(variable_dict, "read"):
+            names = []
+            for selection_names in self.groups:
+                if len(selection_names) > 0 and not np.any(selection_cache.get_mask(selection_names)):
+                    continue
+                for booking in self.groups[selection_names]:
+                    for variable in booking.variables:
+                        if variable.name not in names:
+                            names.append(variable.name)
+            variable_dict.read(names)
+
+        for selection_names in self.groups:
+            mask = None
+            if len(selection_names) > 0:
+                mask = selection_cache.get_mask(selection_names)
+
+            if mask is None:
+                masked_weights = weights
+            else:
+                if not np.any(mask):
+                    continue
+                masked_weights = weights[mask]
+
+            masked_variables = {}
+            masked_bins = {}
+            for booking in self.groups[selection_names]:
+                values = []
+                for variable in booking.variables:
+                    if variable.name not in masked_variables:
+                        if mask is None:
+                            masked_variables[variable.name] = variable_dict[variable.name]
+                        else:
+                            masked_variables[variable.name] = variable_dict[variable.name][mask]
+                    values.append(masked_variables[variable.name])
+
+                histogram = histograms[booking.name][channel]
+                bins = None
+                if isinstance(histogram, (HistogramAccumulator, SplitHistogramAccumulator)):
+                    bins = []
+                    for variable, axis in zip(booking.variables, histogram.axes):
+                        key = (variable.name, axis.key)
+                        if key not in masked_bins:
+                            block_bins = bin_cache.get_bins(variable.name, axis)
+                            masked_bins[key] = block_bins if mask is None else block_bins[mask]
+                        bins.append(masked_bins[key])
+                booking.fill(histogram, values, masked_weights, bins = bins)
@@ -0,0 +1,83 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+def get_histogram_arrays(histogram):
+    '''get the binning, contents and errors of every bin of a TH1, including the underflow and overflow bins'''
+    n_bins = histogram.GetNbinsX()
+    axis = histogram.GetXaxis()
+    edges = np.array([axis.GetBinLowEdge(i) for i in range(1, n_bins + 2)])
+    contents = np.array([histogram.GetBinContent(i) for i in range(0, n_bins + 2)])
+    errors = np.array([histogram.GetBinError(i) for i in range(0, n_bins + 2)])
+    return edges, contents, errors
+
+class FitCache:
+    '''
+    A local store of the results of the fits to the E/p distributions, so that a fit is only done again when its input changes.
+    The key of a fit is a hash of the bin edges, contents and errors of the fitted histogram, the name of the model and a dictionary of the options that choose the fit range.
+    Each result is a json file of the values returned by the fit, e.g. the MPV, its error and the fitted parameters. ROOT objects made by the fit can be saved next to it in a root file, under their own names.
+    The cache doesn't know about changes to the fitting code, so it should be cleared when the fits change.
+    '''
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        if not os.path.exists(cache_directory):
+            try:
+                os.makedirs(cache_directory)
+            except OSError:
+                if not os.path.isdir(cache_directory): raise
+
+    def get_key(self, histogram, model, options = {}):
+        '''get the key of a fit of model to histogram, with the options that choose the fit range'''
+        sha = hashlib.sha1()
+        for array in get_histogram_arrays(histogram):
+            sha.update(np.ascontiguousarray(array, dtype = np.float64).tobytes())
+        sha.update(json.dumps([model, options], sort_keys = True).encode("utf-8"))
+        return sha.hexdigest()
+
+    def get_result_file(self, key):
+        return os.path.join(self.cache_directory, key + ".json")
+
+    def get_object_file(self, key):
+        return os.path.join(self.cache_directory, key + ".root")
+
+    def load(self, key):
+        '''return the result saved for key, or None if the fit isn't in the cache'''
+        result_file = self.get_result_file(key)
+        if not os.path.exists(result_file):
+            return None
+        with open(result_file, "r") as f:
+            return json.load(f)
+
+    def load_objects(self, key, names):
+        '''return the list of the ROOT objects with names saved for key'''
+        import ROOT
+        objects = []
+        object_file = ROOT.TFile(self.get_object_file(key), "READ")
+        for name in names:
+            objects.append(object_file.Get(name).Clone(name))
+            if hasattr(objects[-1], "SetDirectory"):
+                objects[-1].SetDirectory(0)
+        object_file.Close()
+        return objects
+
+    def save(self, key, result, objects = []):
+        '''
+        save the dictionary result for key, together with the list of ROOT objects objects.
+        The files are written to a temporary name first, so that fits running at the same time never see a partially written result. The result is written last, so that a result is only found once its objects are there
+        '''
+        if len(objects) > 0:
+            import ROOT
+            object_file = self.get_object_file(key)
+            temporary_file = object_file + ".{}.tmp.root".format(os.getpid())
+            f = ROOT.TFile(temporary_file, "RECREATE")
+            for root_object in objects:
+                root_object.Write(root_object.GetName())
+            f.Close()
+            os.rename(temporary_file, object_file)
+
+        result_file = self.get_result_file(key)
+        temporary_file = result_file + ".{}.tmp".format(os.getpid())
+        with open(temporary_file, "w") as f:
+            json.dump(result, f, indent = 1, sort_keys = True)
+        os.rename(temporary_file, result_file)
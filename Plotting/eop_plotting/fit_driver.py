@@ -0,0 +1,71 @@
+#Fit the E/p distribution of each (eta, p) bin and channel as an independent task, on a pool of processes
+import multiprocessing
+from fit_cache import FitCache
+
+def get_histogram(root_file, histogram_name, channel):
+    '''read the histogram for a channel from a file written by the filling scripts, in the same way as HistogramManager.getHistograms'''
+    import ROOT
+    tFile = ROOT.TFile(root_file, "READ")
+    histogram = tFile.Get(channel + "/" + histogram_name + channel)
+    histogram.SetDirectory(0)
+    tFile.Close()
+    return histogram
+
+def run_fit_tasks(function, tasks, n_workers = None):
+    '''
+    Call function on each task in tasks, and return the results in the order of the tasks. The tasks are run on a pool of n_workers processes, defaulting to the number of cores.
+    The workers are started as new processes instead of forked from this one, so that each one has its own ROOT and RooFit state. function has to be importable from a module, and the tasks and results have to be picklable.
+    If n_workers is 1, the tasks are run one after another in this process.
+    '''
+    if n_workers == None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = min(n_workers, len(tasks))
+    if n_workers <= 1:
+        return [function(task) for task in tasks]
+
+    print("Running {} fits on {} workers".format(len(tasks), n_workers))
+    pool = multiprocessing.get_context("spawn").Pool(n_workers)
+    try:
+        results = pool.map(function, tasks, chunksize = 1)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return results
+
+def balance_fit_task(arguments):
+    '''
+    Fit a histogram with a JES_BalanceFitter, and draw the fit to an eps file named after the histogram.
+    Return a dictionary with the mean and its error, the name of the eps file, and the fitted histogram, the histogram used for the fit and the fitted gaussian.
+    If fit_cache_directory is set, the result is taken from the FitCache there when the histogram has been fit before, and the fit isn't drawn again.
+    '''
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    root_file, histogram_name, channel, nsigma, fit_cache_directory = arguments
+    to_fit = get_histogram(root_file, histogram_name, channel)
+    object_names = [to_fit.GetName() + "_Fitted", to_fit.GetName() + "_FitGaussian"]
+    if fit_cache_directory != None:
+        fit_cache = FitCache(fit_cache_directory)
+        key = fit_cache.get_key(to_fit, "JES_BalanceFitter", {"nsigma" : nsigma})
+        result = fit_cache.load(key)
+        if result != None:
+            print("Found the fit of {} for channel {} in the fit cache".format(histogram_name, channel))
+            result["histogram"] = to_fit
+            result["fitted_histogram"], result["fit_function"] = fit_cache.load_objects(key, object_names)
+            return result
+
+    fitter = ROOT.JES_BalanceFitter(nsigma)
+    canvas = ROOT.TCanvas(histogram_name, histogram_name)
+    fitter.FitAndDraw(to_fit, 0.0)
+    canvas.Print("{}.eps".format(to_fit.GetName()))
+    result = {}
+    result["mean"] = fitter.GetMean()
+    result["mean_error"] = fitter.GetMeanError()
+    result["fit_canvas"] = "{}.eps".format(to_fit.GetName())
+    canvas.Close()
+    if fit_cache_directory != None:
+        fit_cache.save(key, result, [fitter.m_fitHisto.Clone(object_names[0]), fitter.m_fit.Clone(object_names[1])])
+    result["histogram"] = to_fit
+    result["fitted_histogram"] = fitter.m_fitHisto.Clone(object_names[0])
+    result["fit_function"] = fitter.m_fit.Clone(object_names[1])
+    return result
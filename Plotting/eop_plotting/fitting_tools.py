@@ -4,7 +4,10 @@ import uproot as ur
 from histogram_manager import HistogramManager
 from plotting_tools import DrawDataVsMC, ProjectProfiles, SubtractHistograms
 import numpy as np
+import math
 from plotting_tools import DrawText
+from fit_driver import run_fit_tasks, get_histogram
+from fit_cache import FitCache, get_histogram_arrays
 ROOT.gROOT.SetBatch(True)
 
 ROOT.gSystem.Load("~/RooFitExtensions/build/libRooFitExtensions.dylib")
@@ -102,49 +105,310 @@ def generate_landau_plus_gaus(x):
     pdf = ROOT.RooAddPdf("landau+gauss", "landau+gauss", gaus, landau, coeff)
     return pdf,vars_one + vars_two + [coeff]
 
-def montecarlo_uncertainties(model, variables, x_var, minimum, maximum):
+#numpy versions of the models from the generate functions above. Each one takes the E/p grid and a dictionary of parameter name to the values of every sample, as a column of
+#shape (samples, 1), and returns the unnormalized pdf of every sample on the grid. low and high are the range of E/p that the pdfs are normalized in
+def gaus_shape(x, mean, sigma):
+    return np.exp(-0.5 * ((x - mean) / sigma) ** 2)
+
+def gaus_integral(low, high, mean, sigma):
+    erf = np.vectorize(math.erf)
+    return sigma * math.sqrt(math.pi / 2.0) * (erf((high - mean) / (math.sqrt(2.0) * sigma)) - erf((low - mean) / (math.sqrt(2.0) * sigma)))
+
+def evaluate_gaus(x, parameters, low, high):
+    return gaus_shape(x, parameters["eop_gaus_mean"], parameters["eop_gaus_sigma"])
+
+def evaluate_two_gaus(x, parameters, low, high):
+    #the two gaussians are added with their normalized pdfs, like in a RooAddPdf
+    pdf = 0.0
+    for extra_str, coefficient in [("one", parameters["frac"]), ("two", 1.0 - parameters["frac"])]:
+        mean = parameters["eop_gaus_mean" + extra_str]
+        sigma = parameters["eop_gaus_sigma" + extra_str]
+        pdf = pdf + coefficient * gaus_shape(x, mean, sigma) / gaus_integral(low, high, mean, sigma)
+    return pdf
+
+def evaluate_dcb(x, parameters, low, high):
+    #the gaussian core with a power law tail on each side, like RooTwoSidedCBShape
+    t = (x - parameters["eop_gaus_mean"]) / parameters["eop_gaus_sigma"]
+    pdf = np.exp(-0.5 * t ** 2)
+    for side, alpha, n in [(-1.0, parameters["eop_gaus_alphaLo"], parameters["eop_gaus_nLo"]), (1.0, parameters["eop_gaus_alphaHi"], parameters["eop_gaus_nHi"])]:
+        alpha = np.abs(alpha) * np.ones_like(t)
+        n = n * np.ones_like(t)
+        in_tail = side * t > alpha
+        #the tail in the form of RooTwoSidedCBShape, exp(-alpha^2 / 2) / (alpha / n * (n / alpha - alpha + side * t))^n. The base is at least 1 in the tail, so it doesn't overflow for small alpha and large n, and is flat for alpha = 0
+        with np.errstate(divide = "ignore", invalid = "ignore", over = "ignore"):
+            base = 1.0 + alpha[in_tail] / n[in_tail] * (side * t[in_tail] - alpha[in_tail])
+            pdf[in_tail] = np.exp(-0.5 * alpha[in_tail] ** 2) / base ** n[in_tail]
+    return pdf
+
+model_shapes = {"gaus" : evaluate_gaus, "two_gaus" : evaluate_two_gaus, "dcb" : evaluate_dcb}
+
+def sample_parameters(variables, fit_result, n_samples):
+    '''
+    get an array of shape (n_samples, number of variables) of random values of the variables. The floating parameters of fit_result are sampled from a multivariate gaussian with the covariance matrix of the fit,
+    and the variables that weren't floating in the fit keep their values. Without a fit result, each variable is sampled independently with its error. The values are limited to the range of each variable, like RooRealVar::setVal
+    '''
+    values = np.array([var.getVal() for var in variables])
+    samples = np.tile(values, (n_samples, 1))
+    floating = []
+    covariance = None
+    #a covariance quality of 0 means that the covariance matrix wasn't calculated
+    if fit_result != None and fit_result.covQual() >= 1:
+        floating_parameters = fit_result.floatParsFinal()
+        floating_names = [floating_parameters.at(i).GetName() for i in range(0, floating_parameters.getSize())]
+        fit_covariance = fit_result.covarianceMatrix()
+        floating = [(i, floating_names.index(var.GetName())) for i, var in enumerate(variables) if var.GetName() in floating_names]
+        covariance = np.array([[fit_covariance[a][b] for i, b in floating] for j, a in floating])
+    if covariance is None:
+        floating = [(i, i) for i, var in enumerate(variables) if var.getError() > 0.0]
+        covariance = np.diag([variables[i].getError() ** 2 for i, j in floating])
+    if len(floating) > 0:
+        columns = [i for i, j in floating]
+        samples[:, columns] = np.random.multivariate_normal(values[columns], covariance, size = n_samples)
+    return np.clip(samples, [var.getMin() for var in variables], [var.getMax() for var in variables])
+
+def find_grid_maxima(pdf, grid, refine = True):
+    '''
+    get the position of the maximum of each row of pdf, evaluated on grid. If refine is set, the maximum is moved to the peak of the parabola through the highest grid point and its neighbours.
+    The maximum of a row with any value that isn't a number is nan, instead of the first nan on the grid
+    '''
+    rows = np.arange(pdf.shape[0])
+    valid = np.logical_not(np.any(np.isnan(pdf), axis = 1))
+    max_bins = np.argmax(pdf, axis = 1)
+    maxima = grid[max_bins]
+    maxima[np.logical_not(valid)] = np.nan
+    if refine:
+        inside = valid & (max_bins > 0) & (max_bins < len(grid) - 1)
+        left = pdf[rows[inside], max_bins[inside] - 1]
+        centre = pdf[rows[inside], max_bins[inside]]
+        right = pdf[rows[inside], max_bins[inside] + 1]
+        curvature = left - 2.0 * centre + right
+        step = grid[1] - grid[0]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            shift = np.where(curvature < 0.0, 0.5 * (left - right) / curvature, 0.0)
+        maxima[inside] = maxima[inside] + np.clip(shift, -0.5, 0.5) * step
+    return maxima
+
+def montecarlo_uncertainties(model, variables, x_var, minimum, maximum, fit_result = None, function = None, n_samples = 10000, grid_points = 400, refine = True):
+    '''
+    Estimate the uncertainty on the position of the maximum of model between minimum and maximum, from the spread of the maxima for n_samples random values of the variables drawn with sample_parameters.
+    For the models in model_shapes, the pdfs of all samples are evaluated at once on a grid of grid_points values of E/p, and the maxima are found on that grid, refined between the grid points if refine is set.
+    Other models are evaluated with RooFit one sample at a time.
+    If the model can't be evaluated for any sample, the error of the fitted parameter in peak_parameters is returned instead, and a ValueError is raised for models without one.
+    '''
     print("Using random sampling to estimate uncertainties")
 
-    original_values = []
-    original_errors = []
-    for var in variables:
-        original_values.append(var.getVal())
-        original_errors.append(var.getError())
-    original_values = np.array(original_values)
-    original_errors = np.array(original_errors)
+    original_values = [var.getVal() for var in variables]
 
     f = model.asTF( ROOT.RooArgList(x_var) )
     original_xmax = f.GetMaximumX(minimum + 0.05, maximum - 0.05)
 
-    montecarlo_maxima = []
-    for montecarlo_round in range(0, 10000):
-        if montecarlo_round % 1000 == 0:
-            print("Bootstrap round {}".format(montecarlo_round))
-        random_vals = np.random.normal(size=len(original_values))
-        new_values = original_values + random_vals * original_errors #randomly sample the uncertainties on the parameters
-        #set the values
-        [variables[i].setVal(v) for i,v in enumerate(new_values)]
-        #find the maximum
-        f = model.asTF( ROOT.RooArgList(x_var) )
-        xmax = f.GetMaximumX(minimum + 0.05, maximum - 0.05)
-        montecarlo_maxima.append(xmax)
-
-    montecarlo_maxima = np.array(montecarlo_maxima)
-    print("The mean was {}".format(np.mean(montecarlo_maxima)))
-    print("The original max was {}".format(original_xmax))
-    print("The std dev was {}".format(np.std(montecarlo_maxima)))
+    samples = sample_parameters(variables, fit_result, n_samples)
+    if function in model_shapes:
+        grid = np.linspace(minimum + 0.05, maximum - 0.05, grid_points)
+        montecarlo_maxima = []
+        #the samples are evaluated in blocks, to limit the size of the (samples, grid) arrays
+        for start in range(0, n_samples, 1000):
+            parameters = {}
+            for i, var in enumerate(variables):
+                parameters[var.GetName()] = samples[start:start + 1000, i:i+1]
+            pdf = model_shapes[function](grid, parameters, x_var.getMin(), x_var.getMax())
+            montecarlo_maxima.append(find_grid_maxima(pdf, grid, refine = refine))
+        montecarlo_maxima = np.concatenate(montecarlo_maxima)
+        #samples where the model can't be evaluated, e.g. for a width of 0 at the edge of its range, are dropped
+        evaluated = np.logical_not(np.isnan(montecarlo_maxima))
+        if not np.all(evaluated):
+            print("Dropping {} of {} samples where the model couldn't be evaluated".format(np.sum(np.logical_not(evaluated)), n_samples))
+        montecarlo_maxima = montecarlo_maxima[evaluated]
+    else:
+        montecarlo_maxima = []
+        for montecarlo_round, new_values in enumerate(samples):
+            if montecarlo_round % 1000 == 0:
+                print("Bootstrap round {}".format(montecarlo_round))
+            #set the values
+            [variables[i].setVal(v) for i,v in enumerate(new_values)]
+            #find the maximum
+            f = model.asTF( ROOT.RooArgList(x_var) )
+            xmax = f.GetMaximumX(minimum + 0.05, maximum - 0.05)
+            montecarlo_maxima.append(xmax)
+        montecarlo_maxima = np.array(montecarlo_maxima)
 
     #reset the variables to their origin values
     [variables[i].setVal(v) for i,v in enumerate(original_values)]
+
+    #without any sample to take the spread from, use the fitted error of the parameter that gives the peak
+    if len(montecarlo_maxima) == 0:
+        if function not in peak_parameters:
+            raise ValueError("The {} model couldn't be evaluated for any of the {} samples of the fit between {} and {}".format(function, n_samples, minimum, maximum))
+        print("The model couldn't be evaluated for any sample. Using the fitted error of {}".format(peak_parameters[function]))
+        return original_xmax, [var.getError() for var in variables if var.GetName() == peak_parameters[function]][0]
+
+    print("The mean was {}".format(np.mean(montecarlo_maxima)))
+    print("The original max was {}".format(original_xmax))
+    print("The std dev was {}".format(np.std(montecarlo_maxima)))
     return original_xmax, np.std(montecarlo_maxima)
 
 
-def do_fit(histograms, function="gaus", extra_str = "", montecarlo_errors = False, p_bin = 0, eta_bin=0,sel_type = ""):
+#the channels that do_fit fits. The histograms of all other channels are skipped
+fitted_channels = ["LowMuData", "PythiaJetJet", "LowMuDataTightIso", "PythiaJetJetTightIso"]
+
+#the range of the gaussian fits for the MIP and 20TRT selections in each eta bin and momentum bin, as the (lower, upper) edges in numbers of RMS from the mean of the histogram.
+#the other bins are fit from one RMS below to one RMS above the mean, or 1.2 RMS above momentum bin 7
+gaus_fit_windows = {
+    "MIP" : {
+        0 : {1 : (-0.9, -0.225), 2 : (-0.85, -0.125), 3 : (-0.9, -0.1), 4 : (-1.05, -0.05), 5 : (-1.1, 0.1), 6 : (-1.15, 0.45), 7 : (-1.1, 0.475)},
+        1 : {1 : (-0.95, -0.15), 2 : (-0.85, -0.05), 3 : (-0.9, 0.05), 4 : (-1.0, 0.15), 5 : (-1.05, 0.275), 6 : (-1.0, 0.65), 7 : (-0.975, 0.7), 8 : (-0.9, 0.8), 9 : (-0.95, 0.85), 10 : (-1.0, 0.9)},
+        2 : {0 : (-1.0, -0.45), 1 : (-1.0, -0.5), 2 : (-0.9, -0.4), 3 : (-0.9, -0.225), 4 : (-0.85, -0.1), 5 : (-0.85, 0.1), 6 : (-1.15, 0.45), 7 : (-0.95, 0.5), 8 : (-0.95, 0.65), 9 : (-1.0, 0.825)},
+        3 : {0 : (-1.25, -0.7), 1 : (-1.05, -0.4), 2 : (-0.9, -0.2), 3 : (-0.875, 0.0), 4 : (-0.925, 0.05), 5 : (-1.05, 0.15), 6 : (-1.0, 0.5), 7 : (-0.8, 0.7), 8 : (-0.9, 0.85), 9 : (-0.95, 1.0)},
+        4 : {0 : (-0.7, 0.7), 1 : (-0.7, 0.7), 2 : (-0.8, 0.6), 3 : (-0.85, 0.72), 4 : (-0.85, 0.75), 5 : (-0.9, 0.7), 6 : (-0.9, 0.7), 7 : (-0.9, 0.7), 8 : (-0.8, 0.7), 9 : (-0.95, 0.8), 10 : (-1.0, 0.9)},
+    },
+    "20TRT" : {
+        0 : {1 : (-0.75, 0.25), 2 : (-0.8, 0.15), 3 : (-0.8, 0.1), 4 : (-0.9, 0.075), 5 : (-0.95, 0.35), 6 : (-1.1, 0.4), 7 : (-1.1, 0.6), 8 : (-1.1, 0.65), 9 : (-1.05, 0.75)},
+        1 : {1 : (-0.9, 0.1), 2 : (-0.75, 0.075), 3 : (-0.775, 0.15), 4 : (-0.85, 0.15), 5 : (-1.0, 0.2), 6 : (-1.0, 0.25), 7 : (-0.975, 0.4), 8 : (-1.025, 0.7), 9 : (-1.0, 0.5), 10 : (-1.0, 0.9)},
+        2 : {0 : (-0.6, -0.15), 1 : (-0.9, -0.3), 2 : (-1.0, 0.1), 3 : (-1.0, -0.1), 4 : (-0.75, 0.05), 5 : (-0.76, 0.2), 6 : (-0.95, 0.25), 7 : (-1.0, 0.35), 8 : (-0.95, 0.4), 9 : (-0.95, 0.4), 10 : (-0.95, 0.6)},
+        3 : {0 : (-0.7, 0.1), 1 : (-0.8, 0.1), 2 : (-0.9, 0.15), 3 : (-0.725, 0.125), 4 : (-0.775, 0.125), 5 : (-0.875, 0.075), 6 : (-0.975, 0.125), 7 : (-1.05, 0.15), 8 : (-1.1, 0.15), 9 : (-1.05, 0.55), 10 : (-1.05, 0.7), 11 : (-1.05, 0.8)},
+        4 : {0 : (-0.8, -0.25), 1 : (-0.8, -0.2), 2 : (-0.8, -0.2), 3 : (-0.8, -0.15), 4 : (-0.75, -0.25), 5 : (-0.85, -0.05), 6 : (-0.9, -0.05), 7 : (-0.9, 0.0), 8 : (-0.9, 0.0), 9 : (-1.05, 0.15), 10 : (-1.05, 0.2), 11 : (-1.1, 0.3), 12 : (-1.15, 0.4), 13 : (-1.15, 0.5), 14 : (-1.2, 0.65)},
+    },
+}
+
+#the bins where the Pythia channels are fit in a different range than the other channels
+pythia_gaus_fit_windows = {
+    "MIP" : {
+        0 : {1 : (-0.95, -0.175)},
+    },
+}
+
+def get_gaus_fit_window(sel_type, channel, eta_bin, p_bin):
+    '''get the (lower, upper) edges of the range of a gaussian fit from gaus_fit_windows, or None if the range isn't set for the selection and bin'''
+    window = None
+    for selection in gaus_fit_windows:
+        if selection not in sel_type:
+            continue
+        windows = gaus_fit_windows[selection]
+        if "Pythia" in channel and p_bin in pythia_gaus_fit_windows.get(selection, {}).get(eta_bin, {}):
+            windows = pythia_gaus_fit_windows[selection]
+        window = windows.get(eta_bin, {}).get(p_bin, window)
+    return window
+
+def find_fit_window(to_fit, channel, function = "gaus", p_bin = 0, eta_bin = 0, sel_type = "", high = 2.0):
+    '''
+    find the range of E/p to fit from the histogram to_fit. Return the estimate of the mpv, and the bins of the lower and upper edges of the range.
+    The bin contents are read once, and the search is done on the numpy arrays of the contents and their cumulative sum.
+    '''
+    edges, contents, errors = get_histogram_arrays(to_fit)
+    centers = np.concatenate(([-np.inf], (edges[:-1] + edges[1:]) / 2.0, [np.inf]))
+    n_bins = to_fit.GetNbinsX()
+
+    #find the 9 bins with the highest average number of entries. The mpv is the bin in the middle
+    averages = np.convolve(contents, np.ones(9), "valid")[1:n_bins - 9] / 9.0
+    mpv_bin = 5 + int(np.argmax(averages))
+    mpv = to_fit.GetBinCenter(mpv_bin)
+
+    cumulative = np.cumsum(contents)
+    low_limit = to_fit.FindBin(0.1)
+    #find the integral for eop's below the mpv
+    integral_left = cumulative[mpv_bin] - cumulative[low_limit - 1]
+    print("integral left {}".format(integral_left))
+
+    #find the 68% quantile below the mpv: the first bin going down from the mpv where the entries between it and the mpv are more than 80% of the integral
+    lower_bin = 0
+    lower_bins = np.arange(mpv_bin - 1, low_limit, -1)
+    if len(lower_bins) > 0:
+        lower_counts = cumulative[mpv_bin - 1] - cumulative[lower_bins - 1]
+        quantile = np.flatnonzero(lower_counts > (1.0 - 0.2) * integral_left)
+        lower_bin = int(lower_bins[quantile[0]]) if len(quantile) > 0 else int(lower_bins[-1])
+    lower_content = contents[lower_bin]
+
+    #find the bin above the mpv that has the same number of entries as the lower bin at the 68% quantile
+    upper_bins = np.arange(mpv_bin + 1, n_bins + 1)
+    upper_bins = upper_bins[centers[upper_bins] <= high]
+    below_lower = np.flatnonzero(contents[upper_bins] <= lower_content)
+    if len(below_lower) > 0:
+        n_above = below_lower[0]
+        max_bin = mpv_bin + 2 + n_above
+    else:
+        n_above = len(upper_bins)
+        max_bin = mpv_bin + 1 + n_above
+    upper_bin = int(upper_bins[n_above - 1]) if n_above > 0 else max_bin
+
+    if function == "gaus":
+        old_min = to_fit.GetMinimum()
+        old_max = to_fit.GetMaximum()
+        to_fit.SetMinimum(0.15)
+        to_fit.SetMaximum(1.1)
+        mean = to_fit.GetMean()
+        sig = to_fit.GetRMS()
+        to_fit.SetMinimum(old_min)
+        to_fit.SetMaximum(old_max)
+
+        window = (-1.0, 1.0)
+        if p_bin > 7:
+            window = (-1.2, 1.2)
+        window = get_gaus_fit_window(sel_type, channel, eta_bin, p_bin) or window
+        lower_bin = to_fit.FindBin(mean + window[0] * sig)
+        upper_bin = to_fit.FindBin(mean + window[1] * sig)
+
+    return mpv, lower_bin, upper_bin
+
+def generate_model(function, eop):
+    '''get the model and the list of its variables for the name of a fit function'''
+    if function == "gaus":
+        return generate_gaus(eop)
+    if function == "two_gaus":
+        return generate_two_gaus(eop)
+    elif function == "landau":
+        return generate_landau(eop)
+    elif function == "dcb":
+        return generate_dcb(eop)
+    elif function == "landauxgaus" or function == "gausxlandau":
+        return generate_landau_gaus(eop)
+    elif function == "landau+gaus" or function == "gaus+landau":
+        return generate_landau_plus_gaus(eop)
+    raise ValueError("Unknown fit function {}".format(function))
+
+def fit_in_range(model, eop, eop_hist, low, high):
+    '''fit model to eop_hist for E/p between low and high, and return the RooFitResult'''
+    eop.setRange("Fit", low, high)
+    print("Fitting in range [{},{}]".format(low, high))
+    print(model)
+    prepare_for_fit()
+    return model.fitTo(eop_hist, ROOT.RooFit.Range("Fit"), ROOT.RooFit.Save(True))
+
+def fit_converged(result):
+    '''check that the minimization converged and that the covariance matrix is usable'''
+    return result.status() == 0 and result.covQual() >= 2
+
+#the parameter that is the most probable value of E/p for each fit function. For the sums of two shapes, the most probable value is the maximum of the pdf
+peak_parameters = {"gaus" : "eop_gaus_mean", "dcb" : "eop_gaus_mean", "landau" : "eop_landau_mean", "landauxgaus" : "eop_landau_mean", "gausxlandau" : "eop_landau_mean"}
+
+def get_fitted_peak(function, model, variables, eop, low, high):
+    '''get the fitted most probable value of E/p of model, fitted in the range low to high'''
+    if function in peak_parameters:
+        return [var.getVal() for var in variables if var.GetName() == peak_parameters[function]][0]
+    return model.asTF(ROOT.RooArgList(eop)).GetMaximumX(low, high)
+
+def get_fit_seed(function, model, variables, eop, low, high):
+    '''
+    get the seed for the fit of the next momentum bin from a converged fit in the range low to high: the fitted most probable value, the range relative to it, and the value of every variable.
+    do_fit fits the next bin in the same range relative to the mpv of that bin
+    '''
+    mean = get_fitted_peak(function, model, variables, eop, low, high)
+    seed = {}
+    seed["mean"] = mean
+    seed["window"] = (low - mean, high - mean)
+    seed["parameters"] = dict((var.GetName(), var.getVal()) for var in variables)
+    return seed
+
+def do_fit(histograms, function="gaus", extra_str = "", montecarlo_errors = False, p_bin = 0, eta_bin=0,sel_type = "", montecarlo_samples = 10000, seeds = None):
+    '''
+    fit the E/p distribution of each channel in histograms, and return the dictionaries of channel to mpv, to mpv error and to RooFitResult.
+    seeds is an optional dictionary of channel to the seed from get_fit_seed for the fit of the previous momentum bin. A channel with a seed is fit starting from the fitted values of the previous bin, in the range of the previous bin relative to its most probable value, moved to the mpv of this histogram from find_fit_window.
+    If that fails, it is fit from the range and starting values found by find_fit_window. The seed of every channel is replaced by the seed from the fit of this bin, so that the bins of an eta bin can be fit one after another
+    '''
     mpvs = {}
     mpv_errs = {}
     fit_results = {}
     for channel in histograms:
-        if channel != "LowMuData" and channel != "PythiaJetJet" and channel != "LowMuDataTightIso" and channel != "PythiaJetJetTightIso":
+        if channel not in fitted_channels:
             continue
         print("Fitting the histogram in channel {}".format(channel))
         to_fit = histograms[channel]
@@ -154,454 +418,55 @@ def do_fit(histograms, function="gaus", extra_str = "", montecarlo_errors = Fals
         high = 2.0
         eop = generate_eop_var(0.0, 2.0)
         eop_hist = ROOT.RooDataHist("eop_var", "eop_var", ROOT.RooArgList(eop), to_fit)
-        mpv = -999
-        mpv_entries = -999
-        mpv_bin = -999
-        sigma_up = -999
-        sigma_down = -999
-
-        #find the 10 bins with the highest average mpv
-        bins = [i for i in range(1, 10)]
-        for bin in range(5,to_fit.GetNbinsX()-5):
-            print("for bin {} looking at bins {}".format(bin, bins))
-            points = [to_fit.GetBinContent(b) for b in bins]
-            average = sum(points)/float(len(points))
-            if average > mpv_entries:
-                mpv_bin = bins[4]
-                mpv_entries = average
-                mpv = to_fit.GetBinCenter(mpv_bin)
-            bins = bins[1:] + [bin + 5]
-
-        low_limit = to_fit.FindBin(0.1)
-        #if to_fit.Integral() > 2000:
-        #find the integral for eop's below the mpv
-        integral_left = to_fit.Integral(low_limit, mpv_bin)
-        print("integral left {}".format(integral_left))
-
-        #find the 68% quantile below the mpv
-        lower_count = 0
-        lower_bin = 0
-        for lower_bin in range(mpv_bin-1, low_limit, -1):
-            lower_count += to_fit.GetBinContent(lower_bin)
-            if lower_count > (1.0 - 0.2) * integral_left:
-                break
-        lower_content = to_fit.GetBinContent(lower_bin)
-
-        #find the bin above the mpv that has the same number of entries as the lower bin at the 68% quantile
-        up_bin = 0
-        max_bin = mpv_bin +1
-        for upper_bin in range(mpv_bin +1, to_fit.GetNbinsX()+1):
-             if to_fit.GetBinCenter(upper_bin) > high:
-                 continue
-             max_bin += 1
-             print("{} {}".format(upper_bin, max_bin))
-             if to_fit.GetBinContent(upper_bin) <=  lower_content:
-                 break
-             up_bin = upper_bin
-             upper_bin -= 5
-        upper_bin = up_bin
-        if upper_bin == 0:
-            upper_bin = max_bin
-
-        if function == "gaus":
-            old_min = to_fit.GetMinimum()
-            old_max = to_fit.GetMaximum()
-            to_fit.SetMinimum(0.15)
-            to_fit.SetMaximum(1.1)
-            mean = to_fit.GetMean()
-            sig = to_fit.GetRMS()
-            to_fit.SetMinimum(old_min)
-            to_fit.SetMaximum(old_max)
-            upper_bin = to_fit.FindBin(mean + sig)
-            lower_bin = to_fit.FindBin(mean-sig)
-
-            if p_bin > 7:
-                upper_bin = to_fit.FindBin(mean + 1.2*sig)
-                lower_bin = to_fit.FindBin(mean - 1.2*sig)
-            #if p_bin > 6:
-            #    to_fit.Rebin(2)
-            #if p_bin > 10:
-            #to_fit.Rebin(4)
-
-            #hack in the fits:
-            if "MIP" in sel_type:
-               if eta_bin == 0:
-                   if p_bin == 1:
-                      if "Pythia" not in channel:
-                          upper_bin = to_fit.FindBin(mean + (-0.225) *sig)
-                          lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                      else:
-                          upper_bin = to_fit.FindBin(mean + (-0.175) *sig)
-                          lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean - 0.125 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + (-0.1) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + (-0.05) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.1 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.1 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.45 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.15 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.475 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.1 *sig)
-
-               if eta_bin == 1:
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (-0.15) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean - 0.05 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + 0.05 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.90 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.275 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.65 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.975 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.8 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.85 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + 0.9 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-
-               if eta_bin == 2:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (-0.45) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (-0.5) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean - 0.4 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean - 0.225 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean - 0.1 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.1 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.45 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.15 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.5 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.65 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.825 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-
-               if eta_bin == 3:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (-0.7) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.25 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (-0.4) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean - 0.2 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean - 0.0 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.875 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.05 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.925 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.5 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.85 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 1.0 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-
-               if eta_bin == 4:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (0.7) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.7 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (0.7) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.7 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + 0.6 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + 0.72 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.75 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 * sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.8 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + 0.9 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-
-            if "20TRT" in sel_type:
-               if eta_bin == 0:
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (0.25) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.75 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + 0.1 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.075 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.35 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.4 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.10 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.60 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.1 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.65 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.1 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.75 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-
-               if eta_bin == 1:
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (0.1) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + 0.075 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.75 *sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.775 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.2 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.25 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.4 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.975 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.025 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.5 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + 0.9 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-
-               if eta_bin == 2:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (-0.15) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.6 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (-0.3) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + 0.1 * sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean - 0.1 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.05 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.75 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.2 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.76 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.25 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.35 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.0 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.4 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.4 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + 0.6 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.95 *sig)
-
-               if eta_bin == 3:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (0.1) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.7 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (0.1) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + 0.15 * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.9 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + 0.125 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.725 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + 0.125 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.775 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + 0.075 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.875 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + 0.125 *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.975 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + 0.15 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.10 *sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + 0.55 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + 0.7 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 11:
-                      upper_bin = to_fit.FindBin(mean + 0.8 *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-
-               if eta_bin == 4:
-                   if p_bin == 0:
-                      upper_bin = to_fit.FindBin(mean + (-0.25) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 1:
-                      upper_bin = to_fit.FindBin(mean + (-0.2) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 2:
-                      upper_bin = to_fit.FindBin(mean + (-0.2) * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 * sig)
-                   if p_bin == 3:
-                      upper_bin = to_fit.FindBin(mean + (-0.15) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.8 *sig)
-                   if p_bin == 4:
-                      upper_bin = to_fit.FindBin(mean + (-0.25) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.75 *sig)
-                   if p_bin == 5:
-                      upper_bin = to_fit.FindBin(mean + (-0.05) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.85 *sig)
-                   if p_bin == 6:
-                      upper_bin = to_fit.FindBin(mean + (-0.05) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.90 *sig)
-                   if p_bin == 7:
-                      upper_bin = to_fit.FindBin(mean + (0.0) *sig)
-                      lower_bin = to_fit.FindBin(mean - 0.90 *sig)
-                   if p_bin == 8:
-                      upper_bin = to_fit.FindBin(mean + (0.0) * sig)
-                      lower_bin = to_fit.FindBin(mean - 0.90 * sig)
-                   if p_bin == 9:
-                      upper_bin = to_fit.FindBin(mean + (0.15) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 10:
-                      upper_bin = to_fit.FindBin(mean + (0.2) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.05 *sig)
-                   if p_bin == 11:
-                      upper_bin = to_fit.FindBin(mean + (0.3) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.1 *sig)
-                   if p_bin == 12:
-                      upper_bin = to_fit.FindBin(mean + (0.4) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.15 *sig)
-                   if p_bin == 13:
-                      upper_bin = to_fit.FindBin(mean + (0.5) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.15 *sig)
-                   if p_bin == 14:
-                      upper_bin = to_fit.FindBin(mean + (0.65) *sig)
-                      lower_bin = to_fit.FindBin(mean - 1.2 *sig)
-
-        #do the fit in this range.
-        sigma_up = to_fit.GetBinCenter(upper_bin)
-        sigma_down = to_fit.GetBinCenter(lower_bin)
-        eop.setRange("Fit", sigma_down, sigma_up)
-        print("MPV: {}".format(mpv))
-        print("Fitting in range [{},{}]".format(sigma_down, sigma_up))
-        if function == "gaus":
-            model, variables = generate_gaus(eop)
-        if function == "two_gaus":
-            model, variables = generate_two_gaus(eop)
-        elif function == "landau":
-            model, variables = generate_landau(eop)
-        elif function == "dcb":
-            model, variables = generate_dcb(eop)
-        elif function == "landauxgaus" or function == "gausxlandau":
-            model, variables = generate_landau_gaus(eop)
-        elif function == "landau+gaus" or function == "gaus+landau":
-             model, variables = generate_landau_plus_gaus(eop)
-
-        for var in variables:
-            if "mean" in var.GetName():
-                var.setVal(mpv)
-                break
-
-        print(model)
-        prepare_for_fit()
-        result = model.fitTo(eop_hist, ROOT.RooFit.Range("Fit"), ROOT.RooFit.Save(True))
+        #the estimate of the mpv of this histogram, and the range to fit when there is no fit of the previous momentum bin to start from
+        mpv, lower_bin, upper_bin = find_fit_window(to_fit, channel, function = function, p_bin = p_bin, eta_bin = eta_bin, sel_type = sel_type, high = high)
+
+        #start from the converged fit of the previous momentum bin if there is one, and use the range and starting values from the histogram if that fit fails
+        result = None
+        seed = seeds.get(channel) if seeds != None else None
+        if seed != None:
+            #the range of the previous bin around its most probable value, moved to follow the peak to this bin
+            sigma_down = max(mpv + seed["window"][0], eop.getMin())
+            sigma_up = min(mpv + seed["window"][1], eop.getMax())
+            print("Starting from the fit of the previous momentum bin, with the mpv of this bin at {}".format(mpv))
+            model, variables = generate_model(function, eop)
+            for var in variables:
+                if var.GetName() in seed["parameters"]:
+                    var.setVal(seed["parameters"][var.GetName()])
+            result = fit_in_range(model, eop, eop_hist, sigma_down, sigma_up)
+            if not fit_converged(result):
+                print("The fit starting from the previous momentum bin failed. Fitting again from the default starting values")
+                result = None
+
+        if result == None:
+            #do the fit in this range.
+            sigma_up = to_fit.GetBinCenter(upper_bin)
+            sigma_down = to_fit.GetBinCenter(lower_bin)
+            model, variables = generate_model(function, eop)
+            for var in variables:
+                if "mean" in var.GetName():
+                    var.setVal(mpv)
+                    break
+            print("MPV: {}".format(mpv))
+            result = fit_in_range(model, eop, eop_hist, sigma_down, sigma_up)
         fit_results[channel]=result
 
+        if seeds != None:
+            if fit_converged(result):
+                seeds[channel] = get_fit_seed(function, model, variables, eop, sigma_down, sigma_up)
+            elif channel in seeds:
+                del seeds[channel]
+
         if not montecarlo_errors:
             for var in variables:
                 if "mean" in var.GetName():
                     mpvs[channel]=var.getVal()
                     mpv_errs[channel]=var.getError()
         else:
-            mpvs[channel], mpv_errs[channel]=montecarlo_uncertainties(model, variables,eop, to_fit.GetBinCenter(lower_bin), to_fit.GetBinCenter(upper_bin))
+            try:
+                mpvs[channel], mpv_errs[channel]=montecarlo_uncertainties(model, variables,eop, sigma_down, sigma_up, fit_result = result, function = function, n_samples = montecarlo_samples)
+            except ValueError as error:
+                raise ValueError("{} in channel {}, momentum bin {} and eta bin {}".format(error, channel, p_bin, eta_bin))
 
         #draw the fit
         c = ROOT.TCanvas("canv", "canv")
@@ -681,7 +546,76 @@ def do_fit(histograms, function="gaus", extra_str = "", montecarlo_errors = Fals
 
     return mpvs, mpv_errs, fit_results
 
-def test_fit(f, histogram_base = "EOPDistribution", selection_name = "MIPSelectionHadFracAbove70", function = "gaus", montecarlo_errors = True, sel_type=""):
+#the first momentum bin in each eta bin that isn't fit for the MIP and 20TRT selections. The fits stop there
+last_momentum_bins = {"MIP" : {0 : 10, 1 : 10, 2 : 11, 3 : 12, 4 : 20}, "20TRT" : {0 : 10, 1 : 11, 2 : 12, 3 : 12}}
+
+def get_momentum_bins_to_fit(selection_name, eta_bin, n_p_bins):
+    '''
+    get the momentum bins that are fit in eta_bin, and the bin whose upper edge is the last bin edge of the histograms of the fit results.
+    The first momentum bin is never fit, and for the MIP and 20TRT selections the fits stop at the bin in last_momentum_bins
+    '''
+    stop = n_p_bins
+    for name in last_momentum_bins:
+        if name in selection_name and eta_bin in last_momentum_bins[name]:
+            stop = min(stop, last_momentum_bins[name][eta_bin])
+    last_bin = stop if stop < n_p_bins else n_p_bins - 1
+    return list(range(1, stop)), last_bin
+
+def get_fit_parameters(fit_result):
+    '''get a dictionary of the name of each floating parameter of a RooFitResult to its fitted value and error'''
+    parameters = {}
+    floating_parameters = fit_result.floatParsFinal()
+    for i in range(0, floating_parameters.getSize()):
+        parameter = floating_parameters.at(i)
+        parameters[parameter.GetName()] = (parameter.getVal(), parameter.getError())
+    return parameters
+
+def fit_bin(f, histogram_name, channel, function, extra_str, montecarlo_errors, montecarlo_samples, p_bin, eta_bin, sel_type, fit_cache_directory, seeds = None):
+    '''
+    fit the histogram of a single momentum bin and channel with do_fit, and return the dictionaries of channel to mpv and to mpv error. seeds is passed to do_fit, and is updated with the seed for the next momentum bin.
+    If fit_cache_directory is set, the mpv and its error are taken from the FitCache there when the histogram has been fit before with the same options, and the fit isn't done or drawn again
+    '''
+    histograms = {channel : get_histogram(f, histogram_name, channel)}
+    if fit_cache_directory != None:
+        fit_cache = FitCache(fit_cache_directory)
+        #the fit range depends on the channel, the bin and the selection as well as on the histogram, and on the fit of the previous momentum bin for a warm started fit
+        options = {"channel" : channel, "p_bin" : p_bin, "eta_bin" : eta_bin, "sel_type" : sel_type, "montecarlo_errors" : montecarlo_errors, "montecarlo_samples" : montecarlo_samples}
+        if seeds != None:
+            options["seed"] = seeds.get(channel)
+        key = fit_cache.get_key(histograms[channel], function, options)
+        cached = fit_cache.load(key)
+        if cached != None:
+            print("Found the fit of {} for channel {} in the fit cache".format(histogram_name, channel))
+            if seeds != None:
+                seeds[channel] = cached["seed"]
+                if seeds[channel] == None:
+                    del seeds[channel]
+            return {channel : cached["mpv"]}, {channel : cached["mpv_error"]}
+
+    mpv, mpv_err, fit_result = do_fit(histograms, function = function, extra_str = extra_str, montecarlo_errors = montecarlo_errors, p_bin = p_bin, eta_bin = eta_bin, sel_type = sel_type, montecarlo_samples = montecarlo_samples, seeds = seeds)
+    if fit_cache_directory != None and channel in mpv:
+        result = {"mpv" : float(mpv[channel]), "mpv_error" : float(mpv_err[channel]), "parameters" : get_fit_parameters(fit_result[channel])}
+        if seeds != None:
+            result["seed"] = seeds.get(channel)
+        fit_cache.save(key, result)
+    return mpv, mpv_err
+
+def fit_bin_task(arguments):
+    '''fit a single momentum bin and channel with fit_bin in a worker process. arguments are the arguments of fit_bin'''
+    return fit_bin(*arguments)
+
+def fit_momentum_bins_task(tasks):
+    '''
+    fit the momentum bins of one eta bin and channel in a worker process, in the order of tasks, each fit starting from the converged fit of the previous momentum bin.
+    tasks is a list of the arguments of fit_bin for each momentum bin. Return the list of the mpvs and mpv errors of each bin
+    '''
+    seeds = {}
+    return [fit_bin(*task, seeds = seeds) for task in tasks]
+
+def test_fit(f, histogram_base = "EOPDistribution", selection_name = "MIPSelectionHadFracAbove70", function = "gaus", montecarlo_errors = True, sel_type="", n_workers = None, montecarlo_samples = 10000, fit_cache_directory = None, warm_start = False):
+    '''fit the E/p distribution of every momentum and eta bin, and draw the fit results. The fits are run on n_workers processes, defaulting to the number of cores. montecarlo_samples is the number of random samples of the fit parameters used for the uncertainties when montecarlo_errors is set.
+    If fit_cache_directory is set, the fit results are kept in a FitCache there, and only the histograms that changed since they were last fit are fit again.
+    If warm_start is set, the momentum bins of each eta bin and channel are fit in order of momentum, each starting from the parameters and fit range of the previous bin, and the eta bins and channels are fit in parallel'''
 
     #get the binning vectors
     rf = ROOT.TFile(f, "READ")
@@ -702,42 +636,47 @@ def test_fit(f, histogram_base = "EOPDistribution", selection_name = "MIPSelecti
         p_bins_high_for_eta_bin.append(getattr(bins, selection_name+"PBinsHigh_Eta"+str(i)))
 
     HM = HistogramManager(f)
+
+    #every momentum bin and channel is fit as an independent task
+    tasks = []
+    task_bins = []
+    for i in range(0, len(eta_bins_low)):
+        fit_bins, last_bin = get_momentum_bins_to_fit(selection_name, i, len(p_bins_low_for_eta_bin[i]))
+        for j in fit_bins:
+            histogram_name = histogram_base + "_" + selection_name + "_Eta_" + str(i) + "_Momentum_" + str(j)
+            for channel in HM.channels:
+                if channel not in fitted_channels:
+                    continue
+                tasks.append((f, histogram_name, channel, function, "Eta_{}_P_{}_{}".format(i,j, selection_name), montecarlo_errors, montecarlo_samples, j, i, sel_type, fit_cache_directory))
+                task_bins.append((i, j))
+    if not warm_start:
+        fits = run_fit_tasks(fit_bin_task, tasks, n_workers = n_workers)
+    else:
+        #one task for each eta bin and channel, with the momentum bins in order
+        chains = {}
+        for task, (i, j) in zip(tasks, task_bins):
+            chains.setdefault((i, task[2]), []).append((task, (i, j)))
+        chain_fits = run_fit_tasks(fit_momentum_bins_task, [[task for task, task_bin in chains[chain]] for chain in chains], n_workers = n_workers)
+        task_bins = [task_bin for chain in chains for task, task_bin in chains[chain]]
+        fits = [fit for fits_in_chain in chain_fits for fit in fits_in_chain]
+
+    bin_fits = {}
+    for (i, j), (mpv, mpv_err) in zip(task_bins, fits):
+        if (i, j) not in bin_fits:
+            bin_fits[(i, j)] = ({}, {})
+        bin_fits[(i, j)][0].update(mpv)
+        bin_fits[(i, j)][1].update(mpv_err)
+
     histograms_in_eta_bin = []
     for i, eta_low, eta_high in zip(range(0, len(eta_bins_low)),eta_bins_low, eta_bins_high):
         mpvs = {}
         mpv_errs = {}
         bins = []
         bin_numbers = []
-        for j, p_low, p_high in zip(range(0, len(p_bins_low_for_eta_bin[i])),p_bins_low_for_eta_bin[i], p_bins_high_for_eta_bin[i]):
-            if j==0:
-                continue
-            if "MIP" in selection_name:
-                if i == 0 and j == 10:
-                    break
-                if i == 1 and j == 10:
-                    break
-                if i == 2 and j == 11:
-                    break
-                if i == 3 and j  == 12:
-                    break
-                if i == 4 and j == 20:
-                    break
-            if "20TRT" in selection_name:
-                if i == 0 and j == 10:
-                    break
-                if i == 1 and j == 11:
-                    break
-                if i == 2 and j == 12:
-                    break
-                if i == 3 and j == 12:
-                    break
-                if i == 4 and j == 14:
-                    pass
->>>>>>> Update plotting code
-            histogram_name = histogram_base + "_" + selection_name + "_Eta_" + str(i) + "_Momentum_" + str(j)
-            histograms = HM.getHistograms(histogram_name)
-            to_fit_function = function
-            mpv, mpv_err, fit_result = do_fit(histograms, function = to_fit_function, extra_str = "Eta_{}_P_{}_{}".format(i,j, selection_name), montecarlo_errors = montecarlo_errors, p_bin = j, eta_bin=i, sel_type = sel_type)
+        fit_bins, last_bin = get_momentum_bins_to_fit(selection_name, i, len(p_bins_low_for_eta_bin[i]))
+        for j in fit_bins:
+            p_low = p_bins_low_for_eta_bin[i][j]
+            mpv, mpv_err = bin_fits.get((i, j), ({}, {}))
             for channel in mpv:
                if channel not in mpvs:
                    mpvs[channel]=[]
@@ -746,7 +685,7 @@ def test_fit(f, histogram_base = "EOPDistribution", selection_name = "MIPSelecti
                mpv_errs[channel].append(mpv_err[channel])
             bins.append(p_low)
             bin_numbers.append(j)
-        bins.append(p_high)
+        bins.append(p_bins_high_for_eta_bin[i][last_bin])
 
         hist_name = histogram_base + "{}_{}_".format(function, "fit") + selection_name + "_Eta_" + str(i)
         bin_array = array.array('d', bins)
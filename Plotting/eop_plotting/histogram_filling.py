@@ -1,12 +1,20 @@
 import numpy as np
 from array import array
-from calculation import Calculation
+from calculation import Calculation, BlockEvaluator
+from fill_plan import HistogramBooking, FillPlan
+from accumulators import create_accumulator
+from merging import set_histogram_arrays
+from branch_cache import BranchCache, ColumnData, LazyColumnData
+from tree_readers import RootNumpyReader
+from precision import PrecisionPolicy
 import ROOT
 import imp
 import time
 import os
 import glob
 import imp
+import shutil
+import tempfile
 
 def get_log_bins(minBin, maxBin, nBins):
     '''Get nBins logarithmically-evenly spaced bins ranging from minBin to maxBin'''
@@ -28,6 +36,74 @@ def get_p(Pt, eta):
     '''Given a value of pT and eta, return the momentum'''
     return Pt*np.cosh(eta)
 
+class IndexedColumns:
+    '''
+    A view of the entries indices of a dictionary of numpy arrays. Each array is only indexed when it is first accessed, so that only the arrays that are used are copied, and each of them only once.
+    '''
+    def __init__(self, parent, indices):
+        self.parent = parent
+        self.indices = indices
+        self.indexed = {}
+
+    def __getitem__(self, key):
+        if key not in self.indexed:
+            self.indexed[key] = self.parent[key][self.indices]
+        return self.indexed[key]
+
+    def __contains__(self, key):
+        return key in self.parent
+
+    def __iter__(self):
+        return iter(self.parent)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def keys(self):
+        return self.parent.keys()
+
+    def read(self, keys):
+        '''calculate the keys of the parent at once, if it is a LazyVariables'''
+        if isinstance(self.parent, LazyVariables):
+            self.parent.read(keys)
+
+class LazyVariables:
+    '''
+    A dictionary-like collection of variable name to numpy array, where each variable is only calculated when it is first needed, for the lazy branches of GetData.
+    data is the BlockEvaluator of the block, and column_data the LazyColumnData that it reads from. read(names) reads all of the branches that the variables in names need with one call, and then calculates them.
+    FillPlan reads the variables of every histogram whose selections have entries passing them, so that the branches of the other variables are never read.
+    '''
+    def __init__(self, data, column_data, variables):
+        self.data = data
+        self.column_data = column_data
+        self.variables = {}
+        for variable in variables:
+            self.variables[variable.name] = variable
+        self.values = {}
+
+    def read(self, names):
+        names = [name for name in names if name not in self.values]
+        self.column_data.read(get_needed_branches([self.variables[name] for name in names], []))
+        for name in names:
+            self.values[name] = self.variables[name].eval(self.data)
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            self.read([name])
+        return self.values[name]
+
+    def __contains__(self, name):
+        return name in self.variables
+
+    def __iter__(self):
+        return iter(self.variables)
+
+    def __len__(self):
+        return len(self.variables)
+
+    def keys(self):
+        return self.variables.keys()
+
 def create_selection_function(template, branches, *args):
     '''
     Given a function template, and the branches that are needed to do the calculation in the function, create a calculation class instance and return it.
@@ -75,14 +151,22 @@ class HistogramFiller:
     '''
     Handle the filling of histograms.
     '''
-    def __init__(self, trees, tree_name, weight_calculator, selection_string = "", partitions = None):
+    def __init__(self, trees, tree_name, weight_calculator, selection_string = "", partitions = None, chunk_size = None, cache_directory = None, lazy_branches = False, reader = None, precision = None, book_only = False):
         self.channel_files = {}
         self.tree_name = tree_name
         self.partitions = partitions
+        self.chunk_size = chunk_size #if set, stream over each partition in chunks of this many entries
+        self.branch_cache = BranchCache(cache_directory) if cache_directory != None else None #if set, keep a local copy of the branches read from each partition
+        self.lazy_branches = lazy_branches #if set, only read each branch when a calculation first uses it
+        self.reader = reader if reader != None else RootNumpyReader() #the reader from tree_readers that reads the branches from the trees
+        self.precision = precision if precision != None else PrecisionPolicy() #the PrecisionPolicy that chooses the type each branch is kept in
+        self.used_branch_lists = [] #the lists of the branches that were read from the trees or the cache for each block of data. With lazy branches, these grow until the histograms of the block have been filled
+        self.open_trees = [] #with lazy branches, the (channel, filename) of the trees that have to be closed once their histograms have been filled
+        self.book_only = book_only #if set, DumpHistograms returns the empty histograms without reading any entries, so that the bookings of a filling script can be found without filling them
         self.verbose = False
         self.all_selections = []
         self.all_variables =[]
-        self.histogram_filling_functions = {}
+        self.booked_histograms = {}
         self.selection_string = selection_string
         self.object_counter = 0
         self.weight_calculator = weight_calculator
@@ -120,45 +204,60 @@ class HistogramFiller:
         self.channels.append(subchannel)
         self.channel_files[subchannel] = self.channel_files[channel]
 
-    def get_data(self, channel, filename, variables, selections):
+    def get_partition(self, channel, filename):
+        '''
+        Get the (start, stop) tuple of tree entries to be read for this channel and file
+        '''
+        if self.partitions == None:
+            return (0, self.trees[channel][filename].GetEntries())
+        if self.verbose: print("Found a partition")
+        return self.partitions[channel][filename]
+
+    @property
+    def used_branches(self):
+        '''the branches that were read from the trees or the cache'''
+        used_branches = []
+        for branches in self.used_branch_lists:
+            for branch in branches:
+                if branch not in used_branches:
+                    used_branches.append(branch)
+        return used_branches
+
+    def close_open_trees(self):
+        '''close the files of the trees that were left open for the lazy branches'''
+        for channel, filename in self.open_trees:
+            close_tree_file(self.trees[channel][filename])
+        self.open_trees = []
+
+    def get_data(self, channel, filename, variables, selections, partition = None, close_file = True):
         '''
         Given a string channel, string filename, a list of calculation variables and a list of calculations selections, return a dictionary keys selection_dict, variable_dict and weights. selection_dict is a dictionary of key selection name to numpy array of bool. variable_dict is a dictionary of string variable name to numpy array variable. weights is a numpy array of floats
+        If partition is None, the partition for this channel and file is read. close_file should be False if more entries will be read from the same tree afterwards.
+        With lazy branches, the variables are only calculated when they are filled, so the file is left open and closed by close_open_trees after the histograms have been filled.
         '''
         print("\n"*2)
         print("Getting branches for channel {}".format(channel))
         branches = get_needed_branches(variables, selections)
 
         #get the parition of the ttree to be read
-        partition = None
-        if self.partitions == None:
-            partition = (0, total_entries)
-        else:
-            partition = self.partitions[channel][filename]
-            if self.verbose: print("Found a partition")
+        if partition == None:
+            partition = self.get_partition(channel, filename)
 
         tree = self.trees[channel][filename]
 
         print("Reading entries from {} until {}".format(partition[0], partition[1]))
-        result = GetData(partition = partition, bare_branches = branches, channel = channel, filename = filename, tree = tree, treename = self.tree_name, variables=variables, weight_calculator = self.weight_calculator, selections = selections, selection_string = self.selection_string, verbose = self.verbose)
+        #the selections for the channel are applied while reading, so that the other branches are only read and calculated for the tracks that pass them
+        preselections = self.selections_for_channels[channel] if channel in self.selections_for_channels else []
+        result = GetData(partition = partition, bare_branches = branches, channel = channel, filename = filename, tree = tree, treename = self.tree_name, variables=variables, weight_calculator = self.weight_calculator, selections = selections, selection_string = self.selection_string, verbose = self.verbose, close_file = close_file, cache = self.branch_cache, lazy = self.lazy_branches, preselections = preselections, reader = self.reader, precision = self.precision)
+        self.used_branch_lists.append(result["used_branches"])
+        if self.lazy_branches and close_file:
+            self.open_trees.append((channel, filename))
 
         #Get the selections, variables and weights
         selection_dict = result["selection_dict"]
         variable_dict = result["variable_dict"]
         weights = result["weights"]
 
-        if channel in self.selections_for_channels:
-            print("Applying selections for this channell")
-            selections = self.selections_for_channels[channel]
-            total_selection = np.ones(len(weights)) > 0.5
-            for selection in selections:
-                print("\t Applying {}, with {} events passing".format(selection.name, np.sum(1 * selection_dict[selection.name])))
-                total_selection &= selection_dict[selection.name]
-            weights = weights[total_selection]
-            for key in selection_dict:
-                selection_dict[key] = selection_dict[key][total_selection]
-            for key in variable_dict:
-                variable_dict[key] = variable_dict[key][total_selection]
-
         if self.verbose: print("The following selections have been evaluated ")
         for selection in selection_dict:
             print("Selection {} has {} tracks passing".format(selection, np.sum(1 * selection_dict[selection])))
@@ -168,88 +267,103 @@ class HistogramFiller:
 
         return variable_dict, selection_dict, weights
 
-    def fill_histograms(self, histogram_name, data, variable, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = "", HistogramPerFile=False, useWeights = True):
+    def get_data_chunks(self, channel, filename, variables, selections):
         '''
-        Get the histogram for variable after selections is applied.
+        A generator over the partition for this channel and file, yielding the output of get_data for chunks of self.chunk_size entries.
         '''
-        name_to_fill = variable.name
-        variables = [variable]
-        histogram_dictionary = {}
-        for channel in self.channels:
-            if (type(bins) == list):
-                bins_array = array('d',bins)
-                histogram_dictionary[channel] = ROOT.TH1D(histogram_name + channel, histogram_name + channel, len(bins_array)-1, bins_array)
-            else:
-                histogram_dictionary[channel] = ROOT.TH1D(histogram_name + channel, histogram_name + channel, bins, range_low + 0.0000001, range_high - 0.000001)
-            histogram_dictionary[channel].GetXaxis().SetTitle(xlabel)
-            histogram_dictionary[channel].GetYaxis().SetTitle(ylabel)
-            histogram_dictionary[channel].Sumw2()
+        start, stop = self.get_partition(channel, filename)
+        start = int(start)
+        stop = int(stop)
+        if stop <= start:
+            yield self.get_data(channel, filename, variables, selections, partition = (start, stop))
+            return
+        for chunk_start in range(start, stop, self.chunk_size):
+            chunk_stop = min(chunk_start + self.chunk_size, stop)
+            yield self.get_data(channel, filename, variables, selections, partition = (chunk_start, chunk_stop), close_file = (chunk_stop == stop))
 
+    def create_histograms(self, booking):
+        '''
+        Create an empty histogram for each channel for a booked histogram, and return a dictionary of channel to histogram
+        '''
+        histogram_name = booking.name
+        options = booking.options
+        histogram_dictionary = {}
         for channel in self.channels:
-            for filename in self.channel_files[channel]:
-                variable_dict, selection_dict, weights = data[channel][filename]
-                total_selection = np.ones(len(weights)) > 0.0
-                for selection in selections:
-                    total_selection &= selection_dict[selection.name]
-                to_fill = variable_dict[name_to_fill][total_selection]
-                to_weight = weights[total_selection]
-                if self.verbose: print(len(to_fill))
-                if self.verbose: print(len(to_weight))
-                if self.verbose: print(to_fill)
-                if self.verbose: print(to_weight)
-                if self.verbose: print("Filling Variable " + variable.name)
-                if useWeights:
-                    fill_hist(histogram_dictionary[channel], to_fill, to_weight)
+            if booking.histogram_type == "TH1D":
+                bins = options["bins"]
+                if (type(bins) == list):
+                    bins_array = array('d',bins)
+                    histogram_dictionary[channel] = ROOT.TH1D(histogram_name + channel, histogram_name + channel, len(bins_array)-1, bins_array)
                 else:
-                    fill_hist(histogram_dictionary[channel], to_fill)
-        return histogram_dictionary
+                    histogram_dictionary[channel] = ROOT.TH1D(histogram_name + channel, histogram_name + channel, bins, options["range_low"] + 0.0000001, options["range_high"] - 0.000001)
+                histogram_dictionary[channel].GetXaxis().SetTitle(options["xlabel"])
+                histogram_dictionary[channel].GetYaxis().SetTitle(options["ylabel"])
+
+            elif booking.histogram_type == "TH2D":
+                bins_x = options["bins_x"]
+                bins_y = options["bins_y"]
+                if (type(bins_x) == list and type(bins_y) == list):
+                    bins_array_x = array('d',bins_x)
+                    bins_array_y = array('d',bins_y)
+                    histogram_dictionary[channel] = ROOT.TH2D(histogram_name + channel, histogram_name + channel, len(bins_array_x)-1, bins_array_x, len(bins_array_y)-1, bins_array_y)
+                elif (type(bins_x) != list and type(bins_y) != list):
+                    histogram_dictionary[channel] = ROOT.TH2D(histogram_name + channel, histogram_name + channel, bins_x, options["range_low_x"] + 0.0000001, options["range_high_x"] - 0.000001, bins_y, options["range_low_y"]+0.0000001, options["range_high_y"] + 0.0000001)
+                else:
+                    raise ValueError("both of the bins_x and bins_y variables need to be the same type. Both integers, or both lists")
+                histogram_dictionary[channel].GetXaxis().SetTitle(options["xlabel"])
+                histogram_dictionary[channel].GetYaxis().SetTitle(options["ylabel"])
+                histogram_dictionary[channel].GetZaxis().SetTitle(options["zlabel"])
+                histogram_dictionary[channel].GetZaxis().SetTitleSize(0.035)
+                histogram_dictionary[channel].GetZaxis().SetTitleOffset(1.35)
+
+            elif booking.histogram_type == "TProfile":
+                bins = options["bins"]
+                if (type(bins) == list):
+                    bins_array = array('d',bins)
+                    histogram_dictionary[channel] = ROOT.TProfile(histogram_name + channel, histogram_name + channel, len(bins_array)-1, bins_array)
+                else:
+                    histogram_dictionary[channel] = ROOT.TProfile(histogram_name + channel, histogram_name + channel, bins, options["range_low"] + 0.0000001, options["range_high"] - 0.000001)
+                histogram_dictionary[channel].GetXaxis().SetTitle(options["xlabel"])
+                histogram_dictionary[channel].GetYaxis().SetTitle(options["ylabel"])
 
-    def fill_2d_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel="",):
-        '''the 2-d histgram with variable_x and variable_y drawn'''
-        name_to_fill_x = variable_x.name
-        name_to_fill_y = variable_y.name
-        variables = [variable_x, variable_y]
-        histogram_dictionary = {}
-        for channel in self.channels:
-            if (type(bins_x) == list and type(bins_y) == list):
-                bins_array_x = array('d',bins_x)
-                bins_array_y = array('d',bins_y)
-                histogram_dictionary[channel] = ROOT.TH2D(histogram_name + channel, histogram_name + channel, len(bins_array_x)-1, bins_array_x, len(bins_array_y)-1, bins_array_y)
-            elif (type(bins_x) != list and type(bins_y) != list):
-                histogram_dictionary[channel] = ROOT.TH2D(histogram_name + channel, histogram_name + channel, bins_x, range_low_x + 0.0000001, range_high_x - 0.000001, bins_y, range_low_y+0.0000001, range_high_y + 0.0000001)
             else:
-                raise ValueError("both of the bins_x and bins_y variables need to be the same type. Both integers, or both lists")
-            histogram_dictionary[channel].GetXaxis().SetTitle(xlabel)
-            histogram_dictionary[channel].GetYaxis().SetTitle(ylabel)
-            histogram_dictionary[channel].GetZaxis().SetTitle(zlabel)
-            histogram_dictionary[channel].GetZaxis().SetTitleSize(0.035)
-            histogram_dictionary[channel].GetZaxis().SetTitleOffset(1.35)
+                raise ValueError("Don't know how to create a histogram of type {}".format(booking.histogram_type))
+
             histogram_dictionary[channel].Sumw2()
+        return histogram_dictionary
 
-        for channel in self.channels:
-            for filename in self.channel_files[channel]:
-                variable_dict, selection_dict, weights = data[channel][filename]
-                total_selection = np.ones(len(weights)) > 0.0
-                for selection in selections:
-                    total_selection &= selection_dict[selection.name]
-                to_weight = weights[total_selection]
-                n_sel = len(to_weight)
-                to_fill = np.zeros((n_sel,2))
-                to_fill[:,0] = variable_dict[name_to_fill_x][total_selection]
-                to_fill[:,1] = variable_dict[name_to_fill_y][total_selection]
-                if self.verbose: print(to_fill)
-                if self.verbose: print(to_weight)
-                if self.verbose: print("Filling Variable " + variable.name)
-                fill_hist(histogram_dictionary[channel], to_fill, to_weight)
+    def fill_booking(self, booking, data, histogram_dictionary = None):
+        '''
+        Fill the histograms for a single booked histogram from data. If histogram_dictionary is given, the histograms in it are filled instead of new ones.
+        '''
+        if histogram_dictionary is None:
+            histogram_dictionary = self.create_histograms(booking)
+        FillPlan([booking]).fill(data, {booking.name : histogram_dictionary})
         return histogram_dictionary
 
-    def fill_2d_tprofile_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel="",):
+    def fill_histograms(self, histogram_name, data, variable, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = "", HistogramPerFile=False, useWeights = True, histogram_dictionary = None):
+        '''
+        Get the histogram for variable after selections is applied. If histogram_dictionary is given, the histograms in it are filled instead of new ones.
+        '''
+        booking = HistogramBooking(histogram_name, "TH1D", [variable], selections = selections, use_weights = useWeights, bins = bins, range_low = range_low, range_high = range_high, xlabel = xlabel, ylabel = ylabel)
+        return self.fill_booking(booking, data, histogram_dictionary)
+
+    def fill_2d_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel="", histogram_dictionary = None):
+        '''the 2-d histgram with variable_x and variable_y drawn'''
+        booking = HistogramBooking(histogram_name, "TH2D", [variable_x, variable_y], selections = selections, bins_x = bins_x, range_low_x = range_low_x, range_high_x = range_high_x, xlabel = xlabel, bins_y = bins_y, range_low_y = range_low_y, range_high_y = range_high_y, ylabel = ylabel, zlabel = zlabel)
+        return self.fill_booking(booking, data, histogram_dictionary)
+
+    def fill_2d_tprofile_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel="", histogram_dictionary = None):
         '''the 2-d histgram with variable_x and variable_y drawn'''
         name_to_fill_x = variable_x.name
         name_to_fill_y = variable_y.name
         variables = [variable_x, variable_y]
-        histogram_dictionary = {}
-        for channel in self.channels:
+        if histogram_dictionary is not None:
+            channels_to_create = []
+        else:
+            histogram_dictionary = {}
+            channels_to_create = self.channels
+        for channel in channels_to_create:
             if (type(bins_x) == list and type(bins_y) == list):
                 bins_array_x = array('d',bins_x)
                 bins_array_y = array('d',bins_y)
@@ -265,8 +379,8 @@ class HistogramFiller:
             histogram_dictionary[channel].GetZaxis().SetTitleOffset(1.35)
             histogram_dictionary[channel].Sumw2()
 
-        for channel in self.channels:
-            for filename in self.channel_files[channel]:
+        for channel in data:
+            for filename in data[channel]:
                 variable_dict, selection_dict, weights = data[channel][filename]
                 total_selection = np.ones(len(weights)) > 0.0
                 for selection in selections:
@@ -282,88 +396,75 @@ class HistogramFiller:
                 fill_profile(histogram_dictionary[channel], to_fill, to_weight)
         return histogram_dictionary
 
-    def fill_tprofile_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel="",):
+    def fill_tprofile_histograms(self, histogram_name, data, variable_x, variable_y, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel="", histogram_dictionary = None):
         '''Get a TProfile histogram with variable_y profiled against variable_x, after selections selections have been applied'''
+        booking = HistogramBooking(histogram_name, "TProfile", [variable_x, variable_y], selections = selections, bins = bins, range_low = range_low, range_high = range_high, xlabel = xlabel, ylabel = ylabel)
+        return self.fill_booking(booking, data, histogram_dictionary)
 
-        name_to_fill_x = variable_x.name
-        name_to_fill_y = variable_y.name
-        variables = [variable_x, variable_y]
-        histogram_dictionary = {}
-        for channel in self.channels:
-            if (type(bins) == list):
-                bins_array = array('d',bins)
-                histogram_dictionary[channel] = ROOT.TProfile(histogram_name + channel, histogram_name + channel, len(bins_array)-1, bins_array)
-            else:
-                histogram_dictionary[channel] = ROOT.TProfile(histogram_name + channel, histogram_name + channel, bins, range_low + 0.0000001, range_high - 0.000001)
-            histogram_dictionary[channel].Sumw2()
-
-        for channel in self.channels:
-            for filename in self.channel_files[channel]:
-                variable_dict, selection_dict, weights = data[channel][filename]
-                total_selection = np.ones(len(weights)) > 0.0
-                for selection in selections:
-                    total_selection &= selection_dict[selection.name]
-                to_weight = weights[total_selection]
-                n_sel = len(to_weight)
-                to_fill = np.zeros((n_sel,2))
-                to_fill[:,0] = variable_dict[name_to_fill_x][total_selection]
-                to_fill[:,1] = variable_dict[name_to_fill_y][total_selection]
-                if self.verbose: print(to_fill)
-                if self.verbose: print(to_weight)
-                if self.verbose: print("Filling Variable " + variable.name)
-                if self.verbose: print("Filling Histogram")
-                fill_profile(histogram_dictionary[channel], to_fill, to_weight)
-                if self.verbose: print("Finished filling histogram")
-
-            histogram_dictionary[channel].GetXaxis().SetTitle(xlabel)
-            histogram_dictionary[channel].GetYaxis().SetTitle(ylabel)
-        return histogram_dictionary
-
-    def book_histogram_fill(self, histogram_name, variable, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = "", HistogramPerFile=False, useWeights = True):
-        if histogram_name not in self.histogram_filling_functions:
-            self.histogram_filling_functions[histogram_name] = lambda data : self.fill_histograms(histogram_name, data, variable, selections = selections, bins = bins, range_low = range_low, range_high=range_high,  xlabel = xlabel, ylabel = ylabel, HistogramPerFile=HistogramPerFile, useWeights = useWeights)
-        else:
-            raise ValueError("histogram name already exists")
-        for selection in selections:
-            if selection.name not in [sel.name for sel in self.all_selections]:
-                self.all_selections.append(selection)
-
-        if variable.name not in [var.name for var in self.all_variables]:
-            self.all_variables.append(variable)
-
-    def book_2dhistogram_fill(self, histogram_name, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel=""):
-        if histogram_name not in self.histogram_filling_functions:
-            self.histogram_filling_functions[histogram_name] = lambda data : self.fill_2d_histograms(histogram_name, data, variable_x, variable_y, selections = selections, bins_x = bins_x, range_low_x =range_low_x, range_high_x=range_high_x,  xlabel =xlabel, bins_y=bins_y, range_low_y=range_low_y, range_high_y=range_high_y, ylabel = ylabel, zlabel=zlabel)
-        else:
+    def book(self, booking):
+        '''
+        Book a histogram to be filled when DumpHistograms is called
+        '''
+        if booking.name in self.booked_histograms:
             raise ValueError("histogram name already exists")
+        self.booked_histograms[booking.name] = booking
 
-        for selection in selections:
+        for selection in booking.selections:
             if selection.name not in [sel.name for sel in self.all_selections]:
                 self.all_selections.append(selection)
 
-        if variable_x.name not in [var.name for var in self.all_variables]:
-            self.all_variables.append(variable_x)
+        for variable in booking.variables:
+            if variable.name not in [var.name for var in self.all_variables]:
+                self.all_variables.append(variable)
 
-        if variable_y.name not in [var.name for var in self.all_variables]:
-            self.all_variables.append(variable_y)
+    def book_histogram_fill(self, histogram_name, variable, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = "", HistogramPerFile=False, useWeights = True):
+        self.book(HistogramBooking(histogram_name, "TH1D", [variable], selections = selections, use_weights = useWeights, bins = bins, range_low = range_low, range_high = range_high, xlabel = xlabel, ylabel = ylabel))
 
-    def book_tprofile_fill(self, histogram_name,  variable_x, variable_y, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = ""):
-        if histogram_name not in self.histogram_filling_functions:
-            self.histogram_filling_functions[histogram_name] = lambda data : self.fill_tprofile_histograms(histogram_name, data, variable_x, variable_y, selections = selections, bins = bins, range_low = range_low, range_high=range_high,  xlabel =xlabel, ylabel=ylabel)
-        else:
-            raise ValueError("histogram name already exists")
+    def book_2dhistogram_fill(self, histogram_name, variable_x, variable_y, selections = [], bins_x = 1, range_low_x = 0.000001, range_high_x=1. - 0.00001,  xlabel ="", bins_y=1, range_low_y=0.000001, range_high_y=1. - 0.00001, ylabel = "", zlabel=""):
+        self.book(HistogramBooking(histogram_name, "TH2D", [variable_x, variable_y], selections = selections, bins_x = bins_x, range_low_x = range_low_x, range_high_x = range_high_x, xlabel = xlabel, bins_y = bins_y, range_low_y = range_low_y, range_high_y = range_high_y, ylabel = ylabel, zlabel = zlabel))
 
-        for selection in selections:
-            if selection.name not in [sel.name for sel in self.all_selections]:
-                self.all_selections.append(selection)
+    def book_tprofile_fill(self, histogram_name,  variable_x, variable_y, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001,  xlabel ="", ylabel = ""):
+        self.book(HistogramBooking(histogram_name, "TProfile", [variable_x, variable_y], selections = selections, bins = bins, range_low = range_low, range_high = range_high, xlabel = xlabel, ylabel = ylabel))
 
-        if variable_x.name not in [var.name for var in self.all_variables]:
-            self.all_variables.append(variable_x)
+    def book_split_histogram_fill(self, histogram_name, variable, eta_variable, p_variable, eta_ranges, p_bins_for_eta_range, histogram_names, selections = [], bins = 1, range_low = 0.000001, range_high=1. - 0.00001, xlabel ="", ylabel = ""):
+        '''
+        Book a TH1D of variable for every momentum bin of every eta range, that are all filled in one pass. A track is in an eta range if low < eta_variable < high, and in a momentum bin if low < p_variable <= high.
+        histogram_names is a list for each eta range of the names of the histograms written for each momentum bin. histogram_name is only used to book the histograms, and no histogram is written with that name.
+        '''
+        assert len(histogram_names) == len(eta_ranges) and len(p_bins_for_eta_range) == len(eta_ranges)
+        for names, p_bins in zip(histogram_names, p_bins_for_eta_range):
+            assert len(names) == len(p_bins) - 1
+        self.book(HistogramBooking(histogram_name, "TH1DSplit", [variable, eta_variable, p_variable], selections = selections, bins = bins, range_low = range_low, range_high = range_high, xlabel = xlabel, ylabel = ylabel, eta_ranges = eta_ranges, p_bins_for_eta_range = p_bins_for_eta_range, histogram_names = histogram_names))
 
-        if variable_y.name not in [var.name for var in self.all_variables]:
-            self.all_variables.append(variable_y)
+    def get_subchannel_data(self, data):
+        '''
+        Given the data for the original channels, get the data for every subchannel whose original channel is in data
+        The variables and selections of a subchannel are not copied. They are IndexedColumns views of the original channel that are only resolved when a histogram is filled.
+        '''
+        subchannel_data = {}
+        for subchannel in self.subchannels:
+            origin_channel = self.subchannels[subchannel]["original_channel"]
+            if origin_channel not in data:
+                continue
+            print("Getting the data for subchannel {}".format(subchannel))
+            selections = self.subchannels[subchannel]["selections"]
+            assert subchannel not in data
+            subchannel_data[subchannel] = {}
+            for filename in data[origin_channel]:
+                variable_dict, selection_dict, weights = data[origin_channel][filename]
+                total_selection = np.ones(len(weights)) > 0.5
+                for sel in selections:
+                    total_selection &= selection_dict[sel.name]
+                indices = np.flatnonzero(total_selection)
+                subchannel_data[subchannel][filename] = IndexedColumns(variable_dict, indices), IndexedColumns(selection_dict, indices), weights[indices]
+        return subchannel_data
 
     def DumpHistograms(self):
+        if self.book_only:
+            return self.create_all_histograms()
+        if self.chunk_size != None:
+            return self.DumpHistogramsInChunks()
+
         data = {}
         for channel in self.channels:
             if channel not in self.subchannels:
@@ -372,33 +473,64 @@ class HistogramFiller:
                 for filename in self.channel_files[channel]:
                     data[channel][filename] = self.get_data(channel,filename, self.all_variables, self.all_selections)
 
-        for subchannel in self.subchannels:
-            print("Getting the data for subchannel {}".format(subchannel))
-            origin_channel = self.subchannels[subchannel]["original_channel"]
-            selections = self.subchannels[subchannel]["selections"]
-            assert subchannel not in data
-            data[subchannel] = {}
-            for filename in data[origin_channel]:
-                variable_dict, selection_dict, weights = data[origin_channel][filename]
-                total_selection = np.ones(len(weights)) > 0.5
-                for sel in selections:
-                    total_selection &= selection_dict[sel.name]
+        data.update(self.get_subchannel_data(data))
+
+        accumulators = self.create_all_accumulators()
+        FillPlan(list(self.booked_histograms.values())).fill(data, accumulators)
+        self.close_open_trees()
 
-                new_variable_dict = {}
-                new_selection_dict = {}
-                for key in variable_dict:
-                    new_variable_dict[key] = variable_dict[key][total_selection]
-                for key in selection_dict:
-                    new_selection_dict[key] = selection_dict[key][total_selection]
-                new_weights = weights[total_selection]
-                data[subchannel][filename] = new_variable_dict, new_selection_dict, new_weights
+        return self.convert_accumulators(accumulators)
 
+    def create_all_histograms(self):
+        '''create the empty histograms for every histogram written for the booked histograms'''
         histograms = {}
-        for histogram_name in self.histogram_filling_functions:
-            histograms[histogram_name] = self.histogram_filling_functions[histogram_name](data)
+        for histogram_name in self.booked_histograms:
+            for output_booking in self.booked_histograms[histogram_name].get_output_bookings():
+                histograms[output_booking.name] = self.create_histograms(output_booking)
+        return histograms
 
+    def create_all_accumulators(self):
+        '''create an empty HistogramAccumulator for every booked histogram and channel. The histograms are filled into these, and only converted to ROOT histograms once all of the data has been filled'''
+        accumulators = {}
+        for histogram_name in self.booked_histograms:
+            accumulators[histogram_name] = {}
+            for channel in self.channels:
+                accumulators[histogram_name][channel] = create_accumulator(self.booked_histograms[histogram_name])
+        return accumulators
+
+    def convert_accumulators(self, accumulators):
+        '''create the ROOT histograms for every booked histogram, with the contents of the accumulators'''
+        histograms = self.create_all_histograms()
+        for histogram_name in self.booked_histograms:
+            output_bookings = self.booked_histograms[histogram_name].get_output_bookings()
+            for channel in self.channels:
+                for output_booking, arrays in zip(output_bookings, accumulators[histogram_name][channel].get_output_arrays()):
+                    set_histogram_arrays(histograms[output_booking.name][channel], arrays)
         return histograms
 
+    def DumpHistogramsInChunks(self):
+        '''
+        Fill all of the booked histograms by streaming over the partition of each file in chunks of self.chunk_size entries.
+        Each chunk is filled into the histograms and dropped before the next one is read, so that the memory usage depends on the chunk size and not on the size of the partition.
+        '''
+        accumulators = self.create_all_accumulators()
+        plan = FillPlan(list(self.booked_histograms.values()))
+
+        for channel in self.channels:
+            if channel in self.subchannels:
+                continue
+            print("Dumping for channel {} in chunks of {} entries".format(channel, self.chunk_size))
+            for filename in self.channel_files[channel]:
+                for chunk in self.get_data_chunks(channel, filename, self.all_variables, self.all_selections):
+                    data = {channel : {filename : chunk}}
+                    data.update(self.get_subchannel_data(data))
+                    plan.fill(data, accumulators)
+                    self.close_open_trees()
+                    del data, chunk
+                    if self.verbose: print("Memory usage after chunk: {} MB".format(process.memory_info().rss / 1e6))
+
+        return self.convert_accumulators(accumulators)
+
 
 #These are python JZW samples. I normalize to the number of generated events, the cross section and the filter efficiency
 weight_dictionary = {\
@@ -423,7 +555,6 @@ except ImportError:
 
 if foundRootNumpy:
     from root_numpy import fill_hist, fill_profile
-    from root_numpy import tree2array
 
 import os
 import psutil
@@ -453,7 +584,90 @@ def getIsData(filename):
     '''
     return ("Data" in filename.split("/")[-1] or "data" in filename.split("/")[-1] or "Data" in filename.split("/")[-2] or "data" in filename.split("/")[-2])
 
-def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = None, tree = None, treename = None, variables = [], weight_calculator = None, selections = [], selection_string = "",  verbose = False):
+#in the second step of a read with channel selections, the entries are read in blocks of this size, and blocks without any entry passing the selections are skipped
+preselection_block_size = 10000
+
+def read_branches(tree, branches, selection_string, partition, reader):
+    '''read branches for the entries in partition from tree with reader, trying again if the read fails. Return a structured array like the one from root_numpy.tree2array'''
+    data = None
+    for i in range(1, 50):
+        try:
+            data = reader.read(tree, branches, selection_string, partition[0], partition[1])
+        except Exception as e:
+            print("Catching a failed attempt to retrieve data error. Trying agagin in 5 seconds")
+            print(e)
+            time.sleep(5) #try again in 5 seconds
+        else:
+            break
+
+    if data is None:
+        raise ValueError("Could not retrieve the data.")
+    return data
+
+def get_entry_ranges(indices, block_size, entries):
+    '''
+    Given the sorted positions of the entries to keep in a partition with a number of entries, return the list of (start, stop) ranges of entries to read.
+    The entries are split into blocks of block_size. Blocks without any entry to keep are skipped, and neighbouring blocks are merged into one range.
+    '''
+    ranges = []
+    for block in np.unique(indices // block_size):
+        start = int(block) * block_size
+        stop = min(start + block_size, entries)
+        if len(ranges) > 0 and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+def read_columns(tree, branches, selection_string, partition, reader, cache = None, cache_key = None, indices = None, entry_ranges = None, precision = None):
+    '''
+    Read branches for the entries in partition, and return a dictionary of branch to numpy array, with the types chosen by the PrecisionPolicy precision. See read_native_columns.
+    '''
+    columns = read_native_columns(tree, branches, selection_string, partition, reader, cache = cache, cache_key = cache_key, indices = indices, entry_ranges = entry_ranges)
+    if precision != None:
+        columns = precision.apply(columns)
+    return columns
+
+def read_native_columns(tree, branches, selection_string, partition, reader, cache = None, cache_key = None, indices = None, entry_ranges = None):
+    '''
+    Read branches for the entries in partition, and return a dictionary of branch to numpy array. Branches in the cache are loaded from there, and branches read from the tree are saved to it.
+    If indices is given, only the entries at these positions in the partition are returned. If entry_ranges from get_entry_ranges is given as well, only those ranges of entries are read from the tree.
+    Whole partitions are always read when there is a cache, so that the cache only holds complete branches.
+    '''
+    columns = {}
+    if cache != None:
+        columns = cache.load(cache_key, branches)
+        print("Found {} of {} branches in the cache".format(len(columns), len(branches)))
+        if indices is not None:
+            for branch in columns:
+                columns[branch] = columns[branch][indices]
+    missing_branches = [branch for branch in branches if branch not in columns]
+    if len(missing_branches) == 0:
+        return columns
+
+    if indices is not None and entry_ranges != None and cache == None:
+        blocks = []
+        for start, stop in entry_ranges:
+            data = read_branches(tree, missing_branches, selection_string, (partition[0] + start, partition[0] + stop), reader)
+            blocks.append(data[indices[(indices >= start) & (indices < stop)] - start])
+        if len(blocks) == 0:
+            blocks.append(read_branches(tree, missing_branches, selection_string, (partition[0], partition[0]), reader))
+        data = np.concatenate(blocks)
+        for branch in missing_branches:
+            columns[branch] = data[branch]
+        return columns
+
+    data = read_branches(tree, missing_branches, selection_string, partition, reader)
+    new_columns = {}
+    for branch in missing_branches:
+        new_columns[branch] = data[branch]
+    if cache != None:
+        cache.save(cache_key, new_columns)
+    for branch in new_columns:
+        columns[branch] = new_columns[branch][indices] if indices is not None else new_columns[branch]
+    return columns
+
+def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = None, tree = None, treename = None, variables = [], weight_calculator = None, selections = [], selection_string = "",  verbose = False, close_file = True, cache = None, lazy = False, preselections = [], reader = None, precision = None):
     '''
     A function for retrieving data
 
@@ -466,8 +680,20 @@ def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = Non
     selections -- a list of all selections to calculate
     select_string -- a string used to select a subset of the entries in the tree. This uses the same syntax when selecting events using TTree draw:w
     verbose -- an option to have more printed output from the function.
+    close_file -- close the file of the tree once the data has been read. Set this to False if more entries will be read from the tree later.
+    cache -- an instance of BranchCache. If given, the branches are read from the cache when they are there, and saved to the cache when they are read from the tree.
+    lazy -- only read each branch when it is first needed, instead of reading all of the branches up front. The weights and selections are calculated here, and the variables are returned as a LazyVariables, so that their branches are only read when a histogram with entries passing its selections fills them. The branches that were read are returned in used_branches, which grows as the variables are calculated. The file is not closed, because the variables are read after this returns.
+    preselections -- a list of selections that every returned entry has to pass. Only the branches of these selections are read for all entries, and everything else is read and calculated for the entries that pass them.
+    reader -- the reader used to read the branches from the tree, from tree_readers. Defaults to a RootNumpyReader.
+    precision -- the PrecisionPolicy that chooses the type that each branch is kept in. Defaults to the type of the branch in the tree.
     '''
     assert len(partition) == 2
+    if reader == None:
+        reader = RootNumpyReader()
+    if precision == None:
+        precision = PrecisionPolicy()
+    if selection_string != "" and not reader.supports_selection_string:
+        raise ValueError("The {} reader can't apply the selection string {}".format(reader.name, selection_string))
 
     isData = getIsData(filename)
     for branch in weight_calculator.branches:
@@ -478,19 +704,51 @@ def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = Non
 
     if verbose: print("Reading from file " + filename)
 
-    data = None
-    for i in range(1, 50):
-        try:
-            data = tree2array(tree, branches, selection_string, start = partition[0], stop = partition[1])
-        except Exception as e:
-            print("Catching a failed attempt to retrieve data error. Trying agagin in 5 seconds")
-            print(e)
-            time.sleep(5) #try again in 5 seconds
+    cache_key = cache.get_key(filename, tree, partition, selection_string) if cache != None else None
+
+    #first read only the branches needed by the channel selections, and find the entries that pass them. Everything else is only read and calculated for those entries
+    indices = None
+    entry_ranges = None
+    preselected_columns = {}
+    preselection_branches = get_needed_branches([], preselections)
+    if len(preselection_branches) > 0:
+        print("Applying selections for this channel")
+        preselected_columns = read_columns(tree, preselection_branches, selection_string, partition, reader, cache = cache, cache_key = cache_key, precision = precision)
+        entries = len(preselected_columns[preselection_branches[0]])
+        preselection_data = BlockEvaluator(ColumnData(preselected_columns, entries))
+        total_selection = np.ones(entries) > 0.5
+        for selection in preselections:
+            passed_selection = selection.eval(preselection_data)
+            print("\t Applying {}, with {} events passing".format(selection.name, np.sum(1 * passed_selection)))
+            total_selection &= passed_selection
+        indices = np.flatnonzero(total_selection)
+        print("{} of {} entries pass the selections for channel {}".format(len(indices), entries, channel))
+        #the entries can only be found by position in the tree if no selection string was applied when reading
+        if selection_string == "":
+            entry_ranges = get_entry_ranges(indices, preselection_block_size, entries)
+        for branch in preselected_columns:
+            preselected_columns[branch] = preselected_columns[branch][indices]
+
+    if lazy:
+        #the branches are read from the cache or the tree when they are first needed, all of the branches needed at the same time in one pass
+        def read_lazy_branches(lazy_branches):
+            columns = dict((branch, preselected_columns[branch]) for branch in lazy_branches if branch in preselected_columns)
+            columns.update(read_columns(tree, [branch for branch in lazy_branches if branch not in columns], selection_string, partition, reader, cache = cache, cache_key = cache_key, indices = indices, entry_ranges = entry_ranges, precision = precision))
+            return columns
+        column_data = LazyColumnData(read_lazy_branches, branches, entries = len(indices) if indices is not None else None)
+        #the weights and selections are needed for every entry, so their branches are read together
+        column_data.read(weight_calculator.branches + get_needed_branches([], selections))
+    else:
+        columns = dict(preselected_columns)
+        columns.update(read_columns(tree, [branch for branch in branches if branch not in columns], selection_string, partition, reader, cache = cache, cache_key = cache_key, indices = indices, entry_ranges = entry_ranges, precision = precision))
+        if indices is not None:
+            entries = len(indices)
         else:
-            break
+            entries = len(columns[branches[0]]) if len(branches) > 0 else 0
+        column_data = ColumnData(columns, entries)
 
-    if data == None:
-        raise ValueError("Could not retrieve the data.")
+    #the values of the calculations are kept for this block, so that shared intermediate values are only calculated once
+    data = BlockEvaluator(column_data)
 
     if verbose: print("Got the data for parition " + str(partition))
 
@@ -507,9 +765,12 @@ def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = Non
         weights = weights * xsec_weight * lumi_prescaled
 
     ##calculate everything we need in one go!
-    for variable in variables:
-        if verbose: print("calculating variables for " + variable.name)
-        variable_dict[variable.name] = variable.eval(data)
+    if lazy:
+        variable_dict = LazyVariables(data, column_data, variables)
+    else:
+        for variable in variables:
+            if verbose: print("calculating variables for " + variable.name)
+            variable_dict[variable.name] = variable.eval(data)
 
     #selection_dict is a dictionary of numpy arrays that have dimension # of events
     #each entry in the numpy array tells you if the event passed the selection
@@ -523,10 +784,33 @@ def GetData(partition = (0, 0), bare_branches = [], channel = "", filename = Non
     return_dict["selection_dict"] = selection_dict
     return_dict["variable_dict"] = variable_dict
     return_dict["weights"] = weights
+    return_dict["used_branches"] = column_data.used_branches if lazy else list(column_data.keys())
+    if close_file and not lazy:
+        close_tree_file(tree)
+    return return_dict
+
+def close_tree_file(tree):
+    '''close the file that the tree is reading from'''
     f = tree.GetCurrentFile()
     tree.SetDirectory(0)
-    f.Close()
-    return return_dict
+    if f: f.Close() #no file was opened if every branch came from the cache
+
+def get_filling_script_branches(trees, tree_name, filling_script, weight_calculator):
+    '''
+    get the branches that the filling script filling_script reads from the trees. The histograms of the script are booked on a HistogramFiller that doesn't read any entries, and the branches of the booked variables, selections and weights are returned.
+    '''
+    filling_module = imp.load_source("filling_script_bookings", filling_script)
+    hist_filler = HistogramFiller(trees, tree_name, weight_calculator, book_only = True)
+    temporary_directory = tempfile.mkdtemp(prefix = "bookings_")
+    try:
+        filling_module.fill_histograms(hist_filler, os.path.join(temporary_directory, "bookings.root"))
+    finally:
+        shutil.rmtree(temporary_directory)
+    branches = get_needed_branches(hist_filler.all_variables, hist_filler.all_selections)
+    for branch in hist_filler.weight_calculator.branches:
+        if branch not in branches:
+            branches.append(branch)
+    return branches
 
 def get_needed_branches(variables, selections):
     '''given a list of variables and selections, get all of the branches that should be read from the tree'''
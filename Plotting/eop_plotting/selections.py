@@ -1,5 +1,5 @@
 from calculation import Calculation, CalculationDataMC
-from variables import trkEtaPhiECAL
+from variables import calc_trkEtaECAL_ABS
 import numpy as np
 
 def NoSelection(trk):
@@ -100,7 +100,7 @@ branches = ["trk_d0"]
 sel_d0Less1_5 = Calculation(d0Less1_5, branches)
 
 def ExtrapolAcceptanceCalculator(trk, min_cut, max_cut):
-    trk_eta = np.abs(trkEtaPhiECAL(trk)[0]) #the absolute value of eta
+    trk_eta = calc_trkEtaECAL_ABS.eval(trk) #the absolute value of eta
 
     #check that both tracks are in the acceptance
     in_acceptance = (trk_eta < max_cut) & (trk_eta > min_cut)
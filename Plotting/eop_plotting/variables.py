@@ -8,25 +8,30 @@ calc_TruthMomentum = Calculation(TruthMomentum, ["trk_truthP"])
 
 def TotalCalibHitEnergyEM(trk):
     return trk["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalCalibHitEnergy_EM_200"]
+branches = ["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200", "trk_TotalHadronicBackgroundCalibHitEnergy_EM_200", "trk_TotalCalibHitEnergy_EM_200"]
+calc_TotalCalibHitEnergyEM = Calculation(TotalCalibHitEnergyEM, branches)
 
 def TotalCalibHitEnergyHAD(trk):
     return trk["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"] + trk["trk_TotalCalibHitEnergy_HAD_200"]
+branches = ["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200", "trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200", "trk_TotalCalibHitEnergy_HAD_200"]
+calc_TotalCalibHitEnergyHAD = Calculation(TotalCalibHitEnergyHAD, branches)
 
 def TotalCalibHitEnergy(trk):
-    return TotalCalibHitEnergyEM(trk) + TotalCalibHitEnergyHAD(trk)
+    return calc_TotalCalibHitEnergyEM.eval(trk) + calc_TotalCalibHitEnergyHAD.eval(trk)
+calc_TotalCalibHitEnergy = Calculation(TotalCalibHitEnergy, [], dependencies = [calc_TotalCalibHitEnergyEM, calc_TotalCalibHitEnergyHAD])
 
 CalibHitBranches = ["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200", "trk_TotalHadronicBackgroundCalibHitEnergy_EM_200", "trk_TotalCalibHitEnergy_EM_200","trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200", "trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200", "trk_TotalCalibHitEnergy_HAD_200"]
 
 def HasCalibHit(trk):
-    return TotalCalibHitEnergy(trk) > 0.0
+    return calc_TotalCalibHitEnergy.eval(trk) > 0.0
 sel_HasCalibHit = Calculation(HasCalibHit, CalibHitBranches)
 
 def HasEMCalibHit(trk):
-    return TotalCalibHitEnergyEM(trk) > 0.0
+    return calc_TotalCalibHitEnergyEM.eval(trk) > 0.0
 sel_HasEMCalibHit = Calculation(HasCalibHit, CalibHitBranches)
 
 def HasHADCalibHit(trk):
-    return TotalCalibHitEnergyHAD(trk) > 0.0
+    return calc_TotalCalibHitEnergyHAD.eval(trk) > 0.0
 sel_HasHADCalibHit = Calculation(HasHADCalibHit, CalibHitBranches)
 
 def EOTotalEMCalibEnergy(trk):
@@ -34,43 +39,43 @@ def EOTotalEMCalibEnergy(trk):
 calc_EOTotalEMCalibHitEnergy = Calculation(EOTotalEMCalibEnergy, ["trk_ClusterEMActiveCalibHitEnergy_EM_200", "trk_ClusterEMActiveCalibHitEnergy_HAD_200", "trk_p"])
 
 def CalibHitFrac(trk):
-    return (trk["trk_TotalCalibHitEnergy_EM_200"] + trk["trk_TotalCalibHitEnergy_HAD_200"]) / TotalCalibHitEnergy(trk)
+    return (trk["trk_TotalCalibHitEnergy_EM_200"] + trk["trk_TotalCalibHitEnergy_HAD_200"]) / calc_TotalCalibHitEnergy.eval(trk)
 calc_CalibHitFrac = Calculation(CalibHitFrac, CalibHitBranches)
 
 def PhotonCalibHitFrac(trk):
-    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200"]) / TotalCalibHitEnergy(trk)
+    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200"]) / calc_TotalCalibHitEnergy.eval(trk)
 calc_PhotonCalibHitFrac = Calculation(PhotonCalibHitFrac, CalibHitBranches)
 
 def HadronCalibHitFrac(trk):
-    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"]) / TotalCalibHitEnergy(trk)
+    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"]) / calc_TotalCalibHitEnergy.eval(trk)
 calc_HadronCalibHitFrac = Calculation(HadronCalibHitFrac, CalibHitBranches)
 
 def EMCalibHitFrac(trk):
-    return (trk["trk_TotalCalibHitEnergy_EM_200"]) / TotalCalibHitEnergyEM(trk)
+    return (trk["trk_TotalCalibHitEnergy_EM_200"]) / calc_TotalCalibHitEnergyEM.eval(trk)
 calc_EMCalibHitFrac = Calculation(EMCalibHitFrac, CalibHitBranches)
 
 def HADCalibHitFrac(trk):
-    return (trk["trk_TotalCalibHitEnergy_HAD_200"]) / TotalCalibHitEnergyHAD(trk)
+    return (trk["trk_TotalCalibHitEnergy_HAD_200"]) / calc_TotalCalibHitEnergyHAD.eval(trk)
 calc_HADCalibHitFrac = Calculation(HADCalibHitFrac, CalibHitBranches)
 
 def PhotonEMCalibHitFrac(trk):
-    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200"] ) / TotalCalibHitEnergyEM(trk)
+    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_EM_200"] ) / calc_TotalCalibHitEnergyEM.eval(trk)
 calc_PhotonEMCalibHitFrac = Calculation(PhotonEMCalibHitFrac, CalibHitBranches)
 
 def PhotonHADCalibHitFrac(trk):
-    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200"] ) / TotalCalibHitEnergyHAD(trk)
+    return (trk["trk_TotalPhotonBackgroundCalibHitEnergy_HAD_200"] ) / calc_TotalCalibHitEnergyHAD.eval(trk)
 calc_PhotonHADCalibHitFrac = Calculation(PhotonHADCalibHitFrac, CalibHitBranches)
 
 def HadronCalibHitFrac(trk):
-    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"]) / TotalCalibHitEnergy(trk)
+    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] + trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"]) / calc_TotalCalibHitEnergy.eval(trk)
 calc_HadronCalibHitFrac = Calculation(HadronCalibHitFrac, CalibHitBranches)
 
 def HadronEMCalibHitFrac(trk):
-    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] )/ TotalCalibHitEnergyEM(trk)
+    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_EM_200"] )/ calc_TotalCalibHitEnergyEM.eval(trk)
 calc_HadronEMCalibHitFrac = Calculation(HadronEMCalibHitFrac, CalibHitBranches)
 
 def HadronHADCalibHitFrac(trk):
-    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"] )/ TotalCalibHitEnergyHAD(trk)
+    return (trk["trk_TotalHadronicBackgroundCalibHitEnergy_HAD_200"] )/ calc_TotalCalibHitEnergyHAD.eval(trk)
 calc_HadronHADCalibHitFrac = Calculation(HadronHADCalibHitFrac, CalibHitBranches)
 
 def HadFrac(trk):
@@ -94,7 +99,7 @@ branches = ["trk_nTRT"]
 calc_nTRT = Calculation(nTRT, branches)
 
 def trkCount(trk):
-    return np.zeros(len(trk))
+    return np.zeros(len(trk), dtype = np.float32)
 branches = []
 calc_trkCount = Calculation(trkCount, branches)
 
@@ -164,9 +169,9 @@ def trkEtaPhiECAL(trk):
     has_both = has_barrel_extrap & has_endcap_extrap
     has_one = np.logical_not(has_both) & (has_endcap_extrap | has_barrel_extrap)
 
-    #this will be the eta coordinates used to calculate the acceptance
-    trk_eta = np.ones(len(trk)) * 99999999.0
-    trk_phi = np.ones(len(trk)) * 99999999.0
+    #this will be the eta coordinates used to calculate the acceptance. They are kept in the type of the extrapolated coordinates, which are floats in the tree
+    trk_eta = np.full(len(trk), 99999999.0, dtype = np.result_type(trk_etaEMB, trk_etaEME))
+    trk_phi = np.full(len(trk), 99999999.0, dtype = np.result_type(trk_phiEMB, trk_phiEME))
 
     #if there is only one extrapolated coordinate, then it is easy
     trk_eta[has_one & has_barrel_extrap] = trk_etaEMB[has_one & has_barrel_extrap]
@@ -179,16 +184,20 @@ def trkEtaPhiECAL(trk):
     trk_phi[has_both] = trk_phiEMB[has_both]
 
     return trk_eta, trk_phi
+branches = ["trk_etaEMB2","trk_etaEME2", "trk_phiEMB2", "trk_phiEME2"]
+calc_trkEtaPhiECAL = Calculation(trkEtaPhiECAL, branches)
 
 def trkEtaECAL(trk):
-    return trkEtaPhiECAL(trk)[0]
-branches = ["trk_etaEMB2","trk_etaEME2", "trk_phiEMB2", "trk_phiEME2"]
-calc_trkEtaECAL = Calculation(trkEtaECAL, branches)
+    return calc_trkEtaPhiECAL.eval(trk)[0]
+calc_trkEtaECAL = Calculation(trkEtaECAL, [], dependencies = [calc_trkEtaPhiECAL])
 
 def trkPhiECAL(trk):
-    return trkEtaPhiECAL(trk)[1]
-branches = ["trk_phiEMB2","trk_phiEME2", "trk_etaEMB2","trk_etaEME2"]
-calc_trkPhiECAL = Calculation(trkPhiECAL, branches)
+    return calc_trkEtaPhiECAL.eval(trk)[1]
+calc_trkPhiECAL = Calculation(trkPhiECAL, [], dependencies = [calc_trkEtaPhiECAL])
+
+def trkEtaECAL_ABS(trk):
+    return np.abs(calc_trkEtaECAL.eval(trk))
+calc_trkEtaECAL_ABS = Calculation(trkEtaECAL_ABS, [], dependencies = [calc_trkEtaECAL])
 
 def trkNearestNeighbourEM2(trk):
     return trk["trk_nearest_dR_EM"]
@@ -231,19 +240,81 @@ branches = ["trk_etaEMB2"]
 calc_trkEtaEMB2 = Calculation(trkEtaEMB2, branches)
 
 cone_strings = ["000","025", "050", "075", "100", "125", "150", "175", "200", "225", "250", "275", "300"]
+
+#The total EM + HAD cluster energy in every cone is stacked into one (tracks x cones) matrix per block. The energy in every annulus between neighbouring cones is then
+#np.diff of that matrix, and the energy density and E/p of the annuli are calculated from it for all annuli at once. The histograms of each annulus are filled from a column.
+cone_radii = [float(cone) / 1000.0 for cone in cone_strings]
+annulus_areas = np.array([pi * ((high ** 2) - (low ** 2)) for low, high in zip(cone_radii[:-1], cone_radii[1:])])
+
+def ConeEnergyMatrix(trk):
+    '''the total EM + HAD cluster energy in each cone of cone_strings. The first column is the cone of radius 0, that has no energy'''
+    cone_energies = [trk["trk_ClusterEnergy_EM_{}".format(cone)] + trk["trk_ClusterEnergy_HAD_{}".format(cone)] for cone in cone_strings[1:]]
+    return np.column_stack([np.zeros(len(cone_energies[0]), dtype = cone_energies[0].dtype)] + cone_energies)
+branches = []
+for cone in cone_strings[1:]:
+    branches += ["trk_ClusterEnergy_EM_{}".format(cone), "trk_ClusterEnergy_HAD_{}".format(cone)]
+calc_ConeEnergyMatrix = Calculation(ConeEnergyMatrix, branches)
+
+def AnnulusEnergyMatrix(trk):
+    '''the total energy in the annulus between each pair of neighbouring cones'''
+    return np.diff(calc_ConeEnergyMatrix.eval(trk), axis = 1)
+calc_AnnulusEnergyMatrix = Calculation(AnnulusEnergyMatrix, [], dependencies = [calc_ConeEnergyMatrix])
+
+def AnnulusEnergyDensityMatrix(trk):
+    annulus_energy = calc_AnnulusEnergyMatrix.eval(trk)
+    return annulus_energy / annulus_areas.astype(annulus_energy.dtype)
+calc_AnnulusEnergyDensityMatrix = Calculation(AnnulusEnergyDensityMatrix, [], dependencies = [calc_AnnulusEnergyMatrix])
+
+def AnnulusEOPMatrix(trk):
+    return calc_AnnulusEnergyMatrix.eval(trk) / trk["trk_p"][:, np.newaxis]
+calc_AnnulusEOPMatrix = Calculation(AnnulusEOPMatrix, ["trk_p"], dependencies = [calc_AnnulusEnergyMatrix])
+
+def AnnulusEOPDensityMatrix(trk):
+    annulus_eop = calc_AnnulusEOPMatrix.eval(trk)
+    return annulus_eop / annulus_areas.astype(annulus_eop.dtype)
+calc_AnnulusEOPDensityMatrix = Calculation(AnnulusEOPDensityMatrix, [], dependencies = [calc_AnnulusEOPMatrix])
+
+#one calculation per column, so that each column is taken once per block even though it is used by many histograms
+column_calculations = {}
+def get_column_calculation(calc_matrix, column, name):
+    if name not in column_calculations:
+        function = lambda trk : calc_matrix.eval(trk)[:, column]
+        function.__name__ = name
+        column_calculations[name] = Calculation(function, [], dependencies = [calc_matrix])
+    return column_calculations[name]
+
+def get_cone_energy_calculation(cone):
+    '''get the Calculation of the total EM + HAD cluster energy in the cone'''
+    return get_column_calculation(calc_ConeEnergyMatrix, cone_strings.index(cone), "total_energy_in_cone_{}".format(cone))
+
+def get_annulus_calculation(calc_matrix, min_cone, max_cone):
+    '''get the Calculation of the column of calc_matrix, one of the (tracks x annuli) matrices above, for the annulus between the neighbouring cones min_cone and max_cone'''
+    column = cone_strings.index(min_cone)
+    assert cone_strings[column + 1] == max_cone
+    return get_column_calculation(calc_matrix, column, "{}_{}_{}".format(calc_matrix.name, min_cone, max_cone))
+
+annulus_energy_calculations = {}
+def get_annulus_energy_calculation(min_cone, max_cone):
+    '''get the Calculation of the total EM + HAD cluster energy in the annulus between min_cone and max_cone'''
+    if (min_cone, max_cone) not in annulus_energy_calculations:
+        min_column = cone_strings.index(min_cone)
+        max_column = cone_strings.index(max_cone)
+        if max_column == min_column + 1:
+            function = lambda trk : calc_AnnulusEnergyMatrix.eval(trk)[:, min_column]
+            dependencies = [calc_AnnulusEnergyMatrix]
+        else:
+            function = lambda trk : calc_ConeEnergyMatrix.eval(trk)[:, max_column] - calc_ConeEnergyMatrix.eval(trk)[:, min_column]
+            dependencies = [calc_ConeEnergyMatrix]
+        function.__name__ = "total_energy_in_annulus_{}_{}".format(min_cone, max_cone)
+        annulus_energy_calculations[(min_cone, max_cone)] = Calculation(function, [], dependencies = dependencies)
+    return annulus_energy_calculations[(min_cone, max_cone)]
+
 def total_energy_annulus_template(trk, min_cone, max_cone):
     assert min_cone in cone_strings
     assert max_cone in cone_strings
     assert int(min_cone) < int(max_cone)
 
-    if int(min_cone) < 24:
-        lower_sum = np.zeros(len(trk))
-    else:
-        lower_sum = trk["trk_ClusterEnergy_EM_{}".format(min_cone)] + trk["trk_ClusterEnergy_HAD_{}".format(min_cone)]
-
-    upper_sum = trk["trk_ClusterEnergy_EM_{}".format(max_cone)] + trk["trk_ClusterEnergy_HAD_{}".format(max_cone)]
-
-    return upper_sum - lower_sum
+    return get_annulus_energy_calculation(min_cone, max_cone).eval(trk)
 
 def EnergyAnulus(trk):
     return trk["trk_ClusterEnergy_EM_200"] - trk["trk_ClusterEnergy_EM_100"]
@@ -261,19 +332,16 @@ branches = ["trk_ClusterEnergy_EM_175", "trk_ClusterEnergy_EM_100"]
 calc_EnergyAnulusDown = Calculation(EnergyAnulusDown, branches)
 
 def EOPBkg(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.2**2) - (0.1**2) )) * (EnergyAnulus(trk))
-branches = ["trk_ClusterEnergy_EM_200", "trk_ClusterEnergy_EM_100", "trk_p"]
-calc_EOPBkg = Calculation(EOPBkg, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.2**2) - (0.1**2) )) * (calc_EnergyAnulus.eval(trk))
+calc_EOPBkg = Calculation(EOPBkg, ["trk_p"], dependencies = [calc_EnergyAnulus])
 
 def EOPBkgUp(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.2**2) - (0.125**2) )) * (EnergyAnulusUp(trk))
-branches = ["trk_ClusterEnergy_EM_200", "trk_ClusterEnergy_EM_125", "trk_p"]
-calc_EOPBkgUp = Calculation(EOPBkgUp, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.2**2) - (0.125**2) )) * (calc_EnergyAnulusUp.eval(trk))
+calc_EOPBkgUp = Calculation(EOPBkgUp, ["trk_p"], dependencies = [calc_EnergyAnulusUp])
 
 def EOPBkgDown(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.175**2) - (0.1**2) )) * (EnergyAnulusDown(trk))
-branches = ["trk_ClusterEnergy_EM_175", "trk_ClusterEnergy_EM_100", "trk_p"]
-calc_EOPBkgDown = Calculation(EOPBkgDown, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.175**2) - (0.1**2) )) * (calc_EnergyAnulusDown.eval(trk))
+calc_EOPBkgDown = Calculation(EOPBkgDown, ["trk_p"], dependencies = [calc_EnergyAnulusDown])
 
 def EnergyBigAnulus(trk):
     return trk["trk_ClusterEnergy_EM_275"] - trk["trk_ClusterEnergy_EM_200"]
@@ -291,19 +359,16 @@ branches = ["trk_ClusterEnergy_EM_275", "trk_ClusterEnergy_EM_225"]
 calc_EnergyBigAnulusDown = Calculation(EnergyBigAnulusDown, branches)
 
 def EOPBigBkgUp(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.275**2) - (0.225**2) )) * (EnergyBigAnulusUp(trk))
-branches = ["trk_ClusterEnergy_EM_275", "trk_ClusterEnergy_EM_225", "trk_p"]
-calc_EOPBigBkgUp = Calculation(EOPBigBkgUp, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.275**2) - (0.225**2) )) * (calc_EnergyBigAnulusUp.eval(trk))
+calc_EOPBigBkgUp = Calculation(EOPBigBkgUp, ["trk_p"], dependencies = [calc_EnergyBigAnulusUp])
 
 def EOPBigBkgDown(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.25**2) - (0.2**2) )) * (EnergyBigAnulusDown(trk))
-branches = ["trk_ClusterEnergy_EM_250", "trk_ClusterEnergy_EM_200", "trk_p"]
-calc_EOPBigBkgDown = Calculation(EOPBigBkgDown, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.25**2) - (0.2**2) )) * (calc_EnergyBigAnulusDown.eval(trk))
+calc_EOPBigBkgDown = Calculation(EOPBigBkgDown, ["trk_p"], dependencies = [calc_EnergyBigAnulusDown])
 
 def EOPBigBkg(trk):
-    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.275**2) - (0.2**2) )) * (EnergyBigAnulus(trk))
-branches = ["trk_ClusterEnergy_EM_275", "trk_ClusterEnergy_EM_200", "trk_p"]
-calc_EOPBigBkg = Calculation(EOPBigBkg, branches)
+    return (1./trk["trk_p"]) * ( (0.2**2)/( (0.275**2) - (0.2**2) )) * (calc_EnergyBigAnulus.eval(trk))
+calc_EOPBigBkg = Calculation(EOPBigBkg, ["trk_p"], dependencies = [calc_EnergyBigAnulus])
 
 def EOP(trk):
     return (trk["trk_ClusterEnergy_EM_200"] + trk["trk_ClusterEnergy_HAD_200"])/trk["trk_p"]
@@ -316,7 +381,7 @@ branches = ["trk_LCWClusterEnergy_EM_200", "trk_LCWClusterEnergy_HAD_200", "trk_
 calc_LCW_EOP = Calculation(LCW_EOP, branches)
 
 def DPhi(trk):
-    dphi = np.ones(len(trk)) * 100000000.0
+    dphi = np.full(len(trk), 100000000.0, dtype = np.result_type(trk["trk_phiID"], trk["trk_phiEMB2"], trk["trk_phiEME2"]))
     hasEMB2 = np.abs(trk["trk_phiEMB2"]) < 40
     hasEME2 = np.abs(trk["trk_phiEME2"]) < 40
 
@@ -330,7 +395,7 @@ branches = ["trk_phiEMB2", "trk_phiEME2","trk_phiID"]
 calc_trkDPhi = Calculation(DPhi, branches)
 
 def DEta(trk):
-    deta = np.ones(len(trk)) * 100000000.0
+    deta = np.full(len(trk), 100000000.0, dtype = np.result_type(trk["trk_etaID"], trk["trk_etaEMB2"], trk["trk_etaEME2"]))
     hasEMB2 = np.abs(trk["trk_etaEMB2"]) < 40
     hasEME2 = np.abs(trk["trk_etaEME2"]) < 40
 
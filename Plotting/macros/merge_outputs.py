@@ -0,0 +1,20 @@
+##This is a script that merges the root files written by the plotting jobs into a single file
+import os
+import glob
+import argparse
+import multiprocessing
+from merging import merge_root_files
+
+parser = argparse.ArgumentParser(description='merge the histograms written by all of the plotting jobs')
+parser.add_argument('--job_dir', '-jd', dest="job_dir", type=str, required=True, help='where to look for the root files of the jobs that ran')
+parser.add_argument('--job_name', '-jn', dest="job_name", type=str, required=True, help='the name of the job. The files job_name_N.root are merged')
+parser.add_argument('--output_file', '-o', dest="output_file", type=str, required=True, help='the root file to write the merged histograms to')
+parser.add_argument('--n_workers', '-nw', dest="n_workers", type=int, default=multiprocessing.cpu_count(), help='the number of processes merging files at the same time')
+parser.add_argument('--fan_in', '-fi', dest="fan_in", type=int, default=2, help='the number of files or partial results merged together in each step')
+
+args = parser.parse_args()
+
+input_files = sorted(glob.glob(os.path.join(args.job_dir, "{}_[0-9]*.root".format(args.job_name))))
+print("Found {} files to merge".format(len(input_files)))
+merge_root_files(input_files, args.output_file, n_workers = args.n_workers, fan_in = args.fan_in)
+print("FINISHED")
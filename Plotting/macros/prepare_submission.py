@@ -1,10 +1,11 @@
 #First get the number of entries in each of the trees in inputs
 import utils
 import os
-from histogram_filling import HistogramFiller
+from job_manifest import create_job_record, write_job_record
+from precision import parse_overrides
+from histogram_filling import get_filling_script_branches
 from variables import calc_weight
 import ROOT
-import pickle
 import argparse
 
 parser = argparse.ArgumentParser(description='Submit plotting batch jobs for the EoverPAnalysis plotting')
@@ -14,24 +15,40 @@ parser.add_argument('--job_name', '-job_name', dest="job_name", type=str, defaul
 parser.add_argument('--queue_flavour', '-queue_flavour', dest="queue_flavour", type=str, default='tomorrow', help='What condor queue should the jobs run on?')
 parser.add_argument('--file_flavour', '-ff', dest="file_flavour", type=str, default='inclusive', help='What is the flavour of the jobs that you want to submit?')
 parser.add_argument('--filling_script', '-fs', dest="filling_script", type=str, default='inclusive', help='What is the name of the script that takes the input root file and makes histograms?')
+parser.add_argument('--partitioning', '-pt', dest="partitioning", type=str, default='balanced', choices=['balanced', 'entries'], help='balanced splits the trees into partitions with the same compressed size on disk, and entries splits each file into partitions with the same number of entries')
+parser.add_argument('--chunk_size', '-cs', dest="chunk_size", type=int, default=None, help='If set, each job streams over its partition in chunks of this many entries instead of reading it all at once')
+parser.add_argument('--cache_directory', '-cd', dest="cache_directory", type=str, default=None, help='If set, the branches read by each job are cached in this directory, so that later jobs over the same partitions read them from local disk')
+parser.add_argument('--lazy_branches', '-lb', dest="lazy_branches", action='store_true', help='If set, each job only reads a branch when a calculation first uses it, instead of reading all of the branches up front')
+parser.add_argument('--reader_threads', '-rt', dest="reader_threads", type=int, default=1, help='the number of threads that the uproot reader of each job decompresses branches on. This many cores are requested for each job')
+parser.add_argument('--reader', '-rd', dest="reader", type=str, default='root_numpy', choices=['root_numpy', 'uproot'], help='the library used to read the trees. uproot decompresses the branches on --reader_threads threads, but cannot apply a selection string')
+parser.add_argument('--precision', '-pr', dest="precision", type=str, default='native', choices=['native', 'float32', 'float64'], help='the type that the floating point branches are kept in. native keeps the type of each branch in the tree')
+parser.add_argument('--precision_overrides', '-po', dest="precision_overrides", type=str, nargs='*', default=[], help='branch:type pairs for branches that need a different type than --precision, e.g. trk_p:float64')
+parser.add_argument('--request_memory', '-rm', dest="request_memory", type=int, default=10000, help='The memory in MB to request for each condor job')
 
 args = parser.parse_args()
 project_dir = os.getenv("EOPPlottingDir")
 assert project_dir is not None
 
-#Create a pickle file and list for each submission
+#Create a job record for each submission
 tree_name = args.tree_name
 job_name = args.job_name
 n_jobs = args.n_jobs
 flavour = args.queue_flavour
 file_flavour = args.file_flavour
 filling_script = args.filling_script
+chunk_size = args.chunk_size
+cache_directory = os.path.abspath(args.cache_directory) if args.cache_directory != None else None
 condor_directories = ["condor", args.job_name]
 
 
 files = utils.get_files(file_flavour)
 trees = utils.tchain_files_together(args.tree_name, files)
-partitions = utils.generate_partitions(trees, n_jobs)
+if args.partitioning == "balanced":
+    #balance the partitions by the compressed size of the branches that the filling script reads
+    branches = get_filling_script_branches(trees, args.tree_name, filling_script, calc_weight)
+    partitions = utils.generate_balanced_partitions(trees, n_jobs, branches)
+else:
+    partitions = utils.generate_partitions(trees, n_jobs)
 
 condor_directory = project_dir
 for path in condor_directories:
@@ -51,19 +68,21 @@ python_executable = os.path.join(submission_script_dir, "plot.py")
 
 #create the python script that is needed for plotting
 plotting_instructions_python = []
-plotting_instructions_python.append("from histogram_filling import HistogramFiller")
-plotting_instructions_python.append("from {} import fill_histograms".format(filling_script.split("/")[-1].split(".")[0]))
-plotting_instructions_python.append("import pickle")
+plotting_instructions_python.append("from job_manifest import load_job_record, create_histogram_filler")
+plotting_instructions_python.append("from variables import calc_weight")
+plotting_instructions_python.append("import importlib")
 plotting_instructions_python.append("import argparse")
 plotting_instructions_python.append("parser = argparse.ArgumentParser(description=\'Submit plotting batch jobs for the EoverPAnalysis plotting\')")
 plotting_instructions_python.append("parser.add_argument(\'--num\', '-n', dest=\"num\", type=int, required=True, help=\'Which submission number was this?\')")
-plotting_instructions_python.append("parser.add_argument('--picklefile' '-p', dest='picklefile', type=str, default=\"\", help='Where to get the plotter')")
+plotting_instructions_python.append("parser.add_argument('--recordfile', '-r', dest='recordfile', type=str, default=\"\", help='Where to get the record of this job')")
 plotting_instructions_python.append("parser.add_argument('--jobName', '-j', dest=\"jobname\", type=str, default='\"\"', help='the names of the batch jobs')")
 plotting_instructions_python.append("args = parser.parse_args()")
 plotting_instructions_python.append("i = args.num")
-plotting_instructions_python.append("file = args.picklefile")
+plotting_instructions_python.append("file = args.recordfile")
 plotting_instructions_python.append("name = args.jobname")
-plotting_instructions_python.append("plots = pickle.load(open(file, \"rb\"))[i]")
+plotting_instructions_python.append("record = load_job_record(file)")
+plotting_instructions_python.append("plots = create_histogram_filler(record, calc_weight)")
+plotting_instructions_python.append("fill_histograms = importlib.import_module(record[\"filling_script\"]).fill_histograms")
 plotting_instructions_python.append("fill_histograms(plots, name + \"_\" + str(i) + \".root\")")
 with open(python_executable, 'w') as f:
     for line in plotting_instructions_python:
@@ -80,7 +99,7 @@ plotting_instruction_script.append("printf \"Job is running on node: \"; /bin/ho
 plotting_instruction_script.append("printf \"Job running as user: \"; /usr/bin/id")
 plotting_instruction_script.append("printf \"Job is running in directory: \"; /bin/pwd")
 plotting_instruction_script.append("ls -al")
-plotting_instruction_script.append("python {} ".format("plot.py") + " --num ${1} --picklefile ${2} --jobName ${3}")
+plotting_instruction_script.append("python {} ".format("plot.py") + " --num ${1} --recordfile ${2} --jobName ${3}")
 with open(executable, 'w') as f:
     for line in plotting_instruction_script:
         f.write(line+"\n")
@@ -107,13 +126,15 @@ with open(os.path.join(submission_script_dir,"condor_{}.sub".format(job_name)),"
         os.makedirs(condor_directory+"/Log")
     if not os.path.exists(condor_directory+"/Submission"):
         os.makedirs(condor_directory+"/Submission")
-    submission_pickle_file = os.path.join(condor_directory, "Submission", "{}.pickle".format(job_name))
+    #one small record per job. Each job only gets its own record
+    submission_record_file = os.path.join(condor_directory, "Submission", "{}_$(Process).json".format(job_name))
 
     leading_script.write("Error = " +condor_directory + "/Error/job.$(Process)\n")
     leading_script.write("Output = " +condor_directory + "/Output/job.$(Process)\n")
     leading_script.write("Log = "+condor_directory+"/Log/job.$(Process)\n")
     leading_script.write('+JobFlavour = "' + flavour + '"\n')
-    leading_script.write('Request_memory = 10000\n')
+    leading_script.write('Request_memory = {}\n'.format(args.request_memory))
+    leading_script.write('Request_cpus = {}\n'.format(args.reader_threads))
     leading_script.write("should_transfer_files = YES\n")
     leading_script.write("when_to_transfer_output = ON_Exit\n")
     leading_script.write("transfer_output         = True\n")
@@ -123,7 +144,7 @@ with open(os.path.join(submission_script_dir,"condor_{}.sub".format(job_name)),"
             rw=os.path.join(project_dir, "ReweightingHistograms"),\
             eop=os.path.join(project_dir,"eop_plotting"),\
             u=os.path.join(project_dir,"utils"),\
-            p=os.path.join(submission_pickle_file),\
+            p=submission_record_file,\
             py=python_executable,\
             setup=os.path.join(project_dir, "setup_condor.sh"),\
             fs=os.path.abspath(args.filling_script),\
@@ -133,8 +154,6 @@ with open(os.path.join(submission_script_dir,"condor_{}.sub".format(job_name)),"
     leading_script.write('transfer_output_remaps = "{} = {}"\n'.format(job_name + "_$(Process).root" , os.path.join(condor_directory, job_name + "_$(Process).root") ) )
     leading_script.write("\n")
 
-    #a list of plotters for each of the jobs
-    submission_list = []
     for i in range(0, n_jobs):
         partition = {}
         for channel in partitions:
@@ -142,13 +161,11 @@ with open(os.path.join(submission_script_dir,"condor_{}.sub".format(job_name)),"
             for f in partitions[channel]:
                 assert  len(partitions[channel][f]) == n_jobs
                 partition[channel][f] =  partitions[channel][f][i]
-        hist_filler = HistogramFiller(trees, tree_name, calc_weight, selection_string = "", partitions = partition)
-        submission_list.append(hist_filler)
-        leading_script.write("Arguments = $(Process) "  + submission_pickle_file.split("/")[-1] + " " + job_name + "\n")
+        record = create_job_record(tree_name, filling_script.split("/")[-1].split(".")[0], trees, partition, chunk_size = chunk_size, cache_directory = cache_directory, lazy_branches = args.lazy_branches, reader = args.reader, reader_threads = args.reader_threads, precision = args.precision, precision_overrides = parse_overrides(args.precision_overrides))
+        write_job_record(record, submission_record_file.replace("$(Process)", str(i)))
+        leading_script.write("Arguments = $(Process) "  + submission_record_file.split("/")[-1] + " " + job_name + "\n")
         leading_script.write("Queue 1\n")
         leading_script.write("\n")
 
-#create a pickle file for each submission
-pickle.dump( submission_list, open(submission_pickle_file, "wb" ) )
-print("Created the submission file. Ready to go!")
+print("Created the submission files. Ready to go!")
 os._exit(0)
@@ -0,0 +1,90 @@
+#Fill the histograms of a filling script on all of the cores of this machine, and merge them into a single output file
+import utils
+import os
+import shutil
+import tempfile
+import imp
+import multiprocessing
+import argparse
+
+def fill_partition(arguments):
+    '''
+    Fill the histograms for one partition of the trees in a worker process, and return the name of the root file that they were written to.
+    The trees are chained together again in each worker, so that no open files are shared between processes.
+    '''
+    from histogram_filling import HistogramFiller
+    from variables import calc_weight
+    from tree_readers import get_reader
+    from precision import PrecisionPolicy
+    tree_name, file_flavour, filling_script, partition, chunk_size, cache_directory, lazy_branches, reader, n_threads, precision, precision_overrides, output_filename = arguments
+    filling_module = imp.load_source("filling_script_{}".format(os.getpid()), filling_script)
+
+    files = utils.get_files(file_flavour)
+    trees = utils.tchain_files_together(tree_name, files)
+    hist_filler = HistogramFiller(trees, tree_name, calc_weight, selection_string = "", partitions = partition, chunk_size = chunk_size, cache_directory = cache_directory, lazy_branches = lazy_branches, reader = get_reader(reader, n_workers = n_threads), precision = PrecisionPolicy(precision, precision_overrides))
+    filling_module.fill_histograms(hist_filler, output_filename)
+    return output_filename
+
+if __name__ == "__main__":
+    from merging import merge_root_files
+    from precision import parse_overrides
+    from histogram_filling import get_filling_script_branches
+    from variables import calc_weight
+
+    parser = argparse.ArgumentParser(description='Fill the histograms for the EoverPAnalysis plotting on the cores of this machine')
+    parser.add_argument('--tree_name', '-tn', dest="tree_name", type=str, required=True, help='the name of the tree to read from')
+    parser.add_argument('--n_jobs', '-np', dest="n_jobs", type=int, default=0, help='the number of partitions to split the trees into. Defaults to the number of workers')
+    parser.add_argument('--n_workers', '-nw', dest="n_workers", type=int, default=multiprocessing.cpu_count(), help='the number of processes filling histograms at the same time')
+    parser.add_argument('--file_flavour', '-ff', dest="file_flavour", type=str, default='inclusive', help='What is the flavour of the files that you want to run over?')
+    parser.add_argument('--filling_script', '-fs', dest="filling_script", type=str, required=True, help='What is the name of the script that takes the input root file and makes histograms?')
+    parser.add_argument('--output_file', '-o', dest="output_file", type=str, required=True, help='the root file to write the merged histograms to')
+    parser.add_argument('--partitioning', '-pt', dest="partitioning", type=str, default='balanced', choices=['balanced', 'entries'], help='balanced splits the trees into partitions with the same compressed size on disk, and entries splits each file into partitions with the same number of entries')
+    parser.add_argument('--chunk_size', '-cs', dest="chunk_size", type=int, default=None, help='If set, each partition is streamed over in chunks of this many entries instead of reading it all at once')
+    parser.add_argument('--cache_directory', '-cd', dest="cache_directory", type=str, default=None, help='If set, the branches read from the trees are cached in this directory')
+    parser.add_argument('--lazy_branches', '-lb', dest="lazy_branches", action='store_true', help='If set, each branch is only read when a calculation first uses it, instead of reading all of the branches up front')
+    parser.add_argument('--reader', '-rd', dest="reader", type=str, default='root_numpy', choices=['root_numpy', 'uproot'], help='the library used to read the trees. The uproot reader decompresses the branches of each partition on several threads')
+    parser.add_argument('--precision', '-pr', dest="precision", type=str, default='native', choices=['native', 'float32', 'float64'], help='the type that the floating point branches are kept in. native keeps the type of each branch in the tree')
+    parser.add_argument('--precision_overrides', '-po', dest="precision_overrides", type=str, nargs='*', default=[], help='branch:type pairs for branches that need a different type than --precision, e.g. trk_p:float64')
+    args = parser.parse_args()
+
+    n_workers = args.n_workers
+    n_jobs = args.n_jobs if args.n_jobs > 0 else n_workers
+    n_threads = max(1, multiprocessing.cpu_count() // n_workers) #the threads used by each worker to decompress branches, so that the cores are not oversubscribed
+    filling_script = os.path.abspath(args.filling_script)
+    cache_directory = os.path.abspath(args.cache_directory) if args.cache_directory != None else None
+    output_file = os.path.abspath(args.output_file)
+
+    files = utils.get_files(args.file_flavour)
+    trees = utils.tchain_files_together(args.tree_name, files)
+    if args.partitioning == "balanced":
+        #balance the partitions by the compressed size of the branches that the filling script reads
+        branches = get_filling_script_branches(trees, args.tree_name, filling_script, calc_weight)
+        partitions = utils.generate_balanced_partitions(trees, n_jobs, branches)
+    else:
+        partitions = utils.generate_partitions(trees, n_jobs)
+
+    #the histograms of each partition are written to a temporary directory next to the output file
+    temporary_directory = tempfile.mkdtemp(prefix = "run_local_", dir = os.path.dirname(output_file))
+    job_arguments = []
+    for i in range(0, n_jobs):
+        partition = {}
+        for channel in partitions:
+            partition[channel] = {}
+            for f in partitions[channel]:
+                assert len(partitions[channel][f]) == n_jobs
+                partition[channel][f] = partitions[channel][f][i]
+        partition_output = os.path.join(temporary_directory, "partition_{}.root".format(i))
+        job_arguments.append((args.tree_name, args.file_flavour, filling_script, partition, args.chunk_size, cache_directory, args.lazy_branches, args.reader, n_threads, args.precision, parse_overrides(args.precision_overrides), partition_output))
+
+    #start new processes instead of forking this one, because it has the input files open
+    print("Filling {} partitions with {} workers".format(n_jobs, n_workers))
+    pool = multiprocessing.get_context("spawn").Pool(n_workers, maxtasksperchild = 1)
+    try:
+        partition_outputs = pool.map(fill_partition, job_arguments, chunksize = 1)
+        pool.close()
+        pool.join()
+        merge_root_files(partition_outputs, output_file, n_workers = n_workers)
+    finally:
+        pool.terminate()
+        shutil.rmtree(temporary_directory)
+    print("Wrote the histograms to {}".format(output_file))
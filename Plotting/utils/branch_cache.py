@@ -0,0 +1,136 @@
+import numpy as np
+import hashlib
+import json
+import os
+import ROOT
+
+class ColumnData:
+    '''
+    A dictionary-like collection of branch name to numpy array, that can be used in place of the structured array returned by root_numpy.tree2array.
+    len() returns the number of entries, and not the number of branches.
+    '''
+    def __init__(self, columns, entries):
+        self.columns = columns
+        self.entries = entries
+
+    def __getitem__(self, branch):
+        return self.columns[branch]
+
+    def __contains__(self, branch):
+        return branch in self.columns
+
+    def __len__(self):
+        return self.entries
+
+    def keys(self):
+        return self.columns.keys()
+
+class LazyColumnData:
+    '''
+    A dictionary-like collection of branch name to numpy array like ColumnData, where each branch is only read when it is first needed.
+    read_branches is a function that takes a list of branch names and returns a dictionary of branch name to array for those branches, so that the branches that are needed together are read in one pass over the entries. branches is the list of branches that may be needed.
+    used_branches is the list of branches that have been read, in the order that they were read.
+    len() returns entries if it is given. Otherwise, the first branch in branches is read to find it if no branch has been read yet.
+    '''
+    def __init__(self, read_branches, branches, entries = None):
+        self.read_branches = read_branches
+        self.branches = branches
+        self.entries = entries
+        self.columns = {}
+        self.used_branches = []
+
+    def read(self, branches):
+        '''read every branch in branches that hasn't been read yet, with a single call of read_branches'''
+        missing_branches = []
+        for branch in branches:
+            if branch not in self.columns and branch not in missing_branches:
+                missing_branches.append(branch)
+        if len(missing_branches) == 0:
+            return
+        self.columns.update(self.read_branches(missing_branches))
+        self.used_branches += missing_branches
+
+    def __getitem__(self, branch):
+        self.read([branch])
+        return self.columns[branch]
+
+    def __contains__(self, branch):
+        return branch in self.branches or branch in self.columns
+
+    def __len__(self):
+        if self.entries != None:
+            return self.entries
+        if len(self.columns) == 0:
+            if len(self.branches) == 0:
+                return 0
+            self.read([self.branches[0]])
+        return len(self.columns[self.used_branches[0]])
+
+    def keys(self):
+        return list(self.branches) + [branch for branch in self.columns if branch not in self.branches]
+
+def get_file_signature(filename):
+    '''
+    Get a (name, size, modification time) tuple for a file. Local files are checked with os.stat, and remote files are opened to read the size and modification date of the root file.
+    '''
+    if os.path.isfile(filename):
+        stat = os.stat(filename)
+        return (filename, stat.st_size, stat.st_mtime)
+    root_file = ROOT.TFile.Open(filename)
+    if not root_file or root_file.IsZombie():
+        raise ValueError("Could not open the file {} to get its signature".format(filename))
+    signature = (filename, root_file.GetSize(), root_file.GetModificationDate().AsSQLString())
+    root_file.Close()
+    return signature
+
+class BranchCache:
+    '''
+    A local cache of the branches read from the trees. Each branch read from a partition of a tree is stored in its own .npy file, and read back memory mapped.
+    The cache key is the filename, the entry range, the selection string and the name, size and modification time of each file in the chain, so a cache entry is never used after the input files change.
+    The signature of each file is only found once for each BranchCache, because remote files have to be opened to find it.
+    '''
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.file_signatures = {}
+
+    def get_chain_signature(self, tree):
+        '''get the signature of every file in the TChain tree, finding the signature of the files that haven't been seen before'''
+        signature = []
+        for element in tree.GetListOfFiles():
+            filename = element.GetTitle()
+            if filename not in self.file_signatures:
+                self.file_signatures[filename] = get_file_signature(filename)
+            signature.append(self.file_signatures[filename])
+        return signature
+
+    def get_key(self, filename, tree, partition, selection_string = ""):
+        '''get the key for a partition of the tree for filename'''
+        description = [filename, int(partition[0]), int(partition[1]), selection_string, self.get_chain_signature(tree)]
+        return hashlib.sha1(json.dumps(description).encode("utf-8")).hexdigest()
+
+    def get_branch_file(self, key, branch):
+        return os.path.join(self.cache_directory, key, branch + ".npy")
+
+    def load(self, key, branches):
+        '''return a dictionary of branch to memory mapped array for every branch in branches that is in the cache'''
+        columns = {}
+        for branch in branches:
+            branch_file = self.get_branch_file(key, branch)
+            if os.path.exists(branch_file):
+                columns[branch] = np.load(branch_file, mmap_mode = "r")
+        return columns
+
+    def save(self, key, columns):
+        '''save each branch in the dictionary columns to the cache. The file is written to a temporary name first, so that jobs sharing the cache never see a partially written branch'''
+        directory = os.path.join(self.cache_directory, key)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise
+        for branch in columns:
+            branch_file = self.get_branch_file(key, branch)
+            temporary_file = branch_file + ".{}.tmp".format(os.getpid())
+            with open(temporary_file, "wb") as f:
+                np.save(f, np.ascontiguousarray(columns[branch]))
+            os.rename(temporary_file, branch_file)
@@ -0,0 +1,61 @@
+import json
+import os
+import ROOT
+
+def get_chain_files(tree):
+    '''get the names of all of the files in the TChain tree'''
+    return [element.GetTitle() for element in tree.GetListOfFiles()]
+
+def create_job_record(tree_name, filling_script, trees, partition, chunk_size = None, cache_directory = None, selection_string = "", lazy_branches = False, reader = "root_numpy", reader_threads = 1, precision = "native", precision_overrides = {}):
+    '''
+    Create the record that describes a single plotting job. partition is a dictionary of channel to file to the (start, stop) tuple of entries to read.
+    The files in each TChain are written out, so that the job can build its chains again without listing any directories.
+    '''
+    record = {}
+    record["tree_name"] = tree_name
+    record["filling_script"] = filling_script
+    record["selection_string"] = selection_string
+    record["chunk_size"] = chunk_size
+    record["cache_directory"] = cache_directory
+    record["lazy_branches"] = lazy_branches
+    record["reader"] = reader
+    record["reader_threads"] = reader_threads #the threads used by the reader to decompress branches, which should match the cores requested for the job
+    record["precision"] = precision
+    record["precision_overrides"] = precision_overrides
+    record["partition"] = {}
+    record["chain_files"] = {}
+    for channel in partition:
+        record["partition"][channel] = {}
+        record["chain_files"][channel] = {}
+        for f in partition[channel]:
+            record["partition"][channel][f] = list(partition[channel][f])
+            record["chain_files"][channel][f] = get_chain_files(trees[channel][f])
+    return record
+
+def write_job_record(record, filename):
+    with open(filename, "w") as f:
+        json.dump(record, f, indent = 1, sort_keys = True)
+
+def load_job_record(filename):
+    with open(filename, "r") as f:
+        record = json.load(f)
+    for channel in record["partition"]:
+        for f in record["partition"][channel]:
+            record["partition"][channel][f] = tuple(record["partition"][channel][f])
+    return record
+
+def create_histogram_filler(record, weight_calculator):
+    '''
+    Create the HistogramFiller for the job described by record. The TChains only open their files when the entries are read.
+    '''
+    from histogram_filling import HistogramFiller
+    from tree_readers import get_reader
+    from precision import PrecisionPolicy
+    trees = {}
+    for channel in record["chain_files"]:
+        trees[channel] = {}
+        for f in record["chain_files"][channel]:
+            trees[channel][f] = ROOT.TChain(record["tree_name"])
+            for chain_file in record["chain_files"][channel][f]:
+                trees[channel][f].Add(chain_file)
+    return HistogramFiller(trees, record["tree_name"], weight_calculator, selection_string = record["selection_string"], partitions = record["partition"], chunk_size = record["chunk_size"], cache_directory = record["cache_directory"], lazy_branches = record["lazy_branches"], reader = get_reader(record["reader"], n_workers = record["reader_threads"]), precision = PrecisionPolicy(record["precision"], record["precision_overrides"]))
@@ -0,0 +1,186 @@
+import ROOT
+import numpy as np
+from array import array
+import multiprocessing
+import imp
+
+try:
+    imp.find_module('root_numpy')
+    foundRootNumpy=True
+except ImportError:
+    foundRootNumpy=False
+    print("Didn't find root_numpy module. Histograms can't be merged. Continuing")
+
+if foundRootNumpy:
+    from root_numpy import hist2array
+    import root_numpy
+
+def walk_directory(directory, path = ""):
+    '''
+    Yield a (path, key) tuple for every object in the root directory, looking inside of sub directories. path is the name of the directory that the object is in, relative to directory.
+    '''
+    for key in directory.GetListOfKeys():
+        #only directories are looked inside. TKey::IsFolder is also true for histograms and trees
+        if ROOT.TClass.GetClass(key.GetClassName()).InheritsFrom("TDirectory"):
+            sub_path = key.GetName() if path == "" else path + "/" + key.GetName()
+            for item in walk_directory(directory.Get(key.GetName()), sub_path):
+                yield item
+        else:
+            yield path, key
+
+def histogram_to_arrays(histogram):
+    '''
+    Get a dictionary of the numpy arrays that describe the contents of a TH1D, TH2D or TProfile. The arrays are in the global bin order of root, including the underflow and overflow bins. Every array can be summed to merge two histograms with the same binning.
+    '''
+    arrays = {}
+    arrays["contents"] = np.ravel(hist2array(histogram, include_overflow = True, copy = True), order = "F")
+    arrays["sumw2"] = root_numpy.array(histogram.GetSumw2(), copy = True) if histogram.GetSumw2N() > 0 else None
+    stats = array('d', [0.0] * 13)
+    histogram.GetStats(stats)
+    arrays["stats"] = np.array(stats)
+    arrays["entries"] = histogram.GetEntries()
+    if histogram.InheritsFrom("TProfile"):
+        arrays["bin_entries"] = np.array([histogram.GetBinEntries(i) for i in range(0, histogram.GetNcells())])
+        arrays["bin_sumw2"] = root_numpy.array(histogram.GetBinSumw2(), copy = True) if histogram.GetBinSumw2().GetSize() > 0 else None
+    return arrays
+
+def set_histogram_arrays(histogram, arrays):
+    '''set the contents of histogram from a dictionary of arrays returned by histogram_to_arrays'''
+    ncells = histogram.GetNcells()
+    histogram.Set(ncells, np.ascontiguousarray(arrays["contents"], dtype = np.float64))
+    if arrays["sumw2"] is not None:
+        if histogram.GetSumw2N() == 0: histogram.Sumw2()
+        histogram.GetSumw2().Set(ncells, np.ascontiguousarray(arrays["sumw2"], dtype = np.float64))
+    if "bin_entries" in arrays:
+        for i in range(0, ncells):
+            histogram.SetBinEntries(i, arrays["bin_entries"][i])
+        if arrays["bin_sumw2"] is not None:
+            histogram.GetBinSumw2().Set(ncells, np.ascontiguousarray(arrays["bin_sumw2"], dtype = np.float64))
+    histogram.PutStats(array('d', arrays["stats"]))
+    histogram.SetEntries(arrays["entries"])
+
+def add_arrays(total, other):
+    '''add the histogram arrays in other to the ones in total'''
+    for key in other:
+        if other[key] is None:
+            continue
+        if total[key] is None:
+            total[key] = other[key]
+        else:
+            total[key] = total[key] + other[key]
+
+class MergeResult:
+    '''
+    The summed histograms of some of the files being merged.
+    histograms is a dictionary of (path, name) to the arrays of the histogram. sources is a dictionary of (path, name) to the first file that the histogram or tree was found in, which is used to get the binning of each histogram and the trees when the merged file is written.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.sources = {}
+        self.trees = []
+
+    def add_file(self, filename):
+        '''add every histogram in the file filename'''
+        input_file = ROOT.TFile.Open(filename, "READ")
+        if not input_file or input_file.IsZombie():
+            raise ValueError("Could not open the file {} for merging".format(filename))
+        for path, key in walk_directory(input_file):
+            name = (path, key.GetName())
+            if key.GetClassName().startswith("TTree"):
+                #the trees, such as the BinningTree, are the same in every file, and aren't added
+                if name not in self.sources:
+                    self.sources[name] = filename
+                    self.trees.append(name)
+                continue
+            obj = key.ReadObj()
+            if not obj.InheritsFrom("TH1"):
+                continue
+            arrays = histogram_to_arrays(obj)
+            if name in self.histograms:
+                add_arrays(self.histograms[name], arrays)
+            else:
+                self.histograms[name] = arrays
+                self.sources[name] = filename
+        input_file.Close()
+
+    def add_result(self, other):
+        '''add the histograms of another MergeResult'''
+        for name in other.histograms:
+            if name in self.histograms:
+                add_arrays(self.histograms[name], other.histograms[name])
+            else:
+                self.histograms[name] = other.histograms[name]
+                self.sources[name] = other.sources[name]
+        for name in other.trees:
+            if name not in self.sources:
+                self.sources[name] = other.sources[name]
+                self.trees.append(name)
+
+def merge_group(items):
+    '''merge a list of filenames and MergeResults into a single MergeResult'''
+    result = MergeResult()
+    for item in items:
+        if isinstance(item, MergeResult):
+            result.add_result(item)
+        else:
+            print("Reading the histograms in {}".format(item))
+            result.add_file(item)
+    return result
+
+def cd_directory(root_file, path):
+    '''cd to the directory path in root_file, creating it if it doesn't exist'''
+    root_file.cd()
+    if path == "":
+        return
+    if not root_file.GetDirectory(path):
+        root_file.mkdir(path)
+    root_file.cd(path)
+
+def write_merge_result(result, output_filename):
+    '''write the merged histograms and a copy of each tree to output_filename'''
+    output_file = ROOT.TFile(output_filename, "RECREATE")
+    #open each source file once to get the trees and the binning of the histograms
+    names_for_source = {}
+    for name in result.sources:
+        names_for_source.setdefault(result.sources[name], []).append(name)
+    for source in sorted(names_for_source):
+        input_file = ROOT.TFile.Open(source, "READ")
+        for (path, name) in sorted(names_for_source[source]):
+            obj = input_file.Get(name if path == "" else path + "/" + name)
+            cd_directory(output_file, path)
+            if (path, name) in result.histograms:
+                histogram = obj.Clone(name)
+                histogram.SetDirectory(ROOT.gDirectory)
+                set_histogram_arrays(histogram, result.histograms[(path, name)])
+                histogram.Write(name)
+            else:
+                obj.CloneTree(-1, "fast").Write()
+        input_file.Close()
+    output_file.Close()
+
+def merge_root_files(input_filenames, output_filename, n_workers = 1, fan_in = 2):
+    '''
+    Merge the histograms of the files input_filenames, and write them to output_filename.
+    The files are merged as a tree reduction: each step merges groups of fan_in files or partial results, and the groups are merged in parallel on n_workers processes, until one result is left.
+    '''
+    assert fan_in >= 2
+    items = list(input_filenames)
+    if len(items) == 0:
+        raise ValueError("No files to merge")
+
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        while len(items) > 1 or not isinstance(items[0], MergeResult):
+            groups = [items[i:i + fan_in] for i in range(0, len(items), fan_in)]
+            print("Merging {} items in {} groups".format(len(items), len(groups)))
+            if pool != None:
+                items = pool.map(merge_group, groups, chunksize = 1)
+            else:
+                items = [merge_group(group) for group in groups]
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    print("Writing {} merged histograms to {}".format(len(items[0].histograms), output_filename))
+    write_merge_result(items[0], output_filename)
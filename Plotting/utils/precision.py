@@ -0,0 +1,39 @@
+#The precision that the branches are kept in once they have been read from the trees
+import numpy as np
+
+class PrecisionPolicy:
+    '''
+    Choose the numpy type of each branch after it is read. Most branches written by EoverPTreeAlgo are floats or small integers, and tree readers return them in those types.
+    default is "native" to keep every branch in the type of the tree, or "float32" or "float64" to convert every floating point branch to that type. Integer and boolean branches are kept as they are.
+    overrides is a dictionary of branch name to numpy type name, for branches that need a different type than the default, e.g. {"trk_p" : "float64"}.
+    Every column is returned as its own contiguous array, instead of a strided view into the structured array that it was read into, so that the calculations on it read as little memory as possible.
+    '''
+    def __init__(self, default = "native", overrides = {}):
+        if default not in ["native", "float32", "float64"]:
+            raise ValueError("Unknown precision {}. Use native, float32 or float64".format(default))
+        self.default = default
+        self.overrides = dict(overrides)
+        for branch in self.overrides:
+            np.dtype(self.overrides[branch]) #check that the type exists before anything is read
+
+    def get_dtype(self, branch, dtype):
+        '''get the type that the branch, read from the tree as dtype, is kept in'''
+        if branch in self.overrides:
+            return np.dtype(self.overrides[branch])
+        if self.default == "native" or dtype.kind != "f":
+            return dtype
+        return np.dtype(self.default)
+
+    def apply(self, columns):
+        '''convert each column in the dictionary columns of branch to numpy array to its type'''
+        for branch in columns:
+            columns[branch] = np.ascontiguousarray(columns[branch], dtype = self.get_dtype(branch, columns[branch].dtype))
+        return columns
+
+def parse_overrides(overrides):
+    '''get the dictionary of branch to numpy type from a list of branch:type strings, as given on the command line'''
+    parsed = {}
+    for override in overrides:
+        branch, dtype = override.split(":")
+        parsed[branch] = dtype
+    return parsed
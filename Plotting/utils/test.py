@@ -0,0 +1,45 @@
+#Checks of the merging of the histograms written by the filling jobs. Run with python test.py from the utils directory
+import os
+import shutil
+import tempfile
+import ROOT
+from merging import merge_root_files, walk_directory
+
+def write_channel_file(filename, fill_value):
+    '''write a file with a channel directory holding a TH1D and a TProfile, like the output of a filling job'''
+    output_file = ROOT.TFile(filename, "RECREATE")
+    directory = output_file.mkdir("LowMuData")
+    directory.cd()
+    histogram = ROOT.TH1D("EOPLowMuData", "EOPLowMuData", 10, 0.0, 2.0)
+    histogram.Sumw2()
+    histogram.Fill(fill_value)
+    profile = ROOT.TProfile("EOPProfileLowMuData", "EOPProfileLowMuData", 10, 0.0, 2.0)
+    profile.Fill(fill_value, 2.0 * fill_value)
+    output_file.Write()
+    output_file.Close()
+
+def test_merge_channel_directory():
+    '''the histograms inside of a channel directory are found, and their contents are added'''
+    directory = tempfile.mkdtemp()
+    try:
+        input_files = [os.path.join(directory, "input_{}.root".format(i)) for i in range(0, 3)]
+        for i, filename in enumerate(input_files):
+            write_channel_file(filename, 0.5 + 0.2 * i)
+        output_filename = os.path.join(directory, "merged.root")
+        merge_root_files(input_files, output_filename)
+
+        merged = ROOT.TFile(output_filename, "READ")
+        assert sorted([(path, key.GetName()) for path, key in walk_directory(merged)]) == [("LowMuData", "EOPLowMuData"), ("LowMuData", "EOPProfileLowMuData")]
+        histogram = merged.Get("LowMuData/EOPLowMuData")
+        assert histogram.GetEntries() == 3
+        assert abs(histogram.Integral() - 3.0) < 1e-9
+        profile = merged.Get("LowMuData/EOPProfileLowMuData")
+        assert profile.GetEntries() == 3
+        assert abs(profile.GetBinContent(profile.FindBin(0.5)) - 1.0) < 1e-9
+        merged.Close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    test_merge_channel_directory()
+    print("The merging checks passed")
@@ -0,0 +1,115 @@
+#Readers that turn a range of entries of a TChain into a numpy structured array, with the same output as root_numpy.tree2array
+import numpy as np
+import imp
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    imp.find_module('root_numpy')
+    foundRootNumpy=True
+except ImportError:
+    foundRootNumpy=False
+
+try:
+    imp.find_module('uproot')
+    foundUproot=True
+except ImportError:
+    foundUproot=False
+
+if foundRootNumpy:
+    from root_numpy import tree2array
+
+if foundUproot:
+    import uproot
+
+def columns_to_array(columns, branches):
+    '''create a structured array with a field for each branch in branches from the dictionary columns of branch to numpy array'''
+    entries = len(columns[branches[0]]) if len(branches) > 0 else 0
+    array = np.empty(entries, dtype = [(branch, columns[branch].dtype) for branch in branches])
+    for branch in branches:
+        array[branch] = columns[branch]
+    return array
+
+class RootNumpyReader:
+    '''read the entries of a tree with root_numpy.tree2array'''
+    name = "root_numpy"
+    supports_selection_string = True
+
+    def __init__(self):
+        if not foundRootNumpy:
+            raise ImportError("root_numpy is needed to read trees with the root_numpy reader")
+
+    def read(self, tree, branches, selection_string, start, stop):
+        return tree2array(tree, branches, selection_string, start = start, stop = stop)
+
+class UprootReader:
+    '''
+    Read the entries of a TChain with uproot, file by file. The baskets are decompressed and interpreted on a pool of n_workers threads, so that several branches are read at the same time on multiple cores.
+    ROOT is only used to get the names of the files in the chain, and the files are opened with uproot.
+    Selection strings use the syntax of TTree::Draw, and can only be applied by the root_numpy reader.
+    '''
+    name = "uproot"
+    supports_selection_string = False
+
+    def __init__(self, n_workers = None):
+        if not foundUproot:
+            raise ImportError("uproot is needed to read trees with the uproot reader")
+        self.n_workers = n_workers if n_workers != None else multiprocessing.cpu_count()
+        self.executor = None
+        self.files = {} #dictionary of filename to the open uproot file, so that each file is only opened once
+        self.file_entries = {} #dictionary of filename to the number of entries in the tree of that file
+
+    def get_executor(self):
+        #the executor is created when it is first used, so that readers can be passed to other processes before any threads are started
+        if self.executor == None:
+            self.executor = ThreadPoolExecutor(self.n_workers)
+        return self.executor
+
+    def get_file(self, filename):
+        #the files are opened when they are first read, like the executor
+        if filename not in self.files:
+            self.files[filename] = uproot.open(filename)
+        return self.files[filename]
+
+    def get_file_entries(self, filename, tree_name):
+        if filename not in self.file_entries:
+            self.file_entries[filename] = self.get_file(filename)[tree_name].num_entries
+        return self.file_entries[filename]
+
+    def read(self, tree, branches, selection_string, start, stop):
+        assert selection_string == ""
+        tree_name = tree.GetName()
+        executor = self.get_executor()
+
+        #find the entries to read in each file of the chain
+        blocks = []
+        file_start = 0
+        filenames = [element.GetTitle() for element in tree.GetListOfFiles()]
+        for filename in filenames:
+            file_stop = file_start + self.get_file_entries(filename, tree_name)
+            entry_start = max(start, file_start)
+            entry_stop = min(stop, file_stop) if stop != None else file_stop
+            if entry_start < entry_stop:
+                blocks.append(self.get_file(filename)[tree_name].arrays(branches, entry_start = entry_start - file_start, entry_stop = entry_stop - file_start, library = "np", decompression_executor = executor, interpretation_executor = executor))
+            file_start = file_stop
+            if stop != None and file_start >= stop:
+                break
+        #read no entries from the first file for an empty range, so that the arrays have the types of the branches
+        if len(blocks) == 0 and len(filenames) > 0:
+            blocks.append(self.get_file(filenames[0])[tree_name].arrays(branches, entry_start = 0, entry_stop = 0, library = "np"))
+
+        columns = {}
+        for branch in branches:
+            if len(blocks) > 0:
+                columns[branch] = np.concatenate([block[branch] for block in blocks])
+            else:
+                columns[branch] = np.array([])
+        return columns_to_array(columns, branches)
+
+def get_reader(name, n_workers = None):
+    '''get a reader by its name, either root_numpy or uproot'''
+    if name == RootNumpyReader.name:
+        return RootNumpyReader()
+    if name == UprootReader.name:
+        return UprootReader(n_workers = n_workers)
+    raise ValueError("Unknown reader {}. Use root_numpy or uproot".format(name))
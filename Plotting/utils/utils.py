@@ -212,25 +212,94 @@ def generate_partitions(trees, NPartitions):
             assert f not in partitions[channel]
             tree = trees[channel][f] 
             entries = tree.GetEntries()
-            #OK we need to create n event splits from 0 to entries
-            step = int(float(entries)/float(NPartitions)) - 1 
-            cuts = []
-            #are there enough entires to warrant a split?
-            if step > 50:
-                cuts.append((0, step))
-                while cuts[-1][-1] < entries:
-                    last_value = cuts[-1][-1]
-                    cuts.append( (last_value, last_value + step))
-                cuts = cuts[:-2]
-                cuts.append( (cuts[-1][-1], entries))
-                assert len(cuts) == NPartitions
-            else:
-                cuts.append((0.0, entries))
-                for i in range(1, NPartitions):
-                    cuts.append( (entries, entries) )
+            #split the entries from 0 to entries into NPartitions ranges that differ in size by at most one entry
+            cuts = [((entries * i) // NPartitions, (entries * (i + 1)) // NPartitions) for i in range(0, NPartitions)]
+            assert len(cuts) == NPartitions
             print("Found partitions for channel {}, and file {}, and they were {}".format(channel, f, cuts))
             partitions[channel][f] = cuts
 
     print("Generated partitions")
     return partitions
 
+def get_cluster_costs(tree, branches = None):
+    '''
+    Given a TChain tree, get a list of (start, stop, cost) tuples for each cluster of entries in the chain. The entry numbers are those of the chain.
+    The cost of a cluster is an estimate of the compressed bytes of the branches that will be read from it. If branches is None, all branches are counted.
+    '''
+    clusters = []
+    offset = 0
+    for element in tree.GetListOfFiles():
+        root_file = ROOT.TFile.Open(element.GetTitle(), "READ")
+        if not root_file or root_file.IsZombie():
+            raise ValueError("Could not open the file {}".format(element.GetTitle()))
+        file_tree = root_file.Get(tree.GetName())
+        if not file_tree:
+            root_file.Close()
+            continue
+        entries = file_tree.GetEntries()
+        if entries == 0:
+            root_file.Close()
+            continue
+
+        if branches == None:
+            zip_bytes = file_tree.GetZipBytes()
+        else:
+            zip_bytes = 0
+            for branch_name in branches:
+                branch = file_tree.GetBranch(branch_name)
+                if branch: zip_bytes += branch.GetZipBytes("*")
+        cost_per_entry = float(zip_bytes) / float(entries)
+
+        #go through the clusters of the tree, so that no cluster is split between two partitions
+        cluster_iterator = file_tree.GetClusterIterator(0)
+        start = cluster_iterator()
+        while start < entries:
+            stop = min(cluster_iterator.GetNextEntry(), entries)
+            clusters.append((offset + start, offset + stop, cost_per_entry * (stop - start)))
+            start = cluster_iterator()
+
+        offset += entries
+        root_file.Close()
+    return clusters
+
+def generate_balanced_partitions(trees, NPartitions, branches = None):
+    '''
+    generate a dictionary of channel to file to list of tuples with information about what events to read for each partition
+    The partitions are chosen so that each one has about the same cost, estimated from the compressed bytes of the branches to be read, instead of the same number of entries in each file.
+    All of the clusters of all of the files are put in one list, which is cut into NPartitions consecutive pieces of equal cost. Partitions never split a cluster, and small files are packed together into one partition instead of being spread over all of them.
+    '''
+    units = []
+    for channel in trees:
+        for f in trees[channel]:
+            for start, stop, cost in get_cluster_costs(trees[channel][f], branches):
+                units.append((channel, f, start, stop, cost))
+
+    total_cost = sum([unit[-1] for unit in units])
+    target_cost = total_cost / float(NPartitions) if total_cost > 0 else 1.0
+    print("Balancing a total cost of {} bytes over {} partitions".format(total_cost, NPartitions))
+
+    #each partition reads at most one range of entries from each file, since the units of a file are consecutive
+    ranges = {}
+    cumulative_cost = 0.0
+    for channel, f, start, stop, cost in units:
+        partition_number = min(NPartitions - 1, int((cumulative_cost + 0.5 * cost) / target_cost))
+        cumulative_cost += cost
+        ranges.setdefault((channel, f), {})
+        if partition_number in ranges[(channel, f)]:
+            ranges[(channel, f)][partition_number] = (ranges[(channel, f)][partition_number][0], stop)
+        else:
+            ranges[(channel, f)][partition_number] = (start, stop)
+
+    partitions = {}
+    for channel in trees:
+        partitions[channel] = {}
+        for f in trees[channel]:
+            entries = trees[channel][f].GetEntries()
+            file_ranges = ranges.get((channel, f), {})
+            cuts = [file_ranges[i] if i in file_ranges else (entries, entries) for i in range(0, NPartitions)]
+            print("Found partitions for channel {}, and file {}, and they were {}".format(channel, f, cuts))
+            partitions[channel][f] = cuts
+
+    print("Generated balanced partitions")
+    return partitions
+
@@ -0,0 +1,64 @@
+import numpy as np
+
+def edges_are_uniform(edges):
+    '''check if all of the bins defined by the sorted array edges have the same width'''
+    widths = np.diff(edges)
+    if len(widths) == 0 or widths[0] <= 0.0:
+        return False
+    return np.all(np.abs(widths - widths[0]) <= 1e-6 * widths[0])
+
+def find_bins(values, edges):
+    '''
+    Get the index i of the bin edges[i] <= value < edges[i+1] for each entry in values. Values that are not in any bin, including nan, get an index of -1.
+    edges are the sorted low edges of the bins followed by the high edge of the last bin.
+    For uniform bins the index is calculated directly and then corrected by one bin where floating point rounding puts the value on the wrong side of an edge. Otherwise a binary search is done on the edges.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    nbins = len(edges) - 1
+
+    if edges_are_uniform(edges):
+        width = (edges[-1] - edges[0]) / nbins
+        with np.errstate(invalid='ignore'):
+            position = np.floor((values - edges[0]) / width)
+        position[np.isnan(position)] = nbins
+        bin_index = np.clip(position, -1, nbins).astype(np.int64)
+
+        #move the values that were put one bin too high or one bin too low
+        lower_edge = edges[np.clip(bin_index, 0, nbins)]
+        upper_edge = edges[np.clip(bin_index + 1, 0, nbins)]
+        too_high = (bin_index >= 0) & (values < lower_edge)
+        too_low = (bin_index < nbins) & (values >= upper_edge)
+        bin_index[too_high] -= 1
+        bin_index[too_low] += 1
+    else:
+        bin_index = np.searchsorted(edges, values, side='right') - 1
+
+    bin_index[(bin_index < 0) | (bin_index >= nbins)] = -1
+    return bin_index
+
+def get_weights_from_bins(variable_in_histogram, low_edges, high_edges, normalization):
+    '''
+    Get the weight for each entry in variable_in_histogram from the normalization of the bin [low_edges[i], high_edges[i]) that it falls in.
+    Entries that are not in any bin get a weight of 1.
+    '''
+    edges = np.append(low_edges, high_edges[-1])
+    bin_index = find_bins(variable_in_histogram, edges)
+
+    weights = np.ones(len(bin_index), dtype=np.float64)
+    in_histogram = bin_index >= 0
+    weights[in_histogram] = np.asarray(normalization, dtype=np.float64)[bin_index[in_histogram]]
+    return weights
+
+def get_weights_from_2dbins(xvariable_in_histogram, yvariable_in_histogram, xlow_edges, xhigh_edges, ylow_edges, yhigh_edges, normalization):
+    '''
+    Get the weight for each entry from normalization[ix, iy], where ix and iy are the x and y bins that the entry falls in.
+    Entries that are not in any bin get a weight of 1.
+    '''
+    xbin_index = find_bins(xvariable_in_histogram, np.append(xlow_edges, xhigh_edges[-1]))
+    ybin_index = find_bins(yvariable_in_histogram, np.append(ylow_edges, yhigh_edges[-1]))
+
+    weights = np.ones(len(xbin_index), dtype=np.float64)
+    in_histogram = (xbin_index >= 0) & (ybin_index >= 0)
+    weights[in_histogram] = np.asarray(normalization, dtype=np.float64)[xbin_index[in_histogram], ybin_index[in_histogram]]
+    return weights